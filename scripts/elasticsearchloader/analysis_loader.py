@@ -10,15 +10,27 @@ import os
 import logging
 import re
 import copy
+import threading
 from datetime import datetime
 from prettytable import PrettyTable
 from uuid import uuid4
 import elasticsearchloader.file_utils as fx
+from elasticsearchloader.file_utils import LineReader
+from elasticsearchloader.file_utils import get_compression
+from elasticsearchloader.file_utils import open_input
 from elasticsearchloader.es_utils import ElasticSearchTools
 from elasticsearchloader.es_settings import HEADER_FIELDS, REFERENCE_INDEX
 from elasticsearchloader.es_settings import YAML_INDEX
+from elasticsearchloader.es_settings import HEADER_FILTER_FIELDS
+from elasticsearchloader.es_settings import RECORD_HEADER_FIELDS
+from elasticsearchloader.source_index import index_source
 from elasticsearch.exceptions import NotFoundError
 
+# Number of loaders of the process writing to each index with refresh
+# disabled, by client and index
+_refresh_holds = {}
+_refresh_lock = threading.Lock()
+
 
 class AnalysisLoader(object):
 
@@ -27,7 +39,6 @@ class AnalysisLoader(object):
     each specific data type.
     '''
 
-    LOAD_FACTOR = 4000
     es_tools = {}
     record_attributes = []
     __load_id__ = ''
@@ -116,7 +127,15 @@ class AnalysisLoader(object):
         project_data = {}
 
         if 'run_id' in query_values.keys():
-            yaml_records = self.get_reference_data(YAML_INDEX, query_values)
+            # Both lookups are sent in a single request
+            searches = self.es_tools.multi_search()
+            searches.add(self.get_reference_query(query_values), YAML_INDEX)
+            del query_values['run_id']
+            searches.add(
+                self.get_reference_query(query_values), REFERENCE_INDEX)
+            [yaml_results, project_results] = searches.execute()
+
+            yaml_records = yaml_results.get("hits", {}).get("hits", [])
             if not yaml_records:
                 logging.error("Sample not found in Yaml index.")
             else:
@@ -124,10 +143,7 @@ class AnalysisLoader(object):
                     yaml_records, infile_handle.name
                 )
 
-            del query_values['run_id']
-            project_records = self.get_reference_data(
-                REFERENCE_INDEX, query_values
-            )
+            project_records = project_results.get("hits", {}).get("hits", [])
             if not project_records:
                 logging.error("Sample not found in Sample index.")
             else:
@@ -165,7 +181,7 @@ class AnalysisLoader(object):
         lines_read = 0
         file_is_valid = True
 
-        file_handle = open(file_path, 'r')
+        file_handle = open_input(file_path)
         for line in file_handle:
             if line.startswith('#'):
                 continue
@@ -190,6 +206,10 @@ class AnalysisLoader(object):
         sets up Elastic search connection parameters
         '''
         self.__load_id__ = str(uuid4())
+        # Header fields kept on the records, all of them unless the header
+        # is normalized
+        self.__record_fields__ = None
+        self.__source_header__ = None
         self.es_tools = ElasticSearchTools(es_doc_type, es_index)
         self.es_tools.init_host(
             host=es_host,
@@ -219,25 +239,26 @@ class AnalysisLoader(object):
             self,
             analysis_file=None,
             custom_header=None,
-            analysis_data=None):
+            analysis_data=None,
+            checksum=None):
         '''
         parses a analysis file.
         requires correct header and filename standard
+        the file is read in a single pass, counting the input lines and
+        computing its checksum with the given algorithm, if any
         '''
         # initiate variables
-        analysis_values = {}
         header_values = {}
-        buffered_values = []
-        index_cmd = self.get_index_cmd()
         stats = {'skipped': 0, 'lines_read': 0, 'non_standard_chroms': 0}
         self.disable_index_refresh()
 
         if not isinstance(custom_header, dict):
             custom_header = {}
 
+        file_handle = None
         try:
 
-            file_handle = open(analysis_file, 'r')
+            file_handle = LineReader(analysis_file, checksum)
             header_values = self.parse_header(file_handle, custom_header)
             # Add any user provided data to the header
             if isinstance(custom_header, dict):
@@ -245,78 +266,25 @@ class AnalysisLoader(object):
                     header_values.items() + custom_header.items()
                 )
 
-            # Reposition the handle at the beginning of the file
-            file_handle.seek(0)
-
-            # read the records into the intermediate analysis_files
-            for line in file_handle:
-                stats["lines_read"] += 1
-
-                # Skip lines that begin with a # (ie don't parse comments)
-                if stats["lines_read"] == 1 or line.startswith(
-                        '#') or line.startswith(' '):
-                    stats["skipped"] += 1
-                    continue
-
-                parsed_line = self.parse_line(line)
-                # line could be empty or line could be an uncommented column
-                # header (like titan)
-                if not parsed_line:
-                    stats["skipped"] += 1
-                    continue
-
-                if not isinstance(parsed_line, list):
-                    parsed_line = [parsed_line]
-
-                if len(parsed_line) == 2:
-                    record_copy = copy.deepcopy(parsed_line[0])
-                    parsed_line[0]['paired_record'] = self.__get_paired_record(
-                        parsed_line[1])
-                    parsed_line[1]["paired_record"] = self.__get_paired_record(
-                        record_copy)
-
-                for idx, parsed_line_record in enumerate(parsed_line):
-                    if 'chrom_number' in parsed_line_record.keys():
-                        chrom_number = str(parsed_line_record['chrom_number'])
-                        if re.match(r'^\d{1,2}$', chrom_number):
-                            chrom_number = chrom_number.zfill(2)
-                        else:
-                            chrom_number = chrom_number.upper()
-                            if chrom_number not in ['X', 'Y']:
-                                stats["non_standard_chroms"] += 1
-                                stats["skipped"] += 1
-                                # Remove from the buffer any records that are
-                                # produced by the line being skipped and that
-                                # might have been queueued for indexing
-                                if idx:
-                                    buffered_values = buffered_values[:-idx*2]
-                                break
-
-                        parsed_line_record['chrom_number'] = chrom_number
-
-                    analysis_values = dict(
-                        header_values.items() +
-                        parsed_line_record.items())
-                    analysis_values["source_id"] = self.__load_id__
-
-                    buffered_values.append(index_cmd)
-                    buffered_values.append(analysis_values)
-
-                if len(buffered_values) >= self.LOAD_FACTOR:
-                    self.es_tools.submit_bulk_to_es(buffered_values)
-                    buffered_values = []
-
-            # any leftovers....
-            if len(buffered_values) > 0:
-                self.es_tools.submit_bulk_to_es(buffered_values)
+            header_values = self.store_header(header_values)
+
+            # Replay the lines read while parsing the header
+            file_handle.rewind()
+
+            # records are bulk indexed while the file is still being parsed
+            for _ in self.es_tools.parallel_bulk_to_es(
+                    self._generate_actions(file_handle, header_values, stats)):
+                pass
             file_handle.close()
+            stats.update(file_handle.get_stats())
 
         except IOError as error:
             logging.warn('IO Error: %s', error)
             logging.warn(
                 "NOTE: Load failed. Check logs to verify" +
                 " what was actually loaded. ")
-            file_handle.close()
+            if file_handle:
+                file_handle.close()
         finally:
             self.enable_index_refresh()
 
@@ -325,13 +293,121 @@ class AnalysisLoader(object):
 
         return stats
 
+    def normalize_header(self, filter_fields=None):
+        '''
+        Stores the header once in the sources index, in place of copying
+        it into every record. The records keep their source ID and the
+        given header fields, HEADER_FILTER_FIELDS by default, along with
+        the RECORD_HEADER_FIELDS
+        '''
+        if filter_fields is None:
+            filter_fields = HEADER_FILTER_FIELDS
+        self.__record_fields__ = RECORD_HEADER_FIELDS + [
+            field for field in filter_fields
+            if field not in RECORD_HEADER_FIELDS]
+
+    def store_header(self, header_data):
+        '''
+        Returns the header fields to be added to each record, in normalized
+        header mode the header is stored into the sources index first
+        '''
+        if self.__record_fields__ is None:
+            return header_data
+
+        self.__source_header__ = index_source(
+            self.es_tools, self.__load_id__, header_data)
+
+        record_header = dict(
+            (key, header_data[key]) for key in self.__record_fields__
+            if key in header_data)
+        record_header["source_id"] = self.__load_id__
+        return record_header
+
+    def _generate_actions(self, file_handle, header_values, stats):
+        '''
+        reads the data lines of an input file, yields the index command and
+        record pairs to be submitted for bulk indexing
+        '''
+        index_cmd = self.get_index_cmd()
+
+        for line in file_handle:
+            stats["lines_read"] += 1
+
+            # Skip lines that begin with a # (ie don't parse comments)
+            if stats["lines_read"] == 1 or line.startswith(
+                    '#') or line.startswith(' '):
+                stats["skipped"] += 1
+                continue
+
+            parsed_line = self.parse_line(line)
+            # line could be empty or line could be an uncommented column
+            # header (like titan)
+            if not parsed_line:
+                stats["skipped"] += 1
+                continue
+
+            if not isinstance(parsed_line, list):
+                parsed_line = [parsed_line]
+
+            if len(parsed_line) == 2:
+                record_copy = copy.deepcopy(parsed_line[0])
+                parsed_line[0]['paired_record'] = self.__get_paired_record(
+                    parsed_line[1])
+                parsed_line[1]["paired_record"] = self.__get_paired_record(
+                    record_copy)
+
+            line_records = []
+            for parsed_line_record in parsed_line:
+                if 'chrom_number' in parsed_line_record.keys():
+                    chrom_number = str(parsed_line_record['chrom_number'])
+                    if re.match(r'^\d{1,2}$', chrom_number):
+                        chrom_number = chrom_number.zfill(2)
+                    else:
+                        chrom_number = chrom_number.upper()
+                        if chrom_number not in ['X', 'Y']:
+                            stats["non_standard_chroms"] += 1
+                            stats["skipped"] += 1
+                            # Drop any records already produced by the
+                            # line being skipped
+                            line_records = []
+                            break
+
+                    parsed_line_record['chrom_number'] = chrom_number
+
+                analysis_values = dict(
+                    header_values.items() +
+                    parsed_line_record.items())
+                analysis_values["source_id"] = self.__load_id__
+                line_records.append(analysis_values)
+
+            for analysis_values in line_records:
+                yield index_cmd, analysis_values
+
     def disable_index_refresh(self):
-        ''' Temporarily disables index refreshing during bulk indexing '''
-        return self.es_tools.put_settings({"refresh_interval": "-1"})
+        '''
+        Temporarily disables index refreshing during bulk indexing, until
+        all the loaders of the process writing to the index are done
+        '''
+        key = (id(self.es_tools.es), self.es_tools.get_index())
+        with _refresh_lock:
+            _refresh_holds[key] = _refresh_holds.get(key, 0) + 1
+            if _refresh_holds[key] > 1:
+                return True
+            return self.es_tools.put_settings({"refresh_interval": "-1"})
 
     def enable_index_refresh(self):
-        ''' Re-enables index refresh '''
-        if self.es_tools.put_settings({"refresh_interval": "1s"}):
+        '''
+        Re-enables index refresh, once the last loader of the process
+        writing to the index is done
+        '''
+        key = (id(self.es_tools.es), self.es_tools.get_index())
+        with _refresh_lock:
+            holds = _refresh_holds.pop(key, 0) - 1
+            if holds > 0:
+                _refresh_holds[key] = holds
+                return True
+            enabled = self.es_tools.put_settings({"refresh_interval": "1s"})
+        if enabled:
             return self.es_tools.forcemerge()
         return False
 
@@ -339,6 +415,12 @@ class AnalysisLoader(object):
         '''
         Counts the number of non-comment lines in an input file
         '''
+        if get_compression(input_file):
+            with LineReader(input_file) as file_handle:
+                for _ in file_handle:
+                    pass
+            return file_handle.input_lines
+
         num_lines = os.popen(
             'grep -v "^#" ' +
             input_file +
@@ -349,25 +431,79 @@ class AnalysisLoader(object):
 
         return 0
 
-    def validate_import(self, input_file=None, input_data=None, stats=None):
+    def validate_import(self, input_file=None, input_data=None, stats=None,
+                        refresh=True):
         '''
-        verifies that the expected number of records has been created
+        verifies that the expected number of records has been created,
+        the index is refreshed first unless the caller just did
         '''
 
         validated = False
         import_stats = {}
 
-        self.es_tools.refresh_index()
+        if refresh:
+            self.es_tools.refresh_index()
 
-        if not input_file:
+        if not input_file or self.__source_header__:
             grouping_clause = {'source_id': self.__load_id__}
-            num_input_lines = len(input_data)
+        if not input_file:
+            if stats and "input_records" in stats:
+                # Counted while streaming the records
+                num_input_lines = stats["input_records"]
+            else:
+                num_input_lines = len(input_data)
         else:
             import_stats['file_fullname'] = os.path.abspath(input_file)
-            grouping_clause = {'file_fullname': import_stats["file_fullname"]}
-            num_input_lines = self.count_input_lines(input_file)
+            if not self.__source_header__:
+                grouping_clause = {
+                    'file_fullname': import_stats["file_fullname"]}
+            if stats and "input_lines" in stats:
+                # Counted while parsing
+                num_input_lines = stats["input_lines"]
+            else:
+                num_input_lines = self.count_input_lines(input_file)
+
+        # All checks are counted by a single search, the imported records
+        # being its hits and each check a bucket of a filters aggregation
+        checks = {
+            # Imported records without a sample_id or normal_sample_id field
+            'missing_sample': {
+                'bool': {
+                    'must_not': [
+                        {'exists': {'field': 'sample_id'}},
+                        {'exists': {'field': 'normal_sample_id'}}
+                    ]
+                }
+            },
+            # Imported records with an empty sample_id or normal_sample_id
+            'empty_sample': {
+                'bool': {
+                    'should': [
+                        {'terms': {'sample_id': ['']}},
+                        {'terms': {'normal_sample_id': ['']}}
+                    ]
+                }
+            }
+        }
 
-        results = self.es_tools.search({'match': grouping_clause})
+        # Verify that all imported records have the following fields -
+        # chrom number, start, end, tumor_type, expt_type, project
+        fields = []
+        for field in ['chrom_number', 'start', 'end', 'caller',
+                      'tumor_type', 'expt_type', 'project']:
+            fields.append(field)
+            checks['field_' + field] = {'exists': {'field': field}}
+
+        results = self.es_tools.raw_search({
+            'query': {'match': grouping_clause},
+            'aggs': {'checks': {'filters': {'filters': checks}}},
+            'size': 0
+        })
+        if not results:
+            logging.error("The import into %s couldn't be validated.",
+                          self.es_tools.get_index())
+            return False
+        buckets = results['aggregations']['checks']['buckets']
 
         import_stats['index'] = self.es_tools.get_index()
         import_stats['doc_type'] = self.es_tools.get_doc_type()
@@ -378,6 +514,8 @@ class AnalysisLoader(object):
         if stats:
             import_stats['record_count'] -= stats["non_standard_chroms"]
         import_stats['imported_record_count'] = results['hits']['total']
+        if stats and stats.get("checksum"):
+            import_stats['checksum'] = stats["checksum"]
         import_stats['log'] = ''
 
         if self.validate_record_number(
@@ -389,102 +527,24 @@ class AnalysisLoader(object):
             import_stats['log'] = 'Some records from' +\
                 ' this input file have not been imported.'
 
-        # Verify that all imported records do have a sample_id or
-        # normal_sample_id field
-        filter_query = {
-            'filtered': {
-                'query': {
-                    'match': grouping_clause
-                },
-                'filter': {
-                    'bool': {
-                        'must_not': [
-                            {
-                                'exists': {
-                                    'field': 'sample_id'
-                                }
-                            },
-                            {
-                                'exists': {
-                                    'field': 'normal_sample_id'
-                                }
-                            }
-                        ]
-                    }
-                }
-            }
-        }
-
-        results = self.es_tools.search(filter_query)
-        if results['hits']['total'] != 0:
-            import_stats['log'] += ' ' + str(results['hits']['total']) + \
+        total_hits = buckets['missing_sample']['doc_count']
+        if total_hits != 0:
+            import_stats['log'] += ' ' + str(total_hits) + \
                 ' records do not have sample_id/normal_sample_id attribute.'
             validated = False
 
-        # Verify that there are no records with sample_id or normal_sample_id
-        # with value an empty string
-
-        filter_query = {
-            'filtered': {
-                'query': {
-                    'match': grouping_clause
-                },
-                'filter': {
-                    'bool': {
-                        'should': [
-                            {
-                                'terms': {
-                                    'sample_id': ['']
-                                }
-                            },
-                            {
-                                'terms': {
-                                    'normal_sample_id': ['']
-                                }
-                            }
-                        ]
-                    }
-                }
-            }
-        }
-
-        results = self.es_tools.search(filter_query)
-        if results['hits']['total'] != 0:
-            import_stats['log'] += ' ' + str(results['hits']['total']) + \
+        total_hits = buckets['empty_sample']['doc_count']
+        if total_hits != 0:
+            import_stats['log'] += ' ' + str(total_hits) + \
                 ' records have an empty string as a ' +\
                 'sample_id/normal_sample_id attribute value.'
             validated = False
 
-        # Verify that all imported records have the following fields -
-        # chrom number, start, end, tumor_type, expt_type, project
-
-        for field in ['chrom_number', 'start', 'end', 'caller',
-                      'tumor_type', 'expt_type', 'project']:
-            filter_query = {
-                'filtered': {
-                    'query': {
-                        'match': grouping_clause
-                    },
-                    'filter': {
-                        'bool': {
-                            'must': [
-                                {
-                                    'exists': {
-                                        'field': field
-                                    }
-                                }
-                            ]
-                        }
-                    }
-                }
-            }
-
-            results = self.es_tools.search(filter_query)
-
-            total_hits = results['hits']['total']
+        for field in fields:
+            total_hits = buckets['field_' + field]['doc_count']
             if total_hits != import_stats['imported_record_count']:
                 error_count = import_stats['imported_record_count'] - \
-                    results['hits']['total']
+                    total_hits
                 import_stats['log'] += ' ' + str(error_count) + \
                     ' records are missing field \'' + field + '\'.'
                 validated = False
@@ -573,20 +633,25 @@ class AnalysisLoader(object):
 
         return self.es_tools.create_index(mappings)
 
-    def get_reference_data(self, index, sample_data):
-        ''' searches the provided index for sample related data '''
+    def get_reference_query(self, sample_data):
+        ''' returns the search for sample related data '''
         query = []
         for field in sample_data.keys():
             query.append({'terms': {field: [sample_data[field]]}})
 
-        query = {'bool': {'must': query}}
+        return {'query': {'bool': {'must': query}}}
+
+    def get_reference_data(self, index, sample_data):
+        ''' searches the provided index for sample related data '''
         try:
-            res = self.es_tools.global_search(index, query)
+            res = self.es_tools.global_raw_search(
+                index, self.get_reference_query(sample_data))
         except NotFoundError:
             logging.error("Index %s doesn't exist.", index)
             return []
 
-        return res["hits"]["hits"]
+        # global_raw_search returns an empty response if the search failed
+        return res.get("hits", {}).get("hits", [])
 
     def get_yaml_record(self, results, input_file):
         '''
@@ -0,0 +1,3 @@
+'''
+Ingest benchmarks with synthetic single cell data, see run_benchmark
+'''
@@ -0,0 +1,479 @@
+'''
+End to end ingest benchmark
+
+Generates synthetic bins, segments and QC files at the requested scale,
+loads them with es_import_file.load_analysis_data, the sample being added
+to the reference index first, and times each phase:
+
+    sample_data           looking up the sample in the reference index
+    reference_data        looking up the header in the reference index
+    index                 reading, converting and bulk indexing the records
+    index_records         reading and converting the records
+    index_serialize       serializing the bulk requests
+    index_bulk_wait       waiting for the bulk requests
+    validate_import       verifying the indexed records
+    generate_events_data  denormalization
+
+The timings, the request metrics and the environment are written to a JSON
+report, to be compared across versions. The in-memory backend is used by
+default, which leaves out the cluster side of the work, a real cluster can
+be given with --host, existing indices being deleted and the sample being
+added to its reference index only with --overwrite.
+
+'''
+
+from __future__ import division
+import argparse
+import platform
+import datetime
+import tempfile
+import logging
+import shutil
+import json
+import time
+import sys
+import os
+
+SCRIPT_PATH = os.path.abspath(__file__)
+sys.path.insert(1, '/'.join(SCRIPT_PATH.split('/')[:-3]))
+
+from prettytable import PrettyTable
+from elasticsearchloader.analysis_loader import AnalysisLoader
+from elasticsearchloader.es_fake import FAKE_HOST
+from elasticsearchloader.es_fake import get_fake_client
+from elasticsearchloader.es_import_file import get_sample_data
+from elasticsearchloader.es_import_file import load_analysis_data
+from elasticsearchloader.es_metrics import get_metrics
+from elasticsearchloader.es_settings import REFERENCE_INDEX as reference_index
+from elasticsearchloader.benchmark.synthetic_data import CHROMOSOMES
+from elasticsearchloader.benchmark.synthetic_data import DATA_TYPES
+from elasticsearchloader.benchmark.synthetic_data import get_header
+from elasticsearchloader.benchmark.synthetic_data import write_data_files
+
+PHASES = [
+    "sample_data", "reference_data", "index", "index_records",
+    "index_serialize", "index_bulk_wait", "validate_import",
+    "generate_events_data"]
+
+# Document type of the samples in the reference index
+SAMPLE_DOCTYPE = "sample_ids"
+
+# Reference index record of the synthetic sample, the library IDs being
+# matched as empty
+SAMPLE_DATA = {
+    "normal_sample_id": "",
+    "library_id": "",
+    "normal_library_id": "",
+    "project": "benchmark",
+    "tumor_type": "benchmark",
+    "expt_type": "wgs"
+}
+
+
+def seed_sample_data(host, port, header, overwrite):
+    '''
+    Adds the sample of the synthetic data to the reference index, unless
+    it is there already, so that the records get their project data the
+    same way loaded files do. A real cluster's reference index is only
+    written to if overwrite is set
+    '''
+    project_data = get_sample_data(
+        index_name=reference_index,
+        doctype=SAMPLE_DOCTYPE,
+        host=host,
+        port=port,
+        header_data=header)
+    if project_data:
+        return
+
+    if host != FAKE_HOST and not overwrite:
+        logging.warn(
+            "Sample %s is missing from %s, the records will fail " +
+            "validation.", header["sample_id"], reference_index)
+        return
+
+    loader = AnalysisLoader(
+        es_index=reference_index,
+        es_doc_type=SAMPLE_DOCTYPE,
+        es_host=host,
+        es_port=port)
+    loader.create_index()
+    sample_data = dict(SAMPLE_DATA)
+    sample_data["sample_id"] = header["sample_id"]
+    loader.es_tools.submit_to_es(sample_data)
+    loader.es_tools.refresh_index()
+
+
+def load_file(data_type, file_name, index, host, port, skip_denormalize,
+              engine=None):
+    '''
+    Loads a single file with load_analysis_data, returns the timing of
+    each phase in seconds
+    '''
+    header = get_header(data_type)
+
+    timings = {}
+    t0 = time.time()
+    project_data = get_sample_data(
+        index_name=reference_index,
+        doctype=SAMPLE_DOCTYPE,
+        host=host,
+        port=port,
+        header_data=header)
+    # The empty IDs the sample is matched on aren't copied to the records
+    header.update(
+        (key, value) for (key, value) in project_data.items() if value != "")
+    timings["sample_data"] = time.time() - t0
+
+    result = load_analysis_data(
+        index_name=index,
+        doctype=data_type,
+        host=host,
+        port=port,
+        input_filename=file_name,
+        header_data=header,
+        skip_denormalize=skip_denormalize,
+        is_qc=(data_type == "qc"),
+        csv_engine=engine,
+        timings=timings)
+
+    loader = AnalysisLoader(
+        es_index=index,
+        es_doc_type=data_type,
+        es_host=host,
+        es_port=port)
+    records = loader.es_tools.count({"match_all": {}})["count"]
+
+    return {
+        "records": records,
+        "bytes": os.path.getsize(file_name),
+        "validated": result["validated"],
+        "timings": timings,
+        "records_per_second":
+            records / timings["index"] if timings["index"] else None
+    }
+
+
+def delete_indices(host, port, index, overwrite):
+    '''
+    Starts from empty indices on a real cluster, existing indices are
+    only deleted if overwrite is set
+    '''
+    for index_name in [index, index + "_denormalized"]:
+        loader = AnalysisLoader(
+            es_index=index_name, es_doc_type="benchmark", es_host=host,
+            es_port=port)
+        if not loader.es_tools.exists(index_name):
+            continue
+        if not overwrite:
+            logging.error(
+                "Index %s exists, use --overwrite to delete it.", index_name)
+            exit(1)
+        loader.es_tools.delete_index()
+
+
+def get_version():
+    ''' Returns the version of the loaders, if available '''
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution("elasticsearchloader").version
+    except Exception:
+        return None
+
+
+def get_revision():
+    ''' Returns the current git revision of the loaders, if available '''
+    try:
+        revision = os.popen(
+            'git -C "' + os.path.dirname(SCRIPT_PATH) +
+            '" rev-parse --short HEAD 2>/dev/null').read().strip()
+        return revision or None
+    except OSError:
+        return None
+
+
+def run_benchmark(
+        cells=100,
+        chromosomes=24,
+        bins=100,
+        seed=0,
+        data_dir=None,
+        index="benchmark",
+        host=FAKE_HOST,
+        port=9200,
+        latency=0.0,
+        latency_per_mb=0.0,
+        data_types=None,
+        skip_denormalize=False,
+        label=None,
+        engine=None,
+        overwrite=False):
+    '''
+    Generates the data files, loads them and returns the benchmark report
+    '''
+    if not data_types:
+        data_types = DATA_TYPES
+
+    if host == FAKE_HOST:
+        fake_client = get_fake_client()
+        fake_client.reset()
+        fake_client.latency = latency
+        fake_client.latency_per_mb = latency_per_mb
+    else:
+        delete_indices(host, port, index, overwrite)
+    seed_sample_data(host, port, get_header(data_types[0]), overwrite)
+    get_metrics().reset()
+
+    remove_data_dir = False
+    if not data_dir:
+        data_dir = tempfile.mkdtemp(prefix="es_benchmark_")
+        remove_data_dir = True
+    elif not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    report = {
+        "label": label,
+        "version": get_version(),
+        "revision": get_revision(),
+        "timestamp": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": "memory" if host == FAKE_HOST else
+                   "%s:%s" % (host, port),
+        "engine": engine or "python",
+        "scale": {
+            "cells": cells,
+            "chromosomes": chromosomes,
+            "bins": bins,
+            "seed": seed
+        },
+        "files": {}
+    }
+
+    try:
+        t0 = time.time()
+        files = write_data_files(data_dir, cells, chromosomes, bins, seed)
+        report["generate_time"] = time.time() - t0
+
+        t0 = time.time()
+        for data_type in data_types:
+            logging.info("Loading %s.", files[data_type]["file_name"])
+            report["files"][data_type] = load_file(
+                data_type,
+                files[data_type]["file_name"],
+                index,
+                host,
+                port,
+                skip_denormalize,
+                engine)
+        report["total_time"] = time.time() - t0
+    finally:
+        if remove_data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    snapshot = get_metrics().snapshot()
+    report["metrics"] = snapshot["operations"]
+    report["stages"] = snapshot["stages"]
+    if host == FAKE_HOST:
+        report["backend_requests"] = get_fake_client().get_stats()
+
+    return report
+
+
+def log_report(report):
+    ''' Logs the phase timings as a table '''
+    table = PrettyTable(["File", "Records"] + PHASES + ["Records/s"])
+    table.align = 'r'
+    for data_type in DATA_TYPES:
+        if data_type not in report["files"]:
+            continue
+        results = report["files"][data_type]
+        table.add_row(
+            [data_type, results["records"]] +
+            ["%.3f" % results["timings"][phase]
+             if phase in results["timings"] else "-" for phase in PHASES] +
+            ["%.0f" % (results["records_per_second"] or 0)])
+    logging.info("Benchmark results (seconds):\n%s", table)
+
+
+def main():
+    ''' main function '''
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '-c',
+        '--cells',
+        dest='cells',
+        action='store',
+        help='Number of cells, default is 100',
+        type=int,
+        default=100)
+    argparser.add_argument(
+        '-n',
+        '--chromosomes',
+        dest='chromosomes',
+        action='store',
+        help='Number of chromosomes, at most 24, default is 24',
+        type=int,
+        default=24)
+    argparser.add_argument(
+        '-b',
+        '--bins',
+        dest='bins',
+        action='store',
+        help='Number of bins per chromosome, default is 100',
+        type=int,
+        default=100)
+    argparser.add_argument(
+        '-s',
+        '--seed',
+        dest='seed',
+        action='store',
+        help='Random seed, default is 0',
+        type=int,
+        default=0)
+    argparser.add_argument(
+        '-t',
+        '--data-types',
+        dest='data_types',
+        action='store',
+        help='Comma separated data types to load, default is ' +
+        ','.join(DATA_TYPES),
+        type=str,
+        default=','.join(DATA_TYPES))
+    argparser.add_argument(
+        '-d',
+        '--data-dir',
+        dest='data_dir',
+        action='store',
+        help='Directory to keep the generated files in, a temporary ' +
+        'directory is used and removed by default',
+        type=str)
+    argparser.add_argument(
+        '-o',
+        '--report',
+        dest='report',
+        action='store',
+        help='Report file, default is benchmark_report.json',
+        type=str,
+        default='benchmark_report.json')
+    argparser.add_argument(
+        '-l',
+        '--label',
+        dest='label',
+        action='store',
+        help='Label identifying the run in the report',
+        type=str)
+    argparser.add_argument(
+        '-x',
+        '--index',
+        dest='index_name',
+        action='store',
+        help='Index to load the data into, default is benchmark',
+        type=str,
+        default='benchmark')
+    argparser.add_argument(
+        '-H',
+        '--host',
+        dest='host',
+        action='store',
+        help='Elastic search host, default is the in-memory backend (' +
+        FAKE_HOST + ')',
+        type=str,
+        default=FAKE_HOST)
+    argparser.add_argument(
+        '-p',
+        '--port',
+        dest='port',
+        action='store',
+        help='Elastic search port, default is 9200',
+        type=int,
+        default=9200)
+    argparser.add_argument(
+        '--latency',
+        dest='latency',
+        action='store',
+        help='Simulated latency of each in-memory backend request, ' +
+        'in seconds',
+        type=float,
+        default=0.0)
+    argparser.add_argument(
+        '--latency-per-mb',
+        dest='latency_per_mb',
+        action='store',
+        help='Simulated latency per megabyte of in-memory backend ' +
+        'request body, in seconds',
+        type=float,
+        default=0.0)
+    argparser.add_argument(
+        '-e',
+        '--engine',
+        dest='engine',
+        action='store',
+        help='CSV engine, python or pandas, default is python',
+        choices=['python', 'pandas'],
+        type=str,
+        default='python')
+    argparser.add_argument(
+        '--skip-denormalize',
+        dest='skip_denormalize',
+        action='store_true',
+        help='If set, denormalization is not benchmarked',
+        default=False)
+    argparser.add_argument(
+        '--overwrite',
+        dest='overwrite',
+        action='store_true',
+        help='If set, existing benchmark indices of a real cluster are ' +
+        'deleted, and the synthetic sample is added to its reference index',
+        default=False)
+    argparser.add_argument(
+        '-v',
+        '--verbosity',
+        dest='verbosity',
+        action='store',
+        help='Default level of verbosity is INFO.',
+        choices=['info', 'debug', 'warn', 'error'],
+        type=str,
+        default="info")
+
+    args = argparser.parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(getattr(logging, args.verbosity.upper()))
+    es_logger = logging.getLogger('elasticsearch')
+    es_logger.setLevel(logging.WARN)
+    request_logger = logging.getLogger("urllib3")
+    request_logger.setLevel(logging.WARN)
+
+    logging.basicConfig(
+        format='%(levelname)s: %(message)s',
+        stream=sys.stdout
+    )
+
+    report = run_benchmark(
+        cells=args.cells,
+        chromosomes=min(args.chromosomes, len(CHROMOSOMES)),
+        bins=args.bins,
+        seed=args.seed,
+        data_dir=args.data_dir,
+        index=args.index_name.lower(),
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        latency_per_mb=args.latency_per_mb,
+        data_types=[data_type.strip() for data_type in
+                    args.data_types.split(",") if data_type.strip()],
+        skip_denormalize=args.skip_denormalize,
+        label=args.label,
+        engine=args.engine,
+        overwrite=args.overwrite)
+
+    with open(args.report, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+    log_report(report)
+    logging.info("Report written to %s.", args.report)
+
+
+if __name__ == '__main__':
+    main()
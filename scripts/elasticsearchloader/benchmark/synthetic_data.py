@@ -0,0 +1,260 @@
+'''
+Generates synthetic single cell copy number data files
+
+The bins, segments and QC files follow the layouts described by
+sample_data/yaml_files/bins.yaml, segments.yaml and qc.yaml, the headers
+below being the __HEADER__ sections of those files. The data is random but
+reproducible for a given seed, the size of the files is determined by the
+number of cells, chromosomes and bins per chromosome.
+
+'''
+
+from __future__ import division
+import argparse
+import logging
+import random
+import copy
+import sys
+import os
+
+# Width of a bin in base pairs
+BIN_SIZE = 500000
+
+CHROMOSOMES = [str(idx) for idx in range(1, 23)] + ["X", "Y"]
+
+# Plate layout of the QC data, denormalization processes one plate column
+# at a time
+PLATE_ROWS = 72
+PLATE_COLUMNS = 72
+
+HEADERS = {
+    "bins": {
+        "caller": "single_cell_hmmcopy_bin",
+        "sample_id": "SA501X3F",
+        "file_format": "csv",
+        "field_mapping": {
+            "chrom_number": "chr"
+        },
+        "field_types": {
+            "cell_id": "str",
+            "chr": "str",
+            "start": "int",
+            "end": "int",
+            "integer_copy_scale": "float",
+            "state": "float"
+        }
+    },
+    "segments": {
+        "caller": "single_cell_hmmcopy_seg",
+        "sample_id": "SA501X3F",
+        "file_format": "csv",
+        "field_mapping": {
+            "chrom_number": "chr"
+        },
+        "field_types": {
+            "cell_id": "str",
+            "chr": "str",
+            "start": "int",
+            "end": "int",
+            "state": "float",
+            "integer_median": "float"
+        }
+    },
+    "qc": {
+        "caller": "single_cell_qc",
+        "sample_id": "SA501X3F",
+        "file_format": "csv",
+        "field_types": {
+            "cell_id": "str",
+            "cell_call": "str",
+            "all_heatmap_order": "int",
+            "experimental_condition": "str",
+            "mad_neutral_state": "float",
+            "MSRSI_non_integerness": "float",
+            "sample_plate": "str",
+            "total_mapped_reads": "int"
+        }
+    }
+}
+
+COLUMNS = {
+    "bins": [
+        "cell_id", "chr", "start", "end", "integer_copy_scale", "state"],
+    "segments": [
+        "cell_id", "chr", "start", "end", "state", "integer_median"],
+    "qc": [
+        "cell_id", "cell_call", "all_heatmap_order", "experimental_condition",
+        "mad_neutral_state", "MSRSI_non_integerness", "sample_plate",
+        "total_mapped_reads"]
+}
+
+DATA_TYPES = ["bins", "segments", "qc"]
+
+
+def get_header(data_type):
+    ''' Returns the header data of the given data type '''
+    return copy.deepcopy(HEADERS[data_type])
+
+
+def get_cell_ids(cells):
+    ''' Returns the cell IDs and the plate positions of the cells '''
+    return [
+        ("SA501X3F-R%02d-C%02d" % (row, column), row, column)
+        for (row, column) in [
+            (idx // PLATE_COLUMNS + 1, idx % PLATE_COLUMNS + 1)
+            for idx in range(cells)]]
+
+
+def write_bins(file_name, cells, chromosomes, bins, seed=0):
+    ''' Writes a bins file, returns the number of data rows '''
+    rand = random.Random(seed)
+    rows = 0
+    with open(file_name, "w") as output:
+        output.write(",".join(COLUMNS["bins"]) + "\n")
+        for (cell_id, _, _) in get_cell_ids(cells):
+            lines = []
+            for chrom in CHROMOSOMES[:chromosomes]:
+                state = rand.randint(0, 6)
+                for idx in range(bins):
+                    # copy number states change only occasionally
+                    if rand.random() < 0.05:
+                        state = rand.randint(0, 6)
+                    lines.append("%s,%s,%d,%d,%.4f,%d\n" % (
+                        cell_id, chrom, idx * BIN_SIZE + 1,
+                        (idx + 1) * BIN_SIZE,
+                        state + rand.uniform(-0.5, 0.5), state))
+            output.writelines(lines)
+            rows += len(lines)
+    return rows
+
+
+def write_segments(file_name, cells, chromosomes, bins, seed=0):
+    '''
+    Writes a segments file, each chromosome of each cell being split into
+    segments of one to twenty bins, returns the number of data rows
+    '''
+    rand = random.Random(seed + 1)
+    rows = 0
+    with open(file_name, "w") as output:
+        output.write(",".join(COLUMNS["segments"]) + "\n")
+        for (cell_id, _, _) in get_cell_ids(cells):
+            lines = []
+            for chrom in CHROMOSOMES[:chromosomes]:
+                idx = 0
+                while idx < bins:
+                    length = min(rand.randint(1, 20), bins - idx)
+                    state = rand.randint(0, 6)
+                    lines.append("%s,%s,%d,%d,%d,%.4f\n" % (
+                        cell_id, chrom, idx * BIN_SIZE + 1,
+                        (idx + length) * BIN_SIZE,
+                        state, state + rand.uniform(-0.2, 0.2)))
+                    idx += length
+            output.writelines(lines)
+            rows += len(lines)
+    return rows
+
+
+def write_qc(file_name, cells, seed=0):
+    ''' Writes a QC file, one row per cell, returns the number of data rows '''
+    rand = random.Random(seed + 2)
+    with open(file_name, "w") as output:
+        output.write(",".join(COLUMNS["qc"]) + "\n")
+        for (idx, (cell_id, row, column)) in enumerate(get_cell_ids(cells)):
+            output.write("%s,%s,%d,%s,%.4f,%.4f,R%02d_C%02d,%d\n" % (
+                cell_id,
+                rand.choice(["C1", "C2", "C3"]),
+                idx,
+                rand.choice(["A", "B", "C", "NTC"]),
+                rand.random(),
+                rand.random(),
+                row, column,
+                rand.randint(100000, 5000000)))
+    return cells
+
+
+def write_data_files(data_dir, cells, chromosomes, bins, seed=0):
+    '''
+    Writes the bins, segments and QC files into the given directory, returns
+    the file names and number of data rows by data type
+    '''
+    files = {}
+    for data_type in DATA_TYPES:
+        file_name = os.path.join(data_dir, data_type + ".csv")
+        if data_type == "bins":
+            rows = write_bins(file_name, cells, chromosomes, bins, seed)
+        elif data_type == "segments":
+            rows = write_segments(file_name, cells, chromosomes, bins, seed)
+        else:
+            rows = write_qc(file_name, cells, seed)
+        files[data_type] = {"file_name": file_name, "rows": rows}
+        logging.info(
+            "Generated %s with %d rows (%d bytes).",
+            file_name, rows, os.path.getsize(file_name))
+    return files
+
+
+def main():
+    ''' main function '''
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '-o',
+        '--output-dir',
+        dest='output_dir',
+        action='store',
+        help='Directory to write the data files to',
+        type=str,
+        required=True)
+    argparser.add_argument(
+        '-c',
+        '--cells',
+        dest='cells',
+        action='store',
+        help='Number of cells, default is 100',
+        type=int,
+        default=100)
+    argparser.add_argument(
+        '-n',
+        '--chromosomes',
+        dest='chromosomes',
+        action='store',
+        help='Number of chromosomes, at most 24, default is 24',
+        type=int,
+        default=24)
+    argparser.add_argument(
+        '-b',
+        '--bins',
+        dest='bins',
+        action='store',
+        help='Number of bins per chromosome, default is 100',
+        type=int,
+        default=100)
+    argparser.add_argument(
+        '-s',
+        '--seed',
+        dest='seed',
+        action='store',
+        help='Random seed, default is 0',
+        type=int,
+        default=0)
+
+    args = argparser.parse_args()
+
+    logging.basicConfig(
+        format='%(levelname)s: %(message)s',
+        stream=sys.stdout,
+        level=logging.INFO
+    )
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    write_data_files(
+        args.output_dir,
+        args.cells,
+        min(args.chromosomes, len(CHROMOSOMES)),
+        args.bins,
+        args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+'''
+Bulk request body builder
+
+Actions (an index command and a record) are serialized to NDJSON as they
+are appended to the buffer, instead of the whole request being serialized
+by the Elastic search client at submission time. Uses simplejson for
+encoding when available, the standard json module otherwise. Actions are
+held as UTF-8 encoded strings, so that the buffer size is counted in bytes.
+
+'''
+
+import json
+from datetime import datetime
+from datetime import date
+from decimal import Decimal
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+def _json_default(obj):
+    '''
+    Serializes the values the json module can't handle the same way the
+    Elastic search client does
+    '''
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError("Unable to serialize %r (type: %s)" % (obj, type(obj)))
+
+
+if simplejson is not None:
+    _encoder = simplejson.JSONEncoder(
+        separators=(',', ':'), default=_json_default)
+else:
+    _encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default)
+
+
+def dumps(obj):
+    '''
+    Serializes an object into a single line of JSON, returned as a UTF-8
+    encoded string
+    '''
+    line = _encoder.encode(obj)
+    if isinstance(line, unicode):
+        return line.encode('utf-8')
+    return line
+
+
+class BulkBuffer(object):
+
+    '''
+    Holds the serialized actions of a bulk request
+    '''
+
+    def __init__(self, records=None):
+        self.__actions__ = []
+        self.__size__ = 0
+        # Whether each action names the document it writes
+        self.__has_id__ = []
+        # The same index command is usually shared by all records
+        self.__command__ = None
+        self.__command_line__ = None
+        if records:
+            self.extend(records)
+
+    def __len__(self):
+        ''' Returns the number of actions in the buffer '''
+        return len(self.__actions__)
+
+    def append(self, command, record):
+        ''' Serializes and adds an action to the buffer '''
+        if command is not self.__command__:
+            self.__command__ = command
+            self.__command_line__ = dumps(command) + '\n'
+        action = self.__command_line__ + dumps(record) + '\n'
+        self.__actions__.append(action)
+        self.__has_id__.append(all(
+            metadata.get("_id") is not None
+            for metadata in command.values()))
+        self.__size__ += len(action)
+
+    def extend(self, records):
+        '''
+        Adds the actions from a list of alternating commands and records
+        '''
+        for idx in range(0, len(records), 2):
+            self.append(records[idx], records[idx + 1])
+
+    def get_size(self):
+        ''' Returns the size of the request body in bytes '''
+        return self.__size__
+
+    def get_body(self):
+        ''' Returns the bulk request body '''
+        return ''.join(self.__actions__)
+
+    def get_actions(self):
+        ''' Returns the serialized actions '''
+        return self.__actions__
+
+    def has_ids(self):
+        '''
+        Checks whether all actions carry document IDs, in which case sending
+        them again can't create duplicate documents
+        '''
+        return all(self.__has_id__)
+
+    def subset(self, positions):
+        '''
+        Returns a new buffer holding the actions at the given positions
+        '''
+        subset = BulkBuffer()
+        for position in positions:
+            subset.__actions__.append(self.__actions__[position])
+            subset.__has_id__.append(self.__has_id__[position])
+            subset.__size__ += len(self.__actions__[position])
+        return subset
@@ -0,0 +1,147 @@
+'''
+Feedback controller for the size of bulk indexing requests
+
+The number of records and bytes per bulk request are adjusted after each
+request, based on its latency and on the number of records the cluster
+rejected, aiming for a target latency per request. The limits are kept in
+shared memory, so that a single controller can be used by all loaders of
+a process as well as by the worker processes forked from it.
+
+'''
+
+from __future__ import division
+import logging
+import multiprocessing
+
+# Initial bulk request limits, in records and in bytes
+CHUNK_SIZE = 2000
+MAX_CHUNK_BYTES = 4*1024000
+
+# Bounds within which the limits are tuned
+MIN_CHUNK_SIZE = 100
+MAX_CHUNK_SIZE = 20000
+MIN_CHUNK_BYTES = 256*1024
+MAX_CHUNK_BYTES_LIMIT = 64*1024000
+
+# Bulk request latency to aim for, in seconds
+TARGET_LATENCY = 2.0
+
+# Fraction of the distance to the ideal size covered by each adjustment,
+# and the smallest relative change worth logging
+SMOOTHING = 0.5
+LOG_THRESHOLD = 0.1
+
+
+class BulkSizeController(object):
+
+    '''
+    Tunes the record count and byte size limits of bulk requests
+    '''
+
+    def __init__(
+            self,
+            chunk_size=CHUNK_SIZE,
+            max_chunk_bytes=MAX_CHUNK_BYTES,
+            target_latency=TARGET_LATENCY):
+        self.__target_latency__ = target_latency
+        self.__lock__ = multiprocessing.RLock()
+        self.__chunk_size__ = multiprocessing.Value(
+            'i', chunk_size, lock=self.__lock__)
+        self.__max_chunk_bytes__ = multiprocessing.Value(
+            'i', max_chunk_bytes, lock=self.__lock__)
+
+    def get_chunk_size(self):
+        ''' Returns the current maximum number of records per request '''
+        return self.__chunk_size__.value
+
+    def get_max_chunk_bytes(self):
+        ''' Returns the current maximum request size in bytes '''
+        return self.__max_chunk_bytes__.value
+
+    def record(self, docs, nbytes, took, wall_time, rejected=0):
+        '''
+        Adjusts the limits given the outcome of a bulk request, i.e. the
+        number of records and bytes sent (0 if unknown), the server side
+        processing time in milliseconds, the request wall time in seconds
+        and the number of records rejected by the cluster
+        '''
+        if not docs:
+            return
+
+        with self.__lock__:
+            chunk_size = self.__chunk_size__.value
+            max_chunk_bytes = self.__max_chunk_bytes__.value
+
+            if rejected:
+                # The cluster can't keep up, back off quickly
+                new_chunk_size = chunk_size // 2
+                new_max_chunk_bytes = max_chunk_bytes // 2
+            else:
+                # Requests much smaller than the current limits, typically
+                # the last one of a file, are not representative
+                if docs < chunk_size / 10 and \
+                        (not nbytes or nbytes < max_chunk_bytes / 10):
+                    return
+                ratio = self.__target_latency__ / max(wall_time, 0.001)
+                ratio = min(max(ratio, 0.5), 2.0)
+                new_chunk_size = _adjust(chunk_size, docs, ratio)
+                new_max_chunk_bytes = max_chunk_bytes
+                if nbytes:
+                    new_max_chunk_bytes = _adjust(
+                        max_chunk_bytes, nbytes, ratio)
+
+            new_chunk_size = min(
+                max(new_chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+            new_max_chunk_bytes = min(
+                max(new_max_chunk_bytes, MIN_CHUNK_BYTES),
+                MAX_CHUNK_BYTES_LIMIT)
+
+            self.__chunk_size__.value = new_chunk_size
+            self.__max_chunk_bytes__.value = new_max_chunk_bytes
+
+        if abs(new_chunk_size - chunk_size) > LOG_THRESHOLD * chunk_size or \
+                abs(new_max_chunk_bytes - max_chunk_bytes) > \
+                LOG_THRESHOLD * max_chunk_bytes:
+            logging.info(
+                "Bulk request limits changed from %d records/%d bytes to " +
+                "%d records/%d bytes (%d records, %d bytes, took %s ms, " +
+                "latency %.2f s, %d rejected).",
+                chunk_size, max_chunk_bytes,
+                new_chunk_size, new_max_chunk_bytes,
+                docs, nbytes, took, wall_time, rejected)
+
+
+def _adjust(limit, sent, ratio):
+    '''
+    Moves a limit towards the amount which would have been sent within the
+    target latency, a request faster than the target never lowers the limit
+    and a slower one never raises it
+    '''
+    ideal = sent * ratio
+    if ratio >= 1:
+        ideal = max(ideal, limit)
+    else:
+        ideal = min(ideal, limit)
+    return int(limit + SMOOTHING * (ideal - limit))
+
+
+_bulk_controller = None
+
+
+def get_bulk_controller():
+    '''
+    Returns the bulk size controller shared by all loaders of the process
+    '''
+    global _bulk_controller
+    if _bulk_controller is None:
+        _bulk_controller = BulkSizeController()
+    return _bulk_controller
+
+
+def set_bulk_controller(controller):
+    '''
+    Sets the shared bulk size controller, intended to be used as a process
+    pool initializer so that worker processes share the parent's controller
+    '''
+    global _bulk_controller
+    _bulk_controller = controller
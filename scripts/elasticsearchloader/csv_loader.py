@@ -6,6 +6,7 @@ Created on October 28, 2015
 @author: dmachev
 '''
 
+import itertools
 import csv
 import ast
 import re
@@ -13,19 +14,64 @@ import copy
 import logging
 import os
 import math
+import traceback
 import __builtin__
+from multiprocessing.pool import ThreadPool
 from elasticsearchloader.analysis_loader import AnalysisLoader
+from elasticsearchloader.denormalize_index import get_process_pool
+from elasticsearchloader.es_metrics import export_metrics
+from elasticsearchloader.es_metrics import get_metrics
+from elasticsearchloader.file_utils import LineReader
+from elasticsearchloader.file_utils import get_compression
+from elasticsearchloader.file_utils import get_file_checksum
 from sets import Set
 
+try:
+    import numpy
+    import pandas
+except ImportError:
+    pandas = None
+
+# Engines reading the input files, the pandas engine reads and converts
+# whole chunks of rows at once
+PYTHON_ENGINE = "python"
+PANDAS_ENGINE = "pandas"
+
+# Number of rows read at once by the pandas engine
+CHUNK_ROWS = 100000
+
+# Number of parsed records looked at to configure the fields
+PEEK_RECORDS = 100
+
+# Values treated as missing in non-string columns
+NA_VALUES = ['na', 'nan', 'inf', '?']
+
+# Integers parsed as doubles by the pandas engine are exact below this value
+MAX_EXACT_INT = 2 ** 53
+
+# Sources of the index record fields in a conversion plan
+COLUMN_SOURCE = "column"
+HEADER_SOURCE = "header"
+
+# Conversion plans by field configuration and file header, so that files
+# of the same type are planned once per process
+PLAN_CACHE_SIZE = 64
+_conversion_plans = {}
+
+# Minimum size of the byte ranges parsed by parallel workers, smaller files
+# are split into fewer ranges
+MIN_RANGE_BYTES = 16 * 1024 * 1024
+
+# Attributes of a sniffed CSV dialect, passed on to the parallel workers
+DIALECT_ATTRIBUTES = [
+    'delimiter', 'doublequote', 'escapechar', 'lineterminator',
+    'quotechar', 'quoting', 'skipinitialspace']
+
+
 class CsvLoader(AnalysisLoader):
 
     ''' Class CsvLoader '''
 
-    __csv_dialect__ = None
-    __index_buffer__ = []
-    __field_mapping__ = {}
-    __field_types__ = {}
-    __field_ignore__ = {}
     __field_match__ = {
         r'chr': 'chrom_number',
         r'start': 'start',
@@ -39,8 +85,6 @@ class CsvLoader(AnalysisLoader):
 
     __reserved_fields__ = ["events", "paired_record", "source_id"]
 
-    __parsed_input__ = False
-
     def __init__(
             self,
             es_doc_type=None,
@@ -50,6 +94,21 @@ class CsvLoader(AnalysisLoader):
             use_ssl=False,
             http_auth=None,
             timeout=None):
+        # The field configuration is specific to each instance, so that
+        # several files can be loaded at the same time
+        self.__csv_dialect__ = None
+        self.__field_mapping__ = {}
+        self.__field_types__ = {}
+        self.__field_ignore__ = {}
+        self.__parsed_input__ = False
+        # Kept for the parallel workers, which create their own loaders
+        self.__es_settings__ = {
+            "es_host": es_host,
+            "es_port": es_port,
+            "use_ssl": use_ssl,
+            "http_auth": http_auth,
+            "timeout": timeout
+        }
         super(CsvLoader, self).__init__(
             es_doc_type=es_doc_type,
             es_index=es_index,
@@ -63,9 +122,18 @@ class CsvLoader(AnalysisLoader):
             self,
             analysis_file=None,
             custom_header=None,
-            analysis_data=None):
+            analysis_data=None,
+            engine=None,
+            workers=None,
+            checksum=None):
         '''
-        Parses and indexes the content of the vcf file
+        Parses and indexes the content of the vcf file, engine selects how
+        CSV files are read, either row by row (python, the default) or in
+        chunks of typed columns (pandas). With several workers, files are
+        split into byte ranges parsed and indexed in parallel, row by row.
+        Files are read in a single pass, the number of input lines and the
+        checksum of the file, computed using the given algorithm if any,
+        are returned in the parse stats
         '''
 
         if "field_types" in custom_header.keys():
@@ -82,12 +150,18 @@ class CsvLoader(AnalysisLoader):
 
         self.disable_index_refresh()
 
-        if isinstance(analysis_data, list) and len(analysis_data):
-            self._index_data(header_data, analysis_data)
-        else:
-            self._index_file(header_data, analysis_file)
+        stats = None
+        try:
+            if analysis_data is not None and (
+                    not isinstance(analysis_data, list) or analysis_data):
+                stats = self._index_data(header_data, analysis_data)
+            else:
+                stats = self._index_file(
+                    header_data, analysis_file, engine, workers, checksum)
+        finally:
+            self.enable_index_refresh()
 
-        self.enable_index_refresh()
+        return stats
 
     def _rm_fields(self,header):
         '''
@@ -99,77 +173,421 @@ class CsvLoader(AnalysisLoader):
                 del self.__field_types__[f]
                 print "removed field: ",f
 
-    def _index_file(self, header_data, analysis_file):
+    def _index_file(self, header_data, analysis_file, engine=None,
+                    workers=None, checksum=None):
         '''
-        Parses and indexes the content of a CSV/TSV file
+        Parses and indexes the content of a CSV/TSV file, returns the parse
+        stats
         '''
-        self._get_csv_dialect(analysis_file)
+        if engine == PANDAS_ENGINE and pandas is None:
+            logging.warn(
+                "pandas is not available, reading %s row by row.",
+                analysis_file)
+            engine = PYTHON_ENGINE
+
+        try:
+            csv_lines = LineReader(analysis_file, checksum)
+        except IOError:
+            logging.error('Unable to parse CSV file.')
+            exit(1)
+
+        with csv_lines:
+            header_data['file_fullname'] = os.path.abspath(csv_lines.name)
 
-        with open(analysis_file) as csv_fh:
-            header_data['file_fullname'] = os.path.abspath(csv_fh.name)
+            self._get_csv_dialect(csv_lines)
+            csv_lines.rewind(keep=True)
 
-            csv_reader = csv.DictReader(csv_fh, dialect=self.__csv_dialect__)
+            csv_reader = csv.DictReader(
+                csv_lines, dialect=self.__csv_dialect__)
 
             print "header_data: ", header_data #debug
             print "fields: ", csv_reader.fieldnames #debug
             self._rm_fields(Set(csv_reader.fieldnames))
             
             self._configure_field_mapping(csv_reader.fieldnames, header_data)
-            csv_fh.seek(0)
-            csv_reader.next()
 
             fld_xd = Set(self.__field_ignore__)
             self._verify_field_types()
             self._set_field_types(csv_reader.next(),fld_xd)
             self._check_for_reserved_fields()
+            header_data = self.store_header(header_data)
+
+            # The header and first record are replayed, the rest of the
+            # file is read once
+            csv_lines.rewind()
+
+            if workers and workers > 1 and (
+                    not isinstance(analysis_file, basestring) or
+                    not os.path.isfile(analysis_file) or
+                    get_compression(analysis_file)):
+                logging.warn(
+                    "%s can't be split into byte ranges, reading it in a "
+                    "single pass.", csv_lines.name)
+            elif workers and workers > 1:
+                return self._index_file_ranges(
+                    analysis_file, csv_reader.fieldnames, header_data,
+                    fld_xd, workers, checksum)
+
+            if engine == PANDAS_ENGINE:
+                records = self._chunk_records(
+                    csv_lines, header_data, fld_xd)
+            else:
+                csv_rows = csv.reader(
+                    csv_lines, dialect=self.__csv_dialect__)
+                csv_rows.next()
+                records = self._csv_records(
+                    csv_rows, csv_reader.fieldnames, header_data, fld_xd)
+            self._index_records(records)
+
+        return dict(csv_lines.get_stats(), non_standard_chroms=0)
+
+    def _index_file_ranges(
+            self, analysis_file, fieldnames, header_data, fld_xd, workers,
+            checksum=None):
+        '''
+        Splits a CSV/TSV file into newline aligned byte ranges, parsed and
+        indexed by parallel workers, returns the number of input lines and
+        the checksum of the file, if requested
+        '''
+        # Planned before the workers are started, so that forked workers
+        # inherit the plan
+        self._get_conversion_plan(fieldnames, header_data, fld_xd)
+
+        byte_ranges = get_byte_ranges(analysis_file, workers)
+        logging.info(
+            "Parsing %s in %d byte ranges.", analysis_file, len(byte_ranges))
+
+        params = {
+            "index": self.es_tools.get_index(),
+            "doc_type": self.es_tools.get_doc_type(),
+            "es_settings": self.__es_settings__,
+            "analysis_file": analysis_file,
+            "dialect": dict(
+                (attribute, getattr(self.__csv_dialect__, attribute))
+                for attribute in DIALECT_ATTRIBUTES),
+            "fieldnames": fieldnames,
+            "header_data": header_data,
+            "fld_xd": fld_xd,
+            "field_types": self.__field_types__,
+            "field_mapping": self.__field_mapping__
+        }
+        process_params = []
+        for (start, end) in byte_ranges:
+            process_params.append(copy.copy(params))
+            process_params[-1]["start"] = start
+            process_params[-1]["end"] = end
+
+        # The file is hashed while the workers parse it, the plain file
+        # content being the lines a single pass would hash
+        checksum_pool = None
+        if checksum:
+            checksum_pool = ThreadPool(1)
+            file_checksum = checksum_pool.apply_async(
+                get_file_checksum, (analysis_file, checksum))
+
+        process_pool = get_process_pool(
+            min(workers, len(byte_ranges)),
+            self.__es_settings__["es_host"])
+        try:
+            results = process_pool.map(pool_parse_range, process_params)
+        finally:
+            process_pool.close()
+            process_pool.terminate()
+            if checksum_pool:
+                checksum_pool.close()
+
+        # The workers' loading stages are accounted to this process
+        for result in results:
+            for (stage, duration) in result["stages"].items():
+                get_metrics().observe_stage(stage, duration)
+
+        # The header line is counted along with the data lines, same as
+        # count_input_lines does
+        stats = {
+            "input_lines": 1 + sum(
+                result["input_lines"] for result in results),
+            "records": sum(result["records"] for result in results),
+            "non_standard_chroms": 0
+        }
+        if checksum_pool:
+            stats["checksum"] = file_checksum.get()
+            checksum_pool.join()
+        return stats
 
-            csv_fh.seek(0)
-            csv_reader.next()
-
-            #n = 0
-            for csv_record in csv_reader:
-                index_record = {
-                    key: self._apply_type(csv_record, key)
-                    for key in Set(csv_record.keys()).difference(fld_xd)
-                }
-                #print "record111: ", index_record #debug
-                index_record.update(header_data)
-                #print "record222: ", index_record #debug
-                index_record = self._update_record_keys(index_record)
-                index_record = self._remove_redundant_fields(index_record)
-                try:
-                    [row, column] = index_record["sample_plate"].replace("_", "-").split("-")
-                    index_record["row"] = row[1:].lstrip("0")
-                    index_record["column"] = column[1:].lstrip("0")
-                except KeyError:
-                    pass
-                try:
-                    index_record['chrom_number'] = _format_chrom_number(
-                        str(index_record['chrom_number'])
-                    )
-                except KeyError:
-                    pass
-
-                self._buffer_record(index_record, False)
-                #if (n>11): break
-                #n+=1
-        
-        # Submit any records remaining in the buffer for indexing
-        self._buffer_record(None, True)
+    def _index_range(self, params):
+        '''
+        Parses and indexes the lines of a byte range of a CSV/TSV file,
+        returns the number of input lines and records, along with the time
+        spent in each loading stage
+        '''
+        self.__field_types__ = params["field_types"]
+        self.__field_mapping__ = params["field_mapping"]
+        stage_times = get_metrics().get_stage_times()
+
+        counts = {"input_lines": 0, "records": 0}
+
+        def count_records(records):
+            ''' counts the records as they are produced '''
+            for record in records:
+                counts["records"] += 1
+                yield record
+
+        with open(params["analysis_file"]) as csv_fh:
+            lines = _read_range(
+                csv_fh, params["start"], params["end"], counts)
+            csv_rows = csv.reader(lines, **params["dialect"])
+            self._index_records(count_records(self._csv_records(
+                csv_rows, params["fieldnames"], params["header_data"],
+                params["fld_xd"])))
+
+        counts["stages"] = dict(
+            (stage, duration - stage_times.get(stage, 0.0))
+            for (stage, duration) in get_metrics().get_stage_times().items())
+        return counts
+
+    def _csv_records(self, csv_rows, fieldnames, header_data, fld_xd):
+        '''
+        Converts the rows read from a CSV/TSV file into index records,
+        following the conversion plan of the file header
+        '''
+        plan = self._get_conversion_plan(fieldnames, header_data, fld_xd)
+        record_template = plan.get_constants(header_data)
+        columns = plan.columns
+        sample_plate = plan.sample_plate and \
+            "sample_plate" not in record_template
+        row_length = len(fieldnames)
+
+        for csv_row in csv_rows:
+            if not csv_row:
+                # Blank lines are skipped, same as csv.DictReader does
+                continue
+            if len(csv_row) != row_length:
+                # Rows with missing or extra values are converted the
+                # same way as before plans were introduced
+                yield self._convert_record(
+                    _get_row_record(fieldnames, csv_row), header_data, fld_xd)
+                continue
+
+            index_record = dict(record_template)
+            for (idx, key, converter) in columns:
+                index_record[key] = converter(csv_row[idx])
+            if sample_plate:
+                [row, column] = index_record["sample_plate"].replace("_", "-").split("-")
+                index_record["row"] = row[1:].lstrip("0")
+                index_record["column"] = column[1:].lstrip("0")
+
+            yield index_record
+
+    def _convert_record(self, csv_record, header_data, fld_xd):
+        '''
+        Converts a single row read with csv.DictReader into an index record
+        '''
+        index_record = {
+            key: self._apply_type(csv_record, key)
+            for key in Set(csv_record.keys()).difference(fld_xd)
+        }
+        index_record.update(header_data)
+        index_record = self._update_record_keys(index_record)
+        index_record = self._remove_redundant_fields(index_record)
+        try:
+            [row, column] = index_record["sample_plate"].replace("_", "-").split("-")
+            index_record["row"] = row[1:].lstrip("0")
+            index_record["column"] = column[1:].lstrip("0")
+        except KeyError:
+            pass
+        try:
+            index_record['chrom_number'] = _format_chrom_number(
+                str(index_record['chrom_number'])
+            )
+        except KeyError:
+            pass
 
-    def _index_data(self, header_data, analysis_data):
+        return index_record
+
+    def _get_conversion_plan(self, fieldnames, header_data, fld_xd):
         '''
-        Indexes parsed data
+        Returns the conversion plan of a file header, planned once for each
+        field configuration and header
         '''
+        plan_key = (
+            tuple(fieldnames),
+            tuple(sorted(fld_xd)),
+            tuple(sorted(header_data.keys())),
+            tuple(sorted(self.__field_mapping__.items())),
+            tuple(sorted(
+                (key, self.__field_types__.get(key)) for key in fieldnames)))
+        try:
+            return _conversion_plans[plan_key]
+        except KeyError:
+            pass
 
+        # The renaming of the fields is simulated on a record holding the
+        # source of each field in place of its value
+        fields = {}
+        for (idx, key) in enumerate(fieldnames):
+            if key not in fld_xd:
+                fields[key] = (COLUMN_SOURCE, idx)
+        for key in header_data.keys():
+            fields[key] = (HEADER_SOURCE, key)
+        fields = self._update_record_keys(fields)
+        fields = self._remove_redundant_fields(fields)
+
+        plan = ConversionPlan()
+        for (key, (source, source_key)) in sorted(fields.items()):
+            if source == HEADER_SOURCE:
+                plan.header_fields.append((key, source_key))
+                continue
+            converter = _get_converter(
+                self.__field_types__[fieldnames[source_key]])
+            if key == "chrom_number":
+                converter = _get_chrom_number_converter(converter)
+            plan.columns.append((source_key, key, converter))
+        plan.sample_plate = "sample_plate" in fields
+
+        if len(_conversion_plans) >= PLAN_CACHE_SIZE:
+            _conversion_plans.clear()
+        _conversion_plans[plan_key] = plan
+        return plan
+
+    def _chunk_records(self, csv_lines, header_data, fld_xd):
+        '''
+        Converts the rows read from a CSV/TSV file into index records, same
+        as _csv_records, but reading the file in chunks and converting each
+        column of a chunk at once
+        '''
+        reader = pandas.read_csv(
+            csv_lines,
+            sep=self.__csv_dialect__.delimiter,
+            quoting=csv.QUOTE_NONE,
+            dtype=str,
+            na_filter=False,
+            chunksize=CHUNK_ROWS)
+
+        chrom_numbers = {}
+        for chunk in reader:
+            columns = {}
+            for key in Set(chunk.columns).difference(fld_xd):
+                columns[key] = self._convert_column(chunk[key], key)
+
+            for index_record in self._column_records(
+                    columns, len(chunk), header_data, chrom_numbers):
+                yield index_record
+
+    def _column_records(self, columns, length, header_data, chrom_numbers):
+        '''
+        Turns a batch of converted columns into index records, the header
+        values and renaming being applied to whole columns using the same
+        functions as for single records
+        '''
+        columns.update(header_data)
+        columns = self._update_record_keys(columns)
+        columns = self._remove_redundant_fields(columns)
+
+        if "sample_plate" in columns:
+            (columns["row"], columns["column"]) = _split_sample_plate(
+                columns["sample_plate"], length)
+        if "chrom_number" in columns:
+            columns["chrom_number"] = _format_chrom_numbers(
+                columns["chrom_number"], chrom_numbers)
+
+        # The records are built by iterators, without a Python loop over the
+        # rows, constants being repeated as columns
+        keys = []
+        values = []
+        for key, value in columns.items():
+            keys.append(key)
+            if isinstance(value, _ColumnValues):
+                values.append(value)
+            else:
+                values.append(itertools.repeat(value, length))
+        if not values:
+            return itertools.imap(dict, itertools.repeat((), length))
+        return itertools.imap(dict, itertools.imap(
+            itertools.izip, itertools.repeat(keys), itertools.izip(*values)))
+
+    def _convert_column(self, column, key):
+        '''
+        Applies the data type associated with a column to all of its values,
+        same as _apply_type does for a single value. The values are parsed
+        by numpy at once, only those it can't parse, e.g. missing or quoted
+        values, being converted one at a time
+        '''
+        field_type = self.__field_types__[key]
+        values = column.values
+        if field_type == 'str':
+            converted = values
+            fallback = _get_special_strings(values)
+        elif field_type == 'int':
+            try:
+                converted = values.astype(numpy.int64)
+                fallback = numpy.zeros(len(values), dtype=bool)
+            except (ValueError, OverflowError):
+                # Values such as '2.0' are integers as well, but not '1e3'
+                numbers = _parse_numbers(column)
+                with numpy.errstate(invalid='ignore'):
+                    fallback = ~numpy.isfinite(numbers) | \
+                        (numbers != numpy.trunc(numbers)) | \
+                        (numpy.abs(numbers) >= MAX_EXACT_INT)
+                fallback |= column.str.contains('[eE]').values
+                numbers[fallback] = 0
+                converted = numbers.astype(numpy.int64)
+        elif field_type == 'float':
+            converted = _parse_numbers(column)
+            fallback = ~numpy.isfinite(converted)
+        else:
+            raise ValueError(field_type)
+
+        converted = converted.tolist()
+        if fallback.any():
+            converter = _get_converter(field_type)
+            for idx in numpy.flatnonzero(fallback):
+                converted[idx] = converter(values[idx])
+        return _ColumnValues(converted)
+
+    def _index_data(self, header_data, analysis_data):
+        '''
+        Indexes parsed data, a list or any iterable of records or of batches
+        of records, which is read once. The fields are configured from the
+        first PEEK_RECORDS records, returns the number of records as parse
+        stats
+        '''
         self.__parsed_input__ = True
-        self._configure_field_mapping(analysis_data[0].keys(), header_data)
-        self._rm_fields(Set(analysis_data.fieldnames))
+        records = _iter_records(analysis_data)
+        peeked_records = list(itertools.islice(records, PEEK_RECORDS))
+        stats = {"input_records": 0, "non_standard_chroms": 0}
+        if not peeked_records:
+            logging.warn("No records to index.")
+            return stats
+
+        field_names = []
+        for record in peeked_records:
+            field_names.extend(
+                key for key in record.keys() if key not in field_names)
+
+        self._configure_field_mapping(field_names, header_data)
+        self._rm_fields(Set(field_names))
         fld_xd = Set(self.__field_ignore__)
-        self._set_field_types(analysis_data[0],fld_xd)
+        self._set_field_types(peeked_records[0],fld_xd)
         self._verify_field_types()
         self._check_for_reserved_fields()
+        header_data = self.store_header(header_data)
 
+        def count_records(records):
+            ''' counts the records as they are read '''
+            for record in records:
+                stats["input_records"] += 1
+                yield record
+
+        self._index_records(self._data_records(
+            count_records(itertools.chain(peeked_records, records)),
+            header_data, fld_xd))
+
+        return stats
+
+    def _data_records(self, analysis_data, header_data, fld_xd):
+        '''
+        Converts parsed data into index records
+        '''
         for record in analysis_data:
             index_record = {
                 key: self._detect_type(record, key)
@@ -185,23 +603,15 @@ class CsvLoader(AnalysisLoader):
             except KeyError:
                 pass
 
-            self._buffer_record(index_record, False)
+            yield index_record
 
-        # Submit any records remaining in the buffer for indexing
-        self._buffer_record(None, True)
-
-    def _get_csv_dialect(self, csv_file):
+    def _get_csv_dialect(self, csv_lines):
         '''
-        Gets the CSV file format properties
+        Gets the CSV file format properties from the first line
         '''
-        try:
-            with open(csv_file) as csv_fh:
-                sniffer = csv.Sniffer()
-                self.__csv_dialect__ = sniffer.sniff(csv_fh.readline())
-                self.__csv_dialect__.quoting = csv.QUOTE_NONE
-        except IOError:
-            logging.error('Unable to parse CSV file.')
-            exit(1)
+        sniffer = csv.Sniffer()
+        self.__csv_dialect__ = sniffer.sniff(csv_lines.readline())
+        self.__csv_dialect__.quoting = csv.QUOTE_NONE
 
     def _set_field_types(self, record,fld_xd):
         '''
@@ -267,18 +677,14 @@ class CsvLoader(AnalysisLoader):
     def validate_input_file(self, input_file):
         pass
 
-    def _buffer_record(self, index_record, empty_buffer=False):
+    def _index_records(self, records):
         '''
-        Appends records to the buffer and submits them for indexing
+        Submits the records produced by the given iterator for bulk indexing
         '''
-        if isinstance(index_record, dict):
-            index_cmd = self.get_index_cmd()
-            self.__index_buffer__.append(index_cmd)
-            self.__index_buffer__.append(index_record)
-
-        if len(self.__index_buffer__) >= self.LOAD_FACTOR or empty_buffer:
-            self.es_tools.submit_bulk_to_es(self.__index_buffer__)
-            self.__index_buffer__ = []
+        index_cmd = self.get_index_cmd()
+        actions = ((index_cmd, record) for record in records)
+        for _ in self.es_tools.parallel_bulk_to_es(actions):
+            pass
 
     def _configure_field_mapping(self, column_names, header_data):
         '''
@@ -392,6 +798,238 @@ class CsvLoader(AnalysisLoader):
         return not value.strip()
 
 
+def pool_parse_range(params):
+    '''
+    A proxy function to be called by Pool.map with simple parameters, it
+    creates the loader parsing a byte range of a file
+    '''
+    try:
+        loader = CsvLoader(
+            es_index=params["index"],
+            es_doc_type=params["doc_type"],
+            **params["es_settings"])
+        return loader._index_range(params)
+    except Exception:
+        # The traceback of the worker is lost otherwise
+        logging.error(traceback.format_exc())
+        raise
+    finally:
+        export_metrics()
+
+
+def _iter_records(analysis_data):
+    '''
+    Iterates over parsed records given one by one or in batches, i.e. lists
+    of records
+    '''
+    for item in analysis_data:
+        if isinstance(item, dict):
+            yield item
+        else:
+            for record in item:
+                yield record
+
+
+def get_byte_ranges(file_name, num_ranges):
+    '''
+    Returns the (start, end) offsets of up to num_ranges ranges of similar
+    size covering the data lines of a file, each range starting at the
+    beginning of a line
+    '''
+    with open(file_name) as input_fh:
+        input_fh.readline()
+        data_start = input_fh.tell()
+        data_end = os.fstat(input_fh.fileno()).st_size
+        num_ranges = max(1, min(
+            num_ranges, (data_end - data_start) // MIN_RANGE_BYTES))
+
+        offsets = [data_start]
+        for idx in range(1, num_ranges):
+            offset = data_start + (data_end - data_start) * idx // num_ranges
+            if offset <= offsets[-1]:
+                continue
+            input_fh.seek(offset - 1)
+            # Move on to the beginning of the next line
+            input_fh.readline()
+            if input_fh.tell() < data_end and input_fh.tell() > offsets[-1]:
+                offsets.append(input_fh.tell())
+        offsets.append(data_end)
+
+    return zip(offsets[:-1], offsets[1:])
+
+
+def _read_range(input_fh, start, end, counts):
+    '''
+    Returns the lines of a file between the given offsets, counting the
+    non-comment, non-empty lines the same way count_input_lines does
+    '''
+    input_fh.seek(start)
+    position = start
+    while position < end:
+        line = input_fh.readline()
+        if not line:
+            break
+        position += len(line)
+        if line.rstrip('\n') and not line.startswith('#'):
+            counts["input_lines"] += 1
+        yield line
+
+
+class ConversionPlan(object):
+
+    '''
+    How the rows of a CSV/TSV file are turned into index records: the
+    position, index record field and converter of each column, the
+    index record fields taking header values and whether the sample plate
+    position is split into row and column
+    '''
+
+    def __init__(self):
+        self.columns = []
+        self.header_fields = []
+        self.sample_plate = False
+
+    def get_constants(self, header_data):
+        '''
+        Returns the index record fields taking header values, the sample
+        plate position being split at once if it is a header value
+        '''
+        constants = {}
+        for (key, source_key) in self.header_fields:
+            constants[key] = header_data[source_key]
+        if "chrom_number" in constants:
+            constants["chrom_number"] = _format_chrom_number(
+                str(constants["chrom_number"]))
+        if self.sample_plate and "sample_plate" in constants:
+            [row, column] = constants["sample_plate"].replace("_", "-").split("-")
+            constants["row"] = row[1:].lstrip("0")
+            constants["column"] = column[1:].lstrip("0")
+        return constants
+
+
+def _get_converter(field_type):
+    '''
+    Returns a function applying the given data type to a single value,
+    same as CsvLoader._apply_type
+    '''
+    key_type = getattr(__builtin__, field_type)
+    na_values = NA_VALUES if field_type != 'str' else []
+
+    def convert(value):
+        ''' converts a value read from a CSV/TSV file '''
+        lower_value = value.lower()
+        if lower_value in na_values or not lower_value.strip():
+            return None
+        try:
+            return key_type(value.replace('"', ''))
+        except ValueError:
+            return key_type(re.sub(r'\.0$', '', value))
+
+    return convert
+
+
+def _get_chrom_number_converter(converter):
+    '''
+    Returns a function converting and formatting chrom_number values, each
+    distinct value being formatted once
+    '''
+    formatted = {}
+
+    def convert(value):
+        ''' converts and formats a chrom_number value '''
+        try:
+            return formatted[value]
+        except KeyError:
+            formatted[value] = _format_chrom_number(str(converter(value)))
+            return formatted[value]
+
+    return convert
+
+
+def _parse_numbers(column):
+    '''
+    Returns the values of a column of strings as doubles, NaN for the values
+    which aren't numbers
+    '''
+    values = column.values
+    try:
+        return values.astype(numpy.float64)
+    except ValueError:
+        pass
+    # The numbers are found by pandas but parsed by numpy, the same way as
+    # float() does
+    numbers = pandas.to_numeric(column, errors='coerce').values.astype(
+        numpy.float64)
+    parsed = ~numpy.isnan(numbers)
+    try:
+        numbers[parsed] = values[parsed].astype(numpy.float64)
+    except ValueError:
+        numbers[:] = numpy.nan
+    return numbers
+
+
+def _get_special_strings(values):
+    '''
+    Returns the mask of the strings which are blank or hold quotes, the
+    strings being scanned at once, then one at a time only if any is found
+    '''
+    # Fields read by the pandas engine hold neither new lines nor NULs
+    joined = '\0' + '\0'.join(values) + '\0'
+    if '"' not in joined and not any(
+            '\0' + blank in joined for blank in ('\0', ' ', '\t', '\r')):
+        return numpy.zeros(len(values), dtype=bool)
+    return numpy.array(
+        [not value.strip() or '"' in value for value in values], dtype=bool)
+
+
+def _get_row_record(fieldnames, csv_row):
+    '''
+    Returns a row as a dictionary, same as csv.DictReader does
+    '''
+    csv_record = dict(zip(fieldnames, csv_row))
+    if len(csv_row) > len(fieldnames):
+        csv_record[None] = csv_row[len(fieldnames):]
+    for key in fieldnames[len(csv_row):]:
+        csv_record[key] = None
+    return csv_record
+
+
+class _ColumnValues(list):
+
+    '''
+    The values of a column, as opposed to a value shared by all records
+    '''
+
+
+def _split_sample_plate(sample_plates, length):
+    '''
+    Returns the row and column numbers of sample plate positions (values
+    such as R01_C02) of a column or a single value
+    '''
+    if not isinstance(sample_plates, _ColumnValues):
+        sample_plates = [sample_plates] * length
+    # Each distinct position is split once
+    positions = {}
+    for sample_plate in set(sample_plates):
+        [row, column] = sample_plate.replace("_", "-").split("-")
+        positions[sample_plate] = (row[1:].lstrip("0"), column[1:].lstrip("0"))
+    (rows, columns) = zip(*map(positions.__getitem__, sample_plates)) or \
+        ((), ())
+    return _ColumnValues(rows), _ColumnValues(columns)
+
+
+def _format_chrom_numbers(chrom_numbers, formatted):
+    '''
+    Formats the chrom_number values of a column or a single value, each
+    distinct value being formatted once
+    '''
+    if not isinstance(chrom_numbers, _ColumnValues):
+        return _format_chrom_number(str(chrom_numbers))
+    for chrom_number in set(chrom_numbers).difference(formatted):
+        formatted[chrom_number] = _format_chrom_number(str(chrom_number))
+    return _ColumnValues(map(formatted.__getitem__, chrom_numbers))
+
+
 def _format_chrom_number(chrom_number):
     '''
     Formats the index record chrom_number field
@@ -405,3 +1043,254 @@ def _format_chrom_number(chrom_number):
         return chrom_number.zfill(2)
 
     return chrom_number.upper()
+
+
+import tempfile
+import hashlib
+import unittest
+from elasticsearchloader.es_fake import FAKE_HOST
+
+
+class CsvLoaderTests(unittest.TestCase):
+
+    header = {
+        "caller": "csvtest",
+        "sample_id": "SA1",
+        "field_mapping": {"chrom_number": "chr"},
+        "field_types": {
+            "cell_id": "str",
+            "chr": "str",
+            "start": "int",
+            "end": "int",
+            "state": "float",
+            "integer_median": "float"
+        }
+    }
+
+    content = (
+        "cell_id,chr,start,end,state,integer_median\n"
+        "a,1,10.0,20,NA,?\n"
+        "\"b\",X,,30,2.0,inf\n"
+        "c,23,5,99999999999999999999,1.5,\n"
+        " d ,7, 12 ,40,nan,3\n"
+        "e,y,-1,2,-1.5e2,0.1\n"
+        ",24,1,2,1,1e-3\n")
+
+    def parse_records(self, content, engine=None):
+        '''
+        returns the records parsed from a file with the given content, in
+        place of indexing them
+        '''
+        (file_handle, file_name) = tempfile.mkstemp(suffix=".csv")
+        records = []
+        try:
+            with os.fdopen(file_handle, "w") as output_fh:
+                output_fh.write(content)
+            loader = CsvLoader(
+                es_index="csvtest", es_doc_type="csvtest",
+                es_host=FAKE_HOST, es_port=9200)
+            loader.disable_index_refresh = lambda: None
+            loader.enable_index_refresh = lambda: None
+            loader._index_records = records.extend
+            loader.parse(
+                analysis_file=file_name,
+                custom_header=copy.deepcopy(self.header),
+                engine=engine)
+        finally:
+            os.remove(file_name)
+        for record in records:
+            del record["source_id"]
+            del record["file_fullname"]
+        return records
+
+    @unittest.skipIf(pandas is None, "needs pandas")
+    def test_engines(self):
+        global CHUNK_ROWS
+        chunk_rows = CHUNK_ROWS
+        # Several chunks
+        CHUNK_ROWS = 4
+        try:
+            records = self.parse_records(self.content, PANDAS_ENGINE)
+        finally:
+            CHUNK_ROWS = chunk_rows
+        self.failUnless(records == self.parse_records(self.content))
+        self.failUnless(records[0]["start"] == 10 and
+                        records[0]["state"] is None)
+        self.failUnless(
+            [type(value) for (_, value) in sorted(records[2].items())] ==
+            [str, str, str, long, type(None), str, int, float])
+        self.failUnless(
+            [record["chrom_number"] for record in records] ==
+            ["01", "X", "X", "07", "Y", "Y"])
+
+    def convert_rows(self, content, planned):
+        '''
+        returns the records converted from the rows of a file with the
+        given content, following the conversion plan or row by row with
+        _convert_record, the type of the error raised in place of the
+        records failing to convert
+        '''
+        loader = CsvLoader(
+            es_index="csvtest", es_doc_type="csvtest",
+            es_host=FAKE_HOST, es_port=9200)
+        header_data = copy.deepcopy(self.header)
+        loader.__field_types__.update(header_data.pop("field_types"))
+        csv_rows = list(csv.reader(content.splitlines(True)))
+        fieldnames = csv_rows.pop(0)
+        loader._configure_field_mapping(fieldnames, header_data)
+        fld_xd = Set(["ignored"])
+
+        records = []
+        for csv_row in csv_rows:
+            try:
+                if planned:
+                    records.extend(loader._csv_records(
+                        [csv_row], fieldnames, header_data, fld_xd))
+                else:
+                    records.append(loader._convert_record(
+                        _get_row_record(fieldnames, csv_row), header_data,
+                        fld_xd))
+            except Exception as error:
+                records.append(type(error))
+        return records
+
+    def test_conversion_plan(self):
+        content = (
+            "cell_id,chr,start,end,state,integer_median,ignored\n"
+            "a,1,10,20,1.5,2,x\n"
+            # int values written as floats
+            "b,2,12.0,30.0,2.0,3.0,x\n"
+            # NA and empty values
+            "c,X,NA,,nan,?,\n"
+            "d,y, , 40 ,inf,NaN,x\n"
+            ",,1,2,,,\n"
+            # quoted values, with quotes kept within them
+            "\"e\",\"7\",\"5\",6,\"1.25\",1,x\n"
+            "\"f\"\"g\",\"M\",1,\"2\"\"\",1,1,x\n"
+            "\"h, i\",10,1,2,1e3,-1.5e-2,x\n"
+            # rows of the wrong length
+            "j,3,1,2,1,1\n"
+            "k,3,1,2,1,1,x,extra\n"
+            "l,3,1,2,1,1,,\n")
+        records = self.convert_rows(content, True)
+        self.failUnless(records == self.convert_rows(content, False))
+        self.failUnless(records[1]["start"] == 12 and
+                        records[1]["end"] == 30)
+        self.failUnless(records[2]["start"] is None and
+                        records[2]["chrom_number"] == "X")
+        self.failUnless(records[5]["cell_id"] == "e" and
+                        records[5]["chrom_number"] == "07")
+        self.failUnless(records[6]["cell_id"] == "fg" and
+                        records[6]["end"] == 2)
+        self.failUnless(records[7]["cell_id"] == "h, i")
+        # The missing value is ignored, the extra ones fail to convert
+        self.failUnless(records[8]["cell_id"] == "j")
+        self.failUnless(records[9:] == [KeyError, KeyError])
+        self.failUnless("ignored" not in records[0])
+
+    def get_ranges_lines(self, content, num_ranges):
+        '''
+        returns the byte ranges of a file with the given content, and the
+        lines read from each range
+        '''
+        (file_handle, file_name) = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(file_handle, "w") as output_fh:
+                output_fh.write(content)
+            ranges = get_byte_ranges(file_name, num_ranges)
+            counts = {"input_lines": 0}
+            with open(file_name) as input_fh:
+                lines = [
+                    list(_read_range(input_fh, start, end, counts))
+                    for (start, end) in ranges]
+        finally:
+            os.remove(file_name)
+        return (ranges, lines, counts)
+
+    def test_byte_ranges(self):
+        global MIN_RANGE_BYTES
+        min_range_bytes = MIN_RANGE_BYTES
+        MIN_RANGE_BYTES = 64
+        try:
+            header = "chr,start,end\n"
+            data_lines = [
+                "%d,%d,%d\n" % (idx % 3, idx, idx * 1000)
+                for idx in range(100)]
+            data_lines[10] = "# comment\n"
+            content = header + "".join(data_lines)
+
+            (ranges, lines, counts) = self.get_ranges_lines(content, 4)
+            # Ranges follow one another from the first data line to the end
+            # of the file, each one starting at the beginning of a line
+            self.failUnless(len(ranges) == 4)
+            self.failUnless(ranges[0][0] == len(header))
+            self.failUnless(ranges[-1][1] == len(content))
+            for (previous, current) in zip(ranges, ranges[1:]):
+                self.failUnless(previous[1] == current[0])
+                self.failUnless(content[current[0] - 1] == "\n")
+            self.failUnless(sum(lines, []) == data_lines)
+            self.failUnless(counts["input_lines"] == 99)
+
+            # Without a trailing new line
+            (ranges, lines, counts) = self.get_ranges_lines(
+                content.rstrip("\n"), 4)
+            self.failUnless("".join(sum(lines, [])) ==
+                            "".join(data_lines).rstrip("\n"))
+
+            # Small files aren't split beyond MIN_RANGE_BYTES
+            (ranges, lines, counts) = self.get_ranges_lines(
+                header + "".join(data_lines[:10]), 8)
+            self.failUnless(len(ranges) == 1)
+            self.failUnless(counts["input_lines"] == 10)
+
+            # Lines longer than the ranges, several splits falling in them
+            long_lines = ["%d,%s\n" % (idx, "x" * 300) for idx in range(3)]
+            (ranges, lines, counts) = self.get_ranges_lines(
+                header + "".join(long_lines), 16)
+            self.failUnless(len(ranges) == 3)
+            self.failUnless(lines == [[line] for line in long_lines])
+
+            # Header only
+            (ranges, lines, counts) = self.get_ranges_lines(header, 4)
+            self.failUnless(counts["input_lines"] == 0)
+        finally:
+            MIN_RANGE_BYTES = min_range_bytes
+
+    def get_parse_stats(self, content, workers):
+        '''
+        returns the parse stats of a file with the given content, read by
+        the given number of workers
+        '''
+        loader = CsvLoader(
+            es_index="csvranges", es_doc_type="csvtest",
+            es_host=FAKE_HOST, es_port=9200)
+        loader.create_index()
+        (file_handle, file_name) = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(file_handle, "w") as output_fh:
+                output_fh.write(content)
+            return loader.parse(
+                analysis_file=file_name,
+                custom_header=copy.deepcopy(self.header),
+                workers=workers,
+                checksum="md5")
+        finally:
+            loader.es_tools.delete_index()
+            os.remove(file_name)
+
+    def test_range_stats(self):
+        global MIN_RANGE_BYTES
+        min_range_bytes = MIN_RANGE_BYTES
+        MIN_RANGE_BYTES = 64
+        try:
+            content = self.content.split("\n")[0] + "\n" + "".join(
+                "c%d,%d,%d,%d,%d,%d\n" % (idx, idx % 22 + 1, idx, idx + 1,
+                                          idx % 5, idx % 3)
+                for idx in range(100))
+            stats = self.get_parse_stats(content, 1)
+            range_stats = self.get_parse_stats(content, 4)
+        finally:
+            MIN_RANGE_BYTES = min_range_bytes
+        self.failUnless(stats["checksum"] == hashlib.md5(content).hexdigest())
+        self.failUnless(range_stats["checksum"] == stats["checksum"])
+        self.failUnless(range_stats["input_lines"] == stats["input_lines"])
@@ -10,8 +10,11 @@ import logging
 import sys
 import timeit
 import copy
+import itertools
+import math
 from multiprocessing import cpu_count
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import time
 import os
 import traceback
@@ -19,6 +22,16 @@ from intervaltree import Interval, IntervalTree
 from elasticsearch.exceptions import TransportError
 from elasticsearchloader.analysis_loader import AnalysisLoader
 from elasticsearchloader.es_settings import DENORMALIZED_ALIAS
+from elasticsearchloader.es_fake import FAKE_HOST
+from elasticsearchloader.es_metrics import export_metrics
+from elasticsearchloader.source_index import get_source_ids
+from elasticsearchloader.bulk_controller import get_bulk_controller
+from elasticsearchloader.bulk_controller import set_bulk_controller
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 SCRIPT_PATH = os.path.abspath(__file__)
@@ -29,6 +42,45 @@ sys.setrecursionlimit(10000)
 MAX_PROCESSES = 4
 TIMEOUT = 300
 
+# Number of intervals the records of each chromosome are split into
+INTERVAL_COUNT = 8
+
+# Engines finding the overlapping records, the numpy engine finds the
+# overlaps of all records at once using sorted position arrays
+TREE_ENGINE = "intervaltree"
+NUMPY_ENGINE = "numpy"
+
+# Maximum number of candidate pairs compared at once by the numpy engine
+MAX_CANDIDATES = 2000000
+
+# Number of records rewritten at once when the record sources are fetched
+# lazily, only the sources of these records and of their overlapping
+# records being held in memory
+FETCH_BATCH_SIZE = 500
+
+# Fields read for each record in the first phase of lazy source fetching
+POSITION_FIELDS = ["start", "end", "cell_id"]
+
+# Number of denormalized records checked at once against the denormalized
+# index in partial update mode
+UPDATE_BATCH_SIZE = 500
+
+# Fields read from the denormalized index to tell whether the events of
+# a record have changed
+EVENT_FIELDS = ["overlaps", "events.record_id"]
+
+# Chromosomes of the single cell records which are denormalized
+SC_CHROM_NUMBERS = [str(i).zfill(2) for i in range(1, 23)] + \
+    ["x", "X", "y", "Y", "NONE"]
+
+# Script adding the empty events to the single cell records copied by the
+# server side reindex, on Elastic search 2.x inline scripts need to be
+# enabled
+SC_EVENTS_SCRIPT = "ctx._source.events = []; ctx._source.overlaps = 0"
+
+# Seconds between two checks of the reindex task progress
+REINDEX_POLL_INTERVAL = 10
+
 def generate_events_data(
         index=None,
         doc_type=None,
@@ -38,11 +90,24 @@ def generate_events_data(
         http_auth=None,
         source=None,
         index_alias=None,
-        is_qc=False):
+        is_qc=False,
+        overlap_engine=None,
+        lazy_sources=False,
+        partial_update=False,
+        requests_per_second=None):
     '''
     Iterates over the records from a given input file and finds all events with
     overlapping positions, chromosome numbers and sample IDs and adds them
-    to the record under field 'events'
+    to the record under field 'events'. The overlapping records are found
+    using interval trees (intervaltree, the default) or sorted position
+    arrays (numpy). With lazy_sources, the numpy engine reads only the
+    positions of the records, fetching the sources of the records being
+    rewritten in batches. With partial_update, records already in the
+    denormalized index only have their events and overlaps updated, and
+    are skipped if these haven't changed, the index keeping the record
+    sources for it. Single cell records without QC
+    data are copied by a server side reindex, throttled to
+    requests_per_second
     '''
 
     if not index or not doc_type:
@@ -50,6 +115,13 @@ def generate_events_data(
             "Index and document type names need to be provided as an input.")
         return
 
+    if lazy_sources:
+        overlap_engine = NUMPY_ENGINE
+    if overlap_engine == NUMPY_ENGINE and numpy is None:
+        logging.warn("numpy is not available, using interval trees.")
+        overlap_engine = TREE_ENGINE
+        lazy_sources = False
+
     timer_start = timeit.default_timer()
     # Here the loader is chosen arbitrarily, any other loader type
     # could be used for the purpose
@@ -89,13 +161,20 @@ def generate_events_data(
             es_port=port,
             use_ssl=use_ssl,
             http_auth=http_auth)
-        mappings = get_mappings(document_type)
+        mappings = get_mappings(document_type, partial_update)
         data_loader_dst.create_index(mappings)
         data_loader_dst.es_tools.create_alias(index_alias)
 
+    if partial_update and not has_record_sources(data_loader_dst):
+        logging.warn(
+            "Index %s doesn't keep the record sources, which partial " +
+            "updates need, rewriting the records as a whole.", dst_index)
+        partial_update = False
+
     data_loader_dst.disable_index_refresh()
 
     logging.info("Denormalizing data in index %s (%s).", index, time.ctime())
+    source = resolve_source(data_loader, source)
     logging.info("Processing data with source %s", source)
 
     doc_types.sort()
@@ -118,11 +197,16 @@ def generate_events_data(
         "use_ssl": use_ssl,
         "http_auth": http_auth,
         "source": source,
-        "is_qc": is_qc
+        "is_qc": is_qc,
+        "overlap_engine": overlap_engine or TREE_ENGINE,
+        "lazy_sources": lazy_sources,
+        "partial_update": partial_update,
+        "requests_per_second": requests_per_second
     }
 
-    if (is_single_cell_data(data_loader, source)):
-        if (not has_single_cell_qc_data(data_loader)):
+    (is_single_cell, has_qc_data) = get_single_cell_flags(data_loader, source)
+    if is_single_cell:
+        if not has_qc_data:
             logging.debug("Denormalize Single Cell: No QC Data")
             process_sc_chrom(params)
         else:
@@ -134,14 +218,9 @@ def generate_events_data(
         logging.debug("Denormalize Bulk Data")
         process_params = []
 
-        chrom_nums = [str(i).zfill(2) for i in range(1, 23)] + ["x", "X", "y", "Y", "NONE"]
-        for chrom_number in chrom_nums:
-            data_boundaries = get_data_intervals(
-                data_loader,
-                chrom_number,
-                source
-            )
-            for interval in data_boundaries:
+        data_intervals = get_data_intervals(data_loader, source)
+        for chrom_number in sorted(data_intervals.keys()):
+            for interval in data_intervals[chrom_number]:
                 process_params.append(copy.deepcopy(params))
                 process_params[-1]["chrom_number"] = chrom_number
                 process_params[-1]["interval"] = interval
@@ -157,7 +236,7 @@ def generate_events_data(
 
         print "3 num_processes=",num_processes #debug
         if num_processes:
-            process_pool = Pool(processes=num_processes)
+            process_pool = get_process_pool(num_processes, host)
             process_pool.map(pool_process, process_params)
             process_pool.close()
             process_pool.terminate()
@@ -194,6 +273,50 @@ def generate_events_data(
         )
 
 
+def resolve_source(data_loader, source):
+    '''
+    Returns the source as found on the records. Records whose header is
+    stored once per source don't hold the header fields, such sources are
+    looked up by their header values, i.e. file_fullname, and returned as
+    a list of source IDs
+    '''
+    (source_key, _) = source.items()[0]
+    if source_key == "source_id" or \
+            data_loader.es_tools.count({"match": source})["count"]:
+        return source
+
+    source_ids = get_source_ids(data_loader.es_tools, source)
+    if not source_ids:
+        return source
+
+    return {"source_id": source_ids}
+
+
+def get_source_clause(source):
+    '''
+    Returns the query clause matching the records of a source, or of any
+    of a list of sources
+    '''
+    (source_key, source_value) = source.items()[0]
+    if isinstance(source_value, list):
+        return {"terms": {source_key: source_value}}
+    return {"match": source}
+
+
+def get_process_pool(num_processes, host=None):
+    '''
+    Returns a process pool whose workers share the bulk size controller
+    of the current process, or a thread pool for the in-memory backend,
+    whose data is not shared with other processes
+    '''
+    if host == FAKE_HOST:
+        return ThreadPool(processes=num_processes)
+    return Pool(
+        processes=num_processes,
+        initializer=set_bulk_controller,
+        initargs=(get_bulk_controller(),))
+
+
 def pool_process(params):
     '''
     A proxy function to be called by Pool.map with simple parameters, it
@@ -225,7 +348,10 @@ def pool_process(params):
             data_loader_dst,
             params["interval"],
             params["chrom_number"],
-            params["source"])
+            params["source"],
+            params["overlap_engine"],
+            params["lazy_sources"],
+            params["partial_update"])
     except Exception:
         error_message = "An error has occurred while de-normalizing " +\
                         "records from source " + str(params["source"])
@@ -233,6 +359,8 @@ def pool_process(params):
         logging.error(error_message)
         logging.error(traceback.format_exc(traceback.extract_stack()))
         logging.error("#" * len(error_message))
+    finally:
+        export_metrics()
 
 
 def process_interval(
@@ -240,7 +368,10 @@ def process_interval(
         data_loader_dst,
         interval,
         chrom_number,
-        source):
+        source,
+        overlap_engine=TREE_ENGINE,
+        lazy_sources=False,
+        partial_update=False):
     '''
     Given source/destination loaders and a positions range, de-normalizes
     the data associated with the particular chromosome number and source
@@ -252,13 +383,27 @@ def process_interval(
         interval["min"],
         interval["max"]
     )
-    search_data = build_search_tree(
-        data_loader,
-        chrom_number,
-        interval["min"],
-        interval["max"],
-        source
-    )
+    if lazy_sources:
+        search_data = build_search_arrays(
+            data_loader,
+            chrom_number,
+            interval["min"],
+            interval["max"],
+            source,
+            lazy_sources=True
+        )
+    else:
+        if overlap_engine == NUMPY_ENGINE:
+            build_search_data = build_search_arrays
+        else:
+            build_search_data = build_search_tree
+        search_data = build_search_data(
+            data_loader,
+            chrom_number,
+            interval["min"],
+            interval["max"],
+            source
+        )
 
     if len(search_data["records_tree"]) == 0:
         return
@@ -268,7 +413,10 @@ def process_interval(
     denormalize_data(
         data_loader_dst,
         search_data["records_tree"],
-        search_data["records_from_file"]
+        search_data["records_from_file"],
+        overlap_engine,
+        data_loader if lazy_sources else None,
+        partial_update
     )
     logging.debug(
         "Completed processing for chromosome %s, positions interval %d - %d.",
@@ -278,136 +426,170 @@ def process_interval(
     )
 
 
-def get_data_intervals(data_loader, chrom_number, source):
+def get_data_intervals(data_loader, source):
     '''
-    Returns the min start/max end positions of all records from the given file
+    Returns, for each chromosome of the records from the given source,
+    intervals covering the start positions of all records overlapping
+    them, split at positions which don't have any overlapping records.
+    The chromosomes and their ranges are found by a single aggregation,
+    then the positions of each chromosome are read once and partitioned
+    by record count
     '''
-    query = {
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "match": source
+    results = data_loader.es_tools.raw_search({
+        "query": get_source_clause(source),
+        "aggs": {
+            "chrom_numbers": {
+                "terms": {
+                    "field": "chrom_number",
+                    "size": 0
+                },
+                "aggs": {
+                    "min_start": {
+                        "min": {
+                            "field": "start"
+                        }
                     },
-                    {
-                        "match": {
-                            "chrom_number": chrom_number
+                    "max_end": {
+                        "max": {
+                            "field": "end"
                         }
                     }
-                ]
-            }
-        },
-        "aggs": {
-            "min_start": {
-                "min": {
-                    "field": "start"
-                }
-            },
-            "max_end": {
-                "max": {
-                    "field": "end"
                 }
             }
         },
         "size": 0
-    }
-    results = data_loader.es_tools.raw_search(query)
-    # In case the specific chromosome is not represented in the examined file
-    if results["aggregations"]["max_end"]["value"] is None:
-        return []
-    min_start = int(results["aggregations"]["min_start"]["value"])
-    min_start = get_split_position(data_loader, chrom_number, min_start, True)
-    max_end = int(results["aggregations"]["max_end"]["value"])
-
-    logging.debug(
-        "Determining intervals for chromosome %s within range %d - %d.",
-        chrom_number,
-        min_start,
-        max_end
-    )
-
-    interval_count = 8
-    interval_length = int((max_end - min_start) / interval_count)
-    if not interval_length:
-        interval_length = 1
-    intervals = []
-
-    current_start = min_start
-    current_end = min_start + interval_length
-
-    while current_end < max_end:
-        current_end = get_split_position(data_loader, chrom_number, current_end)
-        current_end += 1
-        intervals.append({"min": current_start, "max": current_end})
-        current_start = current_end
-        current_end = current_start + interval_length
-
-    if not intervals:
-        return [{"min": min_start, "max": max_end + 1}]
-    elif intervals[-1]["max"] < max_end:
-        intervals.append(
-            {"min": intervals[-1]["max"], "max":
-             get_split_position(data_loader, chrom_number, max_end) + 1})
-
-    return intervals
-
+    })
+
+    data_intervals = {}
+    for bucket in results["aggregations"]["chrom_numbers"]["buckets"]:
+        # In case the records of the chromosome don't have positions
+        if bucket["max_end"]["value"] is None:
+            continue
+        chrom_number = bucket["key"]
+        min_start = int(bucket["min_start"]["value"])
+        max_end = int(bucket["max_end"]["value"])
+
+        logging.debug(
+            "Determining intervals for chromosome %s within range %d - %d.",
+            chrom_number,
+            min_start,
+            max_end
+        )
+        (starts, ends) = get_positions(data_loader, chrom_number)
+        data_intervals[chrom_number] = get_partitions(
+            starts, ends, min_start, max_end, INTERVAL_COUNT)
 
-def get_split_position(data_loader, chrom_number, current_pos, look_left=False):
-    '''
-    Verifies whether a given position doesn't have any overlapping records,
-    if so, checks the position at the overlapping record's end (or start,
-    if look_left is set to True)
-    '''
-    query = get_check_position_query(chrom_number, current_pos)
-    results = data_loader.es_tools.raw_search(query)
-    if results["hits"]["total"] == 0:
-        return current_pos
-    lookup_pos = results["hits"]["hits"][0]["_source"]["end"]
-    if look_left:
-        if current_pos < 0:
-            return 0
-        lookup_pos = results["hits"]["hits"][0]["_source"]["start"]
-    return get_split_position(data_loader, chrom_number, lookup_pos, look_left)
+    return data_intervals
 
 
-def get_check_position_query(chrom_number, current_pos):
+def get_positions(data_loader, chrom_number):
     '''
-    Given a chromosome number and a particular positions, returns a query
-    used to check whether there are any records that overlap the position
+    Returns the start and end positions of the records of a chromosome,
+    read from the doc values and sorted by start then end, as numpy arrays
+    if numpy is available
     '''
-    return {
+    query = {
         "query": {
-            "match": {
-                "chrom_number": chrom_number
-            }
-        },
-        "post_filter": {
             "bool": {
-                "must": [
+                "filter": [
                     {
-                        "range": {
-                            "start": {
-                                "lt": current_pos
-                            }
+                        "match": {
+                            "chrom_number": chrom_number
                         }
                     },
                     {
-                        "range": {
-                            "end": {
-                                "gt": current_pos
-                            }
+                        "exists": {
+                            "field": "end"
                         }
                     }
                 ]
             }
         },
-        "sort": {
-            "end": {
-                "order": "desc"
-            }
-        }
+        "fielddata_fields": ["start", "end"]
     }
 
+    starts = []
+    ends = []
+    for record in data_loader.es_tools.parallel_scan(
+            query, source_fields=False):
+        fields = record.get("fields", {})
+        starts.append(fields["start"][0])
+        ends.append(fields["end"][0])
+
+    if numpy is None:
+        positions = sorted(zip(starts, ends))
+        return ([start for (start, _) in positions],
+                [end for (_, end) in positions])
+
+    starts = numpy.array(starts, dtype=numpy.int64)
+    ends = numpy.array(ends, dtype=numpy.int64)
+    order = numpy.lexsort((ends, starts))
+    return (starts[order], ends[order])
+
+
+def get_partitions(starts, ends, min_start, max_end, partition_count):
+    '''
+    Given the start and end positions of the records of a chromosome, sorted
+    by start, returns up to partition_count intervals of start positions
+    covering the records overlapping, directly or through other records, the
+    range min_start - max_end. Intervals are only cut ahead of a record
+    starting after the end of all records before it, so that overlapping
+    records fall into the same interval, and hold about the same number of
+    records
+    '''
+    clusters = [
+        (first_start, last_start, end, count)
+        for (first_start, last_start, end, count) in get_clusters(starts, ends)
+        if end >= min_start and first_start <= max_end]
+    if not clusters:
+        return []
+
+    records_per_partition = int(math.ceil(
+        sum(count for (_, _, _, count) in clusters) / partition_count))
+    intervals = []
+    current_start = clusters[0][0]
+    current_count = 0
+    for (first_start, _, _, count) in clusters:
+        if current_count >= records_per_partition:
+            intervals.append({"min": current_start, "max": first_start})
+            current_start = first_start
+            current_count = 0
+        current_count += count
+
+    intervals.append({"min": current_start, "max": clusters[-1][1] + 1})
+
+    return intervals
+
+
+def get_clusters(starts, ends):
+    '''
+    Returns the groups of records overlapping one another, as their first
+    start, last start, end and number of records, given the positions of the
+    records sorted by start. A group ends ahead of a record starting after
+    the end of all records before it
+    '''
+    if numpy is None:
+        clusters = []
+        for (start, end) in zip(starts, ends):
+            if clusters and start <= clusters[-1][2]:
+                (first_start, _, cluster_end, count) = clusters[-1]
+                clusters[-1] = (
+                    first_start, start, max(cluster_end, end), count + 1)
+            else:
+                clusters.append((start, start, end, 1))
+        return clusters
+
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    if not len(starts):
+        return []
+    reach = numpy.maximum.accumulate(ends)
+    firsts = numpy.flatnonzero(numpy.concatenate(
+        ([True], starts[1:] > reach[:-1])))
+    lasts = numpy.append(firsts[1:], len(starts)) - 1
+    return zip(starts[firsts].tolist(), starts[lasts].tolist(),
+               reach[lasts].tolist(), (lasts - firsts + 1).tolist())
+
 
 def build_search_tree(
         data_loader,
@@ -420,42 +602,20 @@ def build_search_tree(
     chromosome and with start positions within a given interval
     '''
     start_time = timeit.default_timer()
-    query = {
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "range": {
-                            "start": {
-                                "gte": start_pos,
-                                "lt": end_pos
-                            }
-                        }
-                    },
-                    {
-                        "match": {
-                            "chrom_number": chrom_number
-                        }
-                    }
-                ]
-            }
-        },
-        "fields": ["_source", "_size"]
-    }
-
-    results = data_loader.es_tools.scan(query)
+    results = get_interval_records(
+        data_loader, chrom_number, start_pos, end_pos)
 
     (source_key, source_value) = source.items()[0]
+    if not isinstance(source_value, list):
+        source_value = [source_value]
 
     records_tree = IntervalTree()
     records_from_file = []
     for record in results:
         [start, end] = [record["_source"]["start"], record["_source"]["end"]]
-        record["_source"]["record_id"] = record["_id"]
-        record["_size"] = record["_size"]
         # records_tree[start:end+1] = record
         records_tree.addi(start, end+1, record)
-        if record["_source"][source_key] == source_value:
+        if record["_source"].get(source_key) in source_value:
             records_from_file.append(record)
 
     end_time = timeit.default_timer()
@@ -477,20 +637,153 @@ def build_search_tree(
     }
 
 
-def denormalize_data(data_loader_dst, records_tree, records_from_file):
+def build_search_arrays(
+        data_loader,
+        chrom_number,
+        start_pos,
+        end_pos,
+        source,
+        lazy_sources=False):
+    '''
+    same as build_search_tree, but returns the records in sorted position
+    arrays, and the records from the source file as their indices. With
+    lazy_sources, only the fields needed to find the overlaps are read
+    '''
+    start_time = timeit.default_timer()
+    (source_key, source_value) = source.items()[0]
+    source_fields = None
+    if lazy_sources:
+        source_fields = POSITION_FIELDS + [source_key]
+    records = list(get_interval_records(
+        data_loader, chrom_number, start_pos, end_pos, source_fields))
+
+    if not isinstance(source_value, list):
+        source_value = [source_value]
+
+    records_from_file = [
+        idx for (idx, record) in enumerate(records)
+        if record["_source"].get(source_key) in source_value]
+    records_arrays = OverlapArrays(records)
+
+    end_time = timeit.default_timer()
+    logging.debug(
+        "Generated record arrays with %d records for chromosome %s " +
+        "and positions range %d - %d, list of %d records " +
+        "from source file %s in %f seconds.",
+        len(records),
+        chrom_number,
+        start_pos,
+        end_pos,
+        len(records_from_file),
+        str(source),
+        end_time - start_time
+    )
+    return {
+        "records_tree": records_arrays,
+        "records_from_file": records_from_file
+    }
+
+
+def get_interval_records(
+        data_loader, chrom_number, start_pos, end_pos, source_fields=None):
+    '''
+    returns the records with the specified chromosome and with start
+    positions within a given interval, along with their IDs. source_fields
+    limits the fields read, the records then only holding these fields
+    '''
+    query = {
+        "query": {
+            "bool": {
+                "must": [
+                    {
+                        "range": {
+                            "start": {
+                                "gte": start_pos,
+                                "lt": end_pos
+                            }
+                        }
+                    },
+                    {
+                        "match": {
+                            "chrom_number": chrom_number
+                        }
+                    }
+                ]
+            }
+        },
+        "fields": ["_source", "_size"]
+    }
+
+    if source_fields is not None:
+        del query["fields"]
+        for record in data_loader.es_tools.parallel_scan(
+                query, source_fields=source_fields):
+            yield record
+        return
+
+    for record in data_loader.es_tools.parallel_scan(query):
+        record["_source"]["record_id"] = record["_id"]
+        record["_size"] = record["_size"]
+        yield record
+
+
+def denormalize_data(data_loader_dst, records_tree, records_from_file,
+                     overlap_engine=TREE_ENGINE, data_loader=None,
+                     partial_update=False):
     '''
     searches the provided tree for data overlapping with the records
     from a specific sources file, updates their events fields accordingly
-    and adds/re-indexes them on the denormalized index
+    and adds/re-indexes them on the denormalized index. In case the data
+    loader is given, the sources of the records are fetched as they are
+    rewritten
     '''
     start_time = timeit.default_timer()
     overlapping_sets = {}
-    buffered_values = []
-    buffer_size = 0
-    header_size = 140
-    max_buffer_size = 4*1024000
-    batch_size = 4000
+    if data_loader:
+        def get_actions(*args):
+            ''' fetches the sources of the records being rewritten '''
+            return get_lazy_sweep_actions(data_loader, *args)
+    elif overlap_engine == NUMPY_ENGINE:
+        get_actions = get_sweep_actions
+    else:
+        get_actions = get_denormalized_actions
 
+    # When the data type driving the denormalization process consists of
+    # ranged records the request size might grow quite rapidly as the
+    # number of nested records can be quite large, the bulk engine limits
+    # the size in bytes of each request as well
+    actions = get_actions(
+        data_loader_dst,
+        records_tree,
+        records_from_file,
+        overlapping_sets)
+    if partial_update:
+        actions = get_update_actions(data_loader_dst, actions)
+
+    for _ in data_loader_dst.es_tools.parallel_bulk_to_es(actions):
+        pass
+
+    end_time = timeit.default_timer()
+    logging.debug(
+        "Indexed %d records from file and other %d overlapping records " +
+        "in %d seconds (%s).",
+        len(records_from_file),
+        len(overlapping_sets),
+        end_time - start_time,
+        time.ctime()
+    )
+
+
+def get_denormalized_actions(
+        data_loader_dst,
+        records_tree,
+        records_from_file,
+        overlapping_sets):
+    '''
+    yields the index commands and de-normalized records, first for the
+    records from the source file and then for all records overlapping with
+    them, which are collected in overlapping_sets
+    '''
     for record in records_from_file:
         [start, end] = [record["_source"]["start"], record["_source"]["end"]]
         # looking up overlapping records at a single position seem more
@@ -504,37 +797,20 @@ def denormalize_data(data_loader_dst, records_tree, records_from_file):
         # overlapping_sets = overlapping_sets | overlapping_set
         index_record = copy.deepcopy(record)
         index_record["_source"]["events"] = []
-        buffer_size += index_record["_size"] + header_size
         for interval in list(overlapping_set):
             if (is_addable_to_events(index_record, interval)):
 
                 index_record["_source"]["events"].append(interval.data["_source"])
                 overlapping_sets[interval.data["_id"]] = interval
-                buffer_size += interval.data["_size"]
         index_record["_source"]["overlaps"] = len(
             index_record["_source"]["events"]
         )
-        buffered_values.append(
-            get_index_command(data_loader_dst, record)
+        yield (
+            get_index_command(data_loader_dst, record),
+            index_record["_source"]
         )
-        buffered_values.append(index_record["_source"])
-        # When the data type driving the denormalization process consists of
-        # ranged records the buferd data might grow quite rapidly when as the
-        # number of nested records can be quite large, as such, check that as
-        # well when submitting bulk indexing tasks
-        if len(buffered_values) >= batch_size or buffer_size > max_buffer_size:
-            data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
-            buffered_values = []
-            buffer_size = 0
-
-    if len(buffered_values) > 0:
-        data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
-        buffered_values = []
-        buffer_size = 0
-
-    overlapping_sets = overlapping_sets.values()
-
-    for interval_rec in overlapping_sets:
+
+    for interval_rec in overlapping_sets.values():
         overlapping_items = set()
         if interval_rec.begin == interval_rec.end - 1:
             overlapping_items = records_tree[interval_rec.begin]
@@ -544,34 +820,236 @@ def denormalize_data(data_loader_dst, records_tree, records_from_file):
         overlapping_items.remove(interval_rec)
         record = copy.deepcopy(interval_rec.data)
         record["_source"]["events"] = []
-        buffer_size += record["_size"] + header_size
         for interval in list(overlapping_items):
             if (is_addable_to_events(record, interval)):
                 record["_source"]["events"].append(interval.data["_source"])
-                buffer_size += interval.data["_size"]
         record["_source"]["overlaps"] = len(record["_source"]["events"])
-        buffered_values.append(
-            get_index_command(data_loader_dst, record)
+        yield (
+            get_index_command(data_loader_dst, record),
+            record["_source"]
         )
-        buffered_values.append(record["_source"])
 
-        if len(buffered_values) >= batch_size or buffer_size > max_buffer_size:
-            data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
-            buffered_values = []
-            buffer_size = 0
 
-    if len(buffered_values) > 0:
-        data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
+def get_sweep_actions(
+        data_loader_dst,
+        records_arrays,
+        records_from_file,
+        overlapping_sets):
+    '''
+    same as get_denormalized_actions, using the overlaps found in the
+    position arrays of the records
+    '''
+    records = records_arrays.records
+    for (idx, overlaps) in zip(
+            records_from_file,
+            records_arrays.get_overlaps(records_from_file)):
+        record = records[idx]
+        index_record = copy.deepcopy(record)
+        index_record["_source"]["events"] = [
+            records[overlap]["_source"] for overlap in overlaps]
+        index_record["_source"]["overlaps"] = len(overlaps)
+        for overlap in overlaps:
+            overlapping_sets[records[overlap]["_id"]] = overlap
+        yield (
+            get_index_command(data_loader_dst, record),
+            index_record["_source"]
+        )
+
+    overlapping_records = sorted(overlapping_sets.values())
+    for (idx, overlaps) in zip(
+            overlapping_records,
+            records_arrays.get_overlaps(overlapping_records)):
+        record = copy.deepcopy(records[idx])
+        record["_source"]["events"] = [
+            records[overlap]["_source"] for overlap in overlaps]
+        record["_source"]["overlaps"] = len(overlaps)
+        yield (
+            get_index_command(data_loader_dst, record),
+            record["_source"]
+        )
+
+
+def get_lazy_sweep_actions(
+        data_loader,
+        data_loader_dst,
+        records_arrays,
+        records_from_file,
+        overlapping_sets):
+    '''
+    same as get_sweep_actions, for records holding only their positions,
+    the records being rewritten in batches in position order, each batch
+    fetching the sources of its records and of their overlapping records
+    '''
+    records = records_arrays.records
+    sources = {}
+
+    def get_actions(indices, collect_overlaps):
+        ''' yields the rewritten records with the given indices '''
+        indices = records_arrays.get_sorted(indices)
+        for first in range(0, len(indices), FETCH_BATCH_SIZE):
+            batch = indices[first:first + FETCH_BATCH_SIZE]
+            batch_overlaps = list(records_arrays.get_overlaps(batch))
+
+            needed = set(batch)
+            for overlaps in batch_overlaps:
+                needed.update(overlaps)
+            # The sources of the previous batch are kept, neighbouring
+            # batches sharing overlapping records
+            batch_sources = dict(
+                (idx, sources[idx]) for idx in needed if idx in sources)
+            batch_sources.update(fetch_sources(
+                data_loader, records,
+                [idx for idx in needed if idx not in batch_sources]))
+            sources.clear()
+            sources.update(batch_sources)
+
+            for (idx, overlaps) in zip(batch, batch_overlaps):
+                if idx not in batch_sources:
+                    # The record was deleted since its positions were read
+                    continue
+                record = records[idx]
+                overlaps = [
+                    overlap for overlap in overlaps
+                    if overlap in batch_sources]
+                index_source = dict(batch_sources[idx])
+                index_source["events"] = [
+                    batch_sources[overlap] for overlap in overlaps]
+                index_source["overlaps"] = len(overlaps)
+                if collect_overlaps:
+                    for overlap in overlaps:
+                        overlapping_sets[records[overlap]["_id"]] = overlap
+                yield (
+                    get_index_command(data_loader_dst, record),
+                    index_source
+                )
+
+    for action in get_actions(records_from_file, True):
+        yield action
+
+    for action in get_actions(overlapping_sets.values(), False):
+        yield action
+
+
+def fetch_sources(data_loader, records, indices):
+    '''
+    returns the sources of the records with the given indices, along with
+    their IDs, by index
+    '''
+    docs = data_loader.es_tools.mget(
+        [(records[idx]["_type"], records[idx]["_id"]) for idx in indices])
+
+    sources = {}
+    for (idx, doc) in zip(indices, docs):
+        if doc is None:
+            logging.error("Record %s no longer exists.", records[idx]["_id"])
+            continue
+        doc["_source"]["record_id"] = doc["_id"]
+        sources[idx] = doc["_source"]
+    return sources
 
-    end_time = timeit.default_timer()
-    logging.debug(
-        "Indexed %d records from file and other %d overlapping records " +
-        "in %d seconds (%s).",
-        len(records_from_file),
-        len(overlapping_sets),
-        end_time - start_time,
-        time.ctime()
-    )
+
+class OverlapArrays(object):
+
+    '''
+    The start and end positions of records, sorted by start position, along
+    with their cell IDs. The overlaps of many records are found at once,
+    comparing each record with the records starting within the longest
+    record length before it and up to its end
+    '''
+
+    def __init__(self, records):
+        self.records = records
+        starts = numpy.array(
+            [record["_source"]["start"] for record in records],
+            dtype=numpy.int64)
+        ends = numpy.array(
+            [record["_source"]["end"] for record in records],
+            dtype=numpy.int64)
+        self.__order__ = numpy.argsort(starts, kind="mergesort")
+        self.__starts__ = starts
+        self.__ends__ = ends
+        self.__sorted_starts__ = starts[self.__order__]
+        self.__sorted_ends__ = ends[self.__order__]
+        self.__max_length__ = int((ends - starts).max()) if records else 0
+
+        # Records are only added to the events of single cell records with
+        # the same cell ID, as is_addable_to_events does
+        cell_codes = {}
+        self.__has_cell__ = numpy.array(
+            ["cell_id" in record["_source"] for record in records],
+            dtype=bool)
+        self.__cells__ = numpy.array(
+            [cell_codes.setdefault(record["_source"]["cell_id"],
+                                   len(cell_codes))
+             if "cell_id" in record["_source"] else -1
+             for record in records],
+            dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_sorted(self, indices):
+        '''
+        Returns the given record indices sorted by start position
+        '''
+        indices = numpy.asarray(list(indices), dtype=numpy.int64)
+        return indices[numpy.argsort(
+            self.__starts__[indices], kind="mergesort")].tolist()
+
+    def get_overlaps(self, indices):
+        '''
+        Yields, for each of the given record indices, the indices of the
+        other records overlapping the record, which can be added to its
+        events
+        '''
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        if not len(indices):
+            return
+
+        starts = self.__starts__[indices]
+        ends = self.__ends__[indices]
+        lows = numpy.searchsorted(
+            self.__sorted_starts__, starts - self.__max_length__, 'left')
+        highs = numpy.searchsorted(self.__sorted_starts__, ends, 'right')
+        counts = highs - lows
+
+        # The candidates of several records are compared at once, up to
+        # MAX_CANDIDATES pairs
+        first = 0
+        while first < len(indices):
+            last = first + max(1, numpy.searchsorted(
+                numpy.cumsum(counts[first:]), MAX_CANDIDATES, 'right'))
+            for overlaps in self._get_chunk_overlaps(
+                    indices[first:last], starts[first:last],
+                    lows[first:last], counts[first:last]):
+                yield overlaps
+            first = last
+
+    def _get_chunk_overlaps(self, indices, starts, lows, counts):
+        '''
+        Returns the overlapping records of a chunk of records, given the
+        range of sorted positions of their candidates
+        '''
+        total = int(counts.sum())
+        queries = numpy.repeat(numpy.arange(len(indices)), counts)
+        offsets = numpy.cumsum(counts) - counts
+        positions = numpy.arange(total) - numpy.repeat(offsets, counts) + \
+            numpy.repeat(lows, counts)
+        candidates = self.__order__[positions]
+
+        query_indices = indices[queries]
+        matches = (self.__sorted_ends__[positions] >= starts[queries]) & \
+            (candidates != query_indices) & (
+                ~self.__has_cell__[query_indices] |
+                (self.__cells__[candidates] == self.__cells__[query_indices]))
+
+        matched_queries = queries[matches]
+        matched_candidates = candidates[matches]
+        bounds = numpy.searchsorted(
+            matched_queries, numpy.arange(len(indices) + 1), 'left')
+        return [
+            matched_candidates[bounds[idx]:bounds[idx + 1]].tolist()
+            for idx in range(len(indices))]
 
 
 def is_addable_to_events(index_record, interval):
@@ -585,6 +1063,69 @@ def is_addable_to_events(index_record, interval):
         return index_record["_source"]["cell_id"] == interval.data["_source"]["cell_id"]
     return True
 
+def get_update_actions(data_loader_dst, actions):
+    '''
+    Turns the index actions of denormalized records into updates of their
+    events and overlaps fields, with the whole record as upsert in case it
+    has been deleted since. Records already in the denormalized index with
+    the same events are skipped, and records missing from it are indexed
+    as a whole
+    '''
+    counts = {"indexed": 0, "updated": 0, "skipped": 0}
+    actions = iter(actions)
+    while True:
+        batch = list(itertools.islice(actions, UPDATE_BATCH_SIZE))
+        if not batch:
+            break
+
+        docs = data_loader_dst.es_tools.mget(
+            [(command["index"]["_type"], command["index"]["_id"])
+             for (command, _) in batch],
+            source_fields=EVENT_FIELDS)
+        for ((command, record), doc) in zip(batch, docs):
+            if doc is None:
+                counts["indexed"] += 1
+                yield (command, record)
+            elif has_same_events(doc.get("_source", {}), record):
+                counts["skipped"] += 1
+            else:
+                counts["updated"] += 1
+                yield (
+                    {"update": command["index"]},
+                    {
+                        "doc": {
+                            "events": record["events"],
+                            "overlaps": record["overlaps"]
+                        },
+                        "upsert": record
+                    }
+                )
+
+    logging.debug(
+        "Indexed %d, updated %d and skipped %d denormalized records.",
+        counts["indexed"],
+        counts["updated"],
+        counts["skipped"]
+    )
+
+
+def has_same_events(denormalized, record):
+    '''
+    Checks whether a record from the denormalized index holds the same
+    events as the given denormalized record, events being compared by
+    their record IDs
+    '''
+    if denormalized.get("overlaps") != record["overlaps"]:
+        return False
+
+    record_ids = [event.get("record_id") for event in record["events"]]
+    if None in record_ids:
+        return False
+
+    return sorted(record_ids) == sorted(
+        event.get("record_id") for event in denormalized.get("events", []))
+
+
 def get_index_command(data_loader, record):
     '''
     given a record, returns the header needed to re-index it,
@@ -599,13 +1140,29 @@ def get_index_command(data_loader, record):
     }
 
 
-def get_mappings(document_type):
-    ''' returns the mappings for the de-normalized index  '''
+def has_record_sources(data_loader_dst):
+    '''
+    Checks whether the denormalized index keeps the sources of its records,
+    which the update API needs
+    '''
+    mappings = data_loader_dst.es_tools.get_mappings()
+    for index_mappings in mappings.values():
+        for mapping in index_mappings["mappings"].values():
+            if not mapping.get("_source", {}).get("enabled", True):
+                return False
+    return True
+
+
+def get_mappings(document_type, partial_update=False):
+    '''
+    returns the mappings for the de-normalized index, which keeps the
+    sources of its records for partial updates only
+    '''
     return {
         "mappings": {
             document_type: {
                 "_source": {
-                    "enabled": False
+                    "enabled": partial_update
                 },
                 "dynamic_templates": [
                     {
@@ -698,18 +1255,16 @@ def get_mappings(document_type):
 SINGLE CELL DENORMALIZATION
 '''
 
-def is_single_cell_data(data_loader, source):
+def get_single_cell_query(source):
     '''
-    Determines whether the source is single cell data
+    Returns the search for single cell records from the given source
     '''
-    query = {
+    return {
         "query": {
             "filtered": {
                 "filter": {
                     "bool": {
-                        "must": [{
-                            "match": source
-                        },
+                        "must": [get_source_clause(source),
                         {
                             "exists": {
                                 "field": "cell_id"
@@ -718,20 +1273,16 @@ def is_single_cell_data(data_loader, source):
                     }
                 }
             }
-        }
+        },
+        "size": 0
     }
 
-    results = data_loader.es_tools.raw_search(query)
 
-    return results["hits"]["total"] != 0
-
-
-
-def has_single_cell_qc_data(data_loader):
+def get_single_cell_qc_query():
     '''
-    Determines whether the index contains QC data
+    Returns the search for single cell QC records
     '''
-    query = {
+    return {
         "query": {
             "filtered": {
                 "filter": {
@@ -744,10 +1295,38 @@ def has_single_cell_qc_data(data_loader):
                     }
                 }
             }
-        }
+        },
+        "size": 0
     }
 
-    results = data_loader.es_tools.raw_search(query)
+
+def get_single_cell_flags(data_loader, source):
+    '''
+    Determines whether the source is single cell data and whether the index
+    contains QC data, using a single request
+    '''
+    [sc_results, qc_results] = data_loader.es_tools.msearch([
+        get_single_cell_query(source),
+        get_single_cell_qc_query()
+    ])
+
+    return sc_results["hits"]["total"] != 0, qc_results["hits"]["total"] != 0
+
+
+def is_single_cell_data(data_loader, source):
+    '''
+    Determines whether the source is single cell data
+    '''
+    results = data_loader.es_tools.raw_search(get_single_cell_query(source))
+
+    return results["hits"]["total"] != 0
+
+
+def has_single_cell_qc_data(data_loader):
+    '''
+    Determines whether the index contains QC data
+    '''
+    results = data_loader.es_tools.raw_search(get_single_cell_qc_query())
 
     return results["hits"]["total"] != 0
 
@@ -757,14 +1336,15 @@ def has_single_cell_qc_data(data_loader):
 def process_sc_chrom(params): 
     '''
     Generates events field for denormalized records by chromosome
-    (on seg/bin data)
+    (on seg/bin data), using a server side reindex unless partially
+    updating the records, and by chromosome if the reindex fails
 
     '''
-
-    chrom_nums = [str(i).zfill(2) for i in range(1, 23)] + ["x", "X", "y", "Y", "NONE"]
+    if not params["partial_update"] and reindex_sc_records(params):
+        return
 
     process_params = []
-    for chrom_number in chrom_nums:
+    for chrom_number in SC_CHROM_NUMBERS:
         process_params.append(copy.deepcopy(params))
         process_params[-1]["chrom_number"] = chrom_number
 
@@ -776,7 +1356,7 @@ def process_sc_chrom(params):
         num_processes = MAX_PROCESSES
 
     if num_processes:
-        process_pool = Pool(processes=num_processes)
+        process_pool = get_process_pool(num_processes, params["host"])
         process_pool.map(pool_sc_chrom, process_params)
         process_pool.close()
         process_pool.terminate()
@@ -813,7 +1393,8 @@ def pool_sc_chrom(params):
             data_loader,
             data_loader_dst,
             params["source"],
-            params["chrom_number"])
+            params["chrom_number"],
+            params["partial_update"])
 
     except Exception:
         error_message = "An error has occurred while de-normalizing " +\
@@ -822,57 +1403,155 @@ def pool_sc_chrom(params):
         logging.error(error_message)
         logging.error(traceback.format_exc(traceback.extract_stack()))
         logging.error("#" * len(error_message))
+    finally:
+        export_metrics()
 
 
-def denormalize_sc_chrom(data_loader, data_loader_dst, source, chrom_number):
+def denormalize_sc_chrom(
+        data_loader, data_loader_dst, source, chrom_number,
+        partial_update=False):
     '''
     Processes the records in a given chromosome and loads them into denormalized index.
+    With partial_update, only records missing from it or with events are rewritten
 
     '''
     start_time = timeit.default_timer()
-    overlapping_sets = {}
-    buffered_values = []
-    buffer_size = 0
-    header_size = 140
-    max_buffer_size = 4*1024000
-    batch_size = 4000
-
+    counts = {"records": 0}
 
     query = get_sc_records_query(chrom_number, source)
 
-    results = data_loader.es_tools.scan(query)
+    results = data_loader.es_tools.parallel_scan(query)
 
-    results_count = 0
+    actions = get_sc_chrom_actions(data_loader_dst, results, counts)
+    if partial_update:
+        actions = get_update_actions(data_loader_dst, actions)
+
+    for _ in data_loader_dst.es_tools.parallel_bulk_to_es(actions):
+        pass
+
+    end_time = timeit.default_timer()
 
+    logging.debug("Processed chr %s: %d records in %d seconds (%s)",
+        chrom_number,
+        counts["records"],
+        end_time - start_time,
+        time.ctime())
+
+
+def get_sc_chrom_actions(data_loader_dst, results, counts):
+    '''
+    yields the index commands and records with no overlapping events for
+    the given search results
+    '''
     for record in results:
         index_record = copy.deepcopy(record)
         index_record["_source"]["events"] = []
         index_record["_source"]["overlaps"] = 0
 
-        results_count += 1
+        counts["records"] += 1
 
-        # push to buffer
-        buffer_size += index_record["_size"] + header_size
-        buffered_values.append(
-            get_index_command(data_loader_dst, record)
+        yield (
+            get_index_command(data_loader_dst, record),
+            index_record["_source"]
         )
-        buffered_values.append(index_record["_source"])
 
-        if len(buffered_values) >= batch_size or buffer_size > max_buffer_size:
-            data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
-            buffered_values = []
-            buffer_size = 0
 
-    if len(buffered_values) > 0:
-        data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
+def reindex_sc_records(params):
+    '''
+    Copies the single cell records from the source into the denormalized
+    index with a server side reindex, which sets their events. Returns
+    whether the reindex has succeeded
+    '''
+    data_loader = AnalysisLoader(
+        es_index=params["index"],
+        es_doc_type=params["doc_type"],
+        es_host=params["host"],
+        es_port=params["port"],
+        use_ssl=params["use_ssl"],
+        http_auth=params["http_auth"],
+        timeout=TIMEOUT)
+    es_tools = data_loader.es_tools
 
-    end_time = timeit.default_timer()
+    start_time = timeit.default_timer()
+    query = {
+        "bool": {
+            "must": [
+                {
+                    "bool": {
+                        "should": [
+                            {"match": {"chrom_number": chrom_number}}
+                            for chrom_number in SC_CHROM_NUMBERS]
+                    }
+                },
+                get_source_clause(params["source"])
+            ]
+        }
+    }
 
-    logging.debug("Processed chr %s: %d records in %d seconds (%s)",
-        chrom_number,
-        results_count,
-        end_time - start_time,
+    try:
+        task_id = es_tools.reindex(
+            params["dst_index"],
+            query,
+            SC_EVENTS_SCRIPT,
+            requests_per_second=params["requests_per_second"],
+            slices=es_tools.get_shard_count())
+        logging.info("Started reindex task %s.", task_id)
+
+        (completed, status) = es_tools.get_task(task_id)
+        while not completed:
+            logging.info(
+                "Reindexed %d of %d records.",
+                status.get("created", 0) + status.get("updated", 0),
+                status.get("total", 0))
+            time.sleep(REINDEX_POLL_INTERVAL)
+            (completed, status) = es_tools.get_task(task_id)
+    except Exception as e:
+        logging.warn("Server side reindex failed, %s.", e)
+        return False
+
+    if status.get("failures"):
+        logging.warn(
+            "Server side reindex failed, %s.", status["failures"][0])
+        return False
+
+    # Before Elastic search 5.0, completed tasks aren't listed anymore and
+    # their outcome is unknown, it is checked by counting the records copied
+    if "failures" not in status and \
+            not has_reindexed_records(params, es_tools, query):
+        return False
+
+    logging.debug(
+        "Reindexed the records from source %s in %d seconds (%s)",
+        str(params["source"]),
+        timeit.default_timer() - start_time,
         time.ctime())
+    return True
+
+
+def has_reindexed_records(params, es_tools, query):
+    '''
+    Checks whether the denormalized index holds as many records matching
+    the reindex query as the source index
+    '''
+    data_loader_dst = AnalysisLoader(
+        es_index=params["dst_index"],
+        es_doc_type=params["doc_type"],
+        es_host=params["host"],
+        es_port=params["port"],
+        use_ssl=params["use_ssl"],
+        http_auth=params["http_auth"],
+        timeout=TIMEOUT)
+    data_loader_dst.es_tools.refresh_index()
+
+    record_count = es_tools.count(query)["count"]
+    record_count_dst = data_loader_dst.es_tools.count(query)["count"]
+    if record_count_dst != record_count:
+        logging.warn(
+            "Server side reindex failed, %d of %d records copied.",
+            record_count_dst,
+            record_count)
+        return False
+    return True
 
 
 def get_sc_records_query(chrom_number, source):
@@ -881,7 +1560,7 @@ def get_sc_records_query(chrom_number, source):
     '''
     must_terms = [{"match": {"chrom_number": chrom_number}}]
 
-    must_terms.append({"match": source})
+    must_terms.append(get_source_clause(source))
 
     query =  {
         "query": {
@@ -916,7 +1595,7 @@ def process_sc_qc(params):
         num_processes = MAX_PROCESSES
 
     if num_processes:
-        process_pool = Pool(processes=num_processes)
+        process_pool = get_process_pool(num_processes, params["host"])
         process_pool.map(pool_sc_qc, process_params)
         process_pool.close()
         process_pool.terminate()
@@ -955,7 +1634,8 @@ def pool_sc_qc(params):
             data_loader_dst,
             params["source"],
             params["column"],
-            params["is_qc"])
+            params["is_qc"],
+            params["partial_update"])
 
     except Exception:
         error_message = "An error has occurred while de-normalizing " +\
@@ -964,44 +1644,66 @@ def pool_sc_qc(params):
         logging.error(error_message)
         logging.error(traceback.format_exc(traceback.extract_stack()))
         logging.error("#" * len(error_message))
+    finally:
+        export_metrics()
 
 
-def denormalize_sc_qc(data_loader, data_loader_dst, source, column, is_qc):
+def denormalize_sc_qc(
+        data_loader, data_loader_dst, source, column, is_qc,
+        partial_update=False):
     '''
     Processes the records in a given column and loads them into denormalized index.
+    With partial_update, only the records whose events changed are rewritten
 
     '''
     start_time = timeit.default_timer()
-    overlapping_sets = {}
-    buffered_values = []
-    buffer_size = 0
-    header_size = 140
-    max_buffer_size = 4*1024000
-    batch_size = 4000
-
+    counts = {"cells": 0, "overlapping": 0}
 
     query = get_qc_col_records_query(column)
 
-    results = data_loader.es_tools.scan(query)
+    results = data_loader.es_tools.parallel_scan(query)
 
-    cell_count = 0
-    overlapping_count = 0
+    actions = get_sc_qc_actions(
+        data_loader, data_loader_dst, results, source, is_qc, counts,
+        partial_update)
+    if partial_update:
+        actions = get_update_actions(data_loader_dst, actions)
 
+    for _ in data_loader_dst.es_tools.parallel_bulk_to_es(actions):
+        pass
 
+    end_time = timeit.default_timer()
+
+    logging.debug("Processed column %s: %d records with %d overlapping in %d seconds (%s)",
+        column,
+        counts["cells"],
+        counts["overlapping"],
+        end_time - start_time,
+        time.ctime())
+
+
+def get_sc_qc_actions(
+        data_loader, data_loader_dst, results, source, is_qc, counts,
+        record_ids=False):
+    '''
+    yields the index commands and records for the given QC records and
+    the single cell records matching their cell IDs. With record_ids, the
+    QC events hold the IDs of their records
+    '''
     for qc_record in results:
-        cell_count += 1
+        counts["cells"] += 1
+        if record_ids:
+            qc_record["_source"]["record_id"] = qc_record["_id"]
 
         if (is_qc): 
             qc_index_record = copy.deepcopy(qc_record)
             qc_index_record["_source"]["events"] = []
             qc_index_record["_source"]["overlaps"] = 0
 
-            buffer_size += qc_index_record["_size"] + header_size
-            buffered_values.append(
-                get_index_command(data_loader_dst, qc_record)
+            yield (
+                get_index_command(data_loader_dst, qc_record),
+                qc_index_record["_source"]
             )
-            buffered_values.append(qc_index_record["_source"])
-
 
         cell_query = get_overlapping_sc_query(qc_record, source, is_qc)
         overlap_results = data_loader.es_tools.scan(cell_query)
@@ -1010,37 +1712,12 @@ def denormalize_sc_qc(data_loader, data_loader_dst, source, column, is_qc):
             index_record = copy.deepcopy(overlap_record)
             index_record["_source"]["events"] = [qc_record["_source"]]
             index_record["_source"]["overlaps"] = 1
-            overlapping_count += 1
-
-            buffer_size += qc_record["_size"] + index_record["_size"] + header_size
+            counts["overlapping"] += 1
 
-            buffered_values.append(
-                get_index_command(data_loader_dst, overlap_record)
+            yield (
+                get_index_command(data_loader_dst, overlap_record),
+                index_record["_source"]
             )
-            buffered_values.append(index_record["_source"])
-
-            if len(buffered_values) >= batch_size or buffer_size > max_buffer_size:
-                data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
-                buffered_values = []
-                buffer_size = 0
-
-
-        if len(buffered_values) >= batch_size or buffer_size > max_buffer_size:
-            data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
-            buffered_values = []
-            buffer_size = 0
-
-    if len(buffered_values) > 0:
-        data_loader_dst.es_tools.submit_bulk_to_es(buffered_values)
-
-    end_time = timeit.default_timer()
-
-    logging.debug("Processed column %s: %d records with %d overlapping in %d seconds (%s)",
-        column,
-        cell_count,
-        overlapping_count,
-        end_time - start_time,
-        time.ctime())
 
 
 def get_qc_col_records_query(column):
@@ -1078,9 +1755,7 @@ def get_overlapping_sc_query(qc_record, source, is_qc):
     '''
     single_cell_id = qc_record["_source"]["cell_id"]
 
-    source_query = {
-                    "match": source
-                }
+    source_query = get_source_clause(source)
     query =  {
         "query": {
             "bool": {
@@ -1106,6 +1781,248 @@ def get_overlapping_sc_query(qc_record, source, is_qc):
 
 
 
+import random
+import unittest
+
+
+class DenormalizeIndexTests(unittest.TestCase):
+
+    # The tests run against the Elastic search server given by ES_TEST_HOST
+    # and ES_TEST_PORT, ES_TEST_HOST=memory runs them in memory
+    host = os.environ.get("ES_TEST_HOST", "localhost")
+    port = int(os.environ.get("ES_TEST_PORT", 9200))
+
+    def get_loader(self, index, doc_type="dntest"):
+        ''' returns a loader of the given test index '''
+        return AnalysisLoader(
+            es_index=index,
+            es_doc_type=doc_type,
+            es_host=self.host,
+            es_port=self.port)
+
+    @staticmethod
+    def get_denormalized_record(record_id, event_ids):
+        ''' returns a denormalized record with the given events '''
+        return {
+            "_type": "dntest",
+            "_id": record_id,
+            "_source": {
+                "caller": "dntest",
+                "record_id": record_id,
+                "events": [
+                    {"caller": "dntest", "record_id": event_id}
+                    for event_id in event_ids],
+                "overlaps": len(event_ids)
+            }
+        }
+
+    def test_partitions(self):
+        global numpy
+        numpy_module = numpy
+        for engine_numpy in [numpy_module, None]:
+            numpy = engine_numpy
+            try:
+                self.check_partitions()
+            finally:
+                numpy = numpy_module
+
+    def check_partitions(self):
+        ''' checks the partitions of sorted positions '''
+        # Touching records overlap, the intervals being cut between clusters
+        self.failUnless(
+            get_partitions([1, 10, 30], [10, 20, 40], 0, 100, 3) ==
+            [{"min": 1, "max": 30}, {"min": 30, "max": 31}])
+        # A single cluster isn't cut
+        self.failUnless(
+            get_partitions([1, 5, 50], [100, 10, 200], 0, 300, 4) ==
+            [{"min": 1, "max": 51}])
+        # No more intervals than records
+        self.failUnless(
+            get_partitions([1, 5], [2, 6], 0, 100, 10) ==
+            [{"min": 1, "max": 5}, {"min": 5, "max": 6}])
+        # Clusters out of the range are left out, those reaching into it kept
+        self.failUnless(
+            get_partitions([1, 3, 5, 100], [2, 8, 6, 200], 4, 50, 2) ==
+            [{"min": 3, "max": 6}])
+        self.failUnless(get_partitions([1], [2], 4, 50, 2) == [])
+        self.failUnless(get_partitions([], [], 0, 100, 2) == [])
+        # A record shorter than the one before it doesn't end the cluster
+        self.failUnless(
+            get_clusters([1, 2, 5, 20], [10, 3, 7, 30]) ==
+            [(1, 5, 10, 3), (20, 20, 30, 1)])
+
+    def get_engine_events(self, data_loader, source, engine, lazy_sources):
+        '''
+        denormalizes the records of a source with the given engine, returns
+        the overlaps and event IDs of the denormalized records, by ID
+        '''
+        data_loader_dst = self.get_loader("dntest_denormalized")
+        data_loader_dst.es_tools.delete_index()
+        # The sources are kept to read the events back
+        data_loader_dst.create_index(get_mappings("dntest", True))
+
+        data_intervals = get_data_intervals(data_loader, source)
+        for (chrom_number, intervals) in data_intervals.items():
+            for interval in intervals:
+                process_interval(
+                    data_loader, data_loader_dst, interval, chrom_number,
+                    source, engine, lazy_sources)
+        data_loader_dst.es_tools.refresh_index()
+
+        results = data_loader_dst.es_tools.raw_search(
+            {"query": {"match_all": {}}, "size": 1000})
+        return dict(
+            (hit["_id"], (
+                hit["_source"]["overlaps"],
+                sorted(event["record_id"]
+                       for event in hit["_source"]["events"])))
+            for hit in results["hits"]["hits"])
+
+    @unittest.skipUnless(
+        os.environ.get("ES_TEST_HOST") == FAKE_HOST, "needs the memory host")
+    def test_overlap_engines(self):
+        data_loader = self.get_loader("dntest")
+        random_generator = random.Random(1)
+        for with_cells in [False, True]:
+            data_loader.es_tools.delete_index()
+            records = {}
+            bulk_records = []
+            for idx in range(200):
+                start = random_generator.randint(1, 20000)
+                record = {
+                    "chrom_number": random_generator.choice(["01", "02"]),
+                    "start": start,
+                    "end": start + random_generator.randint(0, 1500),
+                    "source_id": random_generator.choice(["s1", "s2"])
+                }
+                if with_cells:
+                    record["cell_id"] = random_generator.choice(["c1", "c2"])
+                records["r%d" % idx] = record
+                bulk_records.append(
+                    {"index": {"_type": "dntest", "_id": "r%d" % idx}})
+                bulk_records.append(record)
+            data_loader.es_tools.submit_bulk_to_es(bulk_records)
+            data_loader.es_tools.refresh_index()
+
+            source = {"source_id": "s1"}
+            tree_events = self.get_engine_events(
+                data_loader, source, TREE_ENGINE, False)
+            self.failUnless(any(
+                overlaps for (overlaps, _) in tree_events.values()))
+            if numpy is not None:
+                self.failUnless(tree_events == self.get_engine_events(
+                    data_loader, source, NUMPY_ENGINE, False))
+                self.failUnless(tree_events == self.get_engine_events(
+                    data_loader, source, NUMPY_ENGINE, True))
+
+            # All records of the source are rewritten, with their events
+            # on the same chromosome and cell only
+            for (record_id, record) in records.items():
+                if record["source_id"] == "s1":
+                    self.failUnless(record_id in tree_events)
+            for (record_id, (overlaps, event_ids)) in tree_events.items():
+                self.failUnless(overlaps == len(event_ids))
+                for event_id in event_ids:
+                    for field in ["chrom_number", "cell_id"]:
+                        self.failUnless(
+                            records[event_id].get(field) ==
+                            records[record_id].get(field))
+
+    @unittest.skipUnless(
+        os.environ.get("ES_TEST_HOST") == FAKE_HOST, "needs the memory host")
+    def test_partial_update(self):
+        data_loader_dst = self.get_loader("dntest_denormalized")
+        data_loader_dst.es_tools.delete_index()
+        data_loader_dst.create_index(get_mappings("dntest"))
+        # The record sources are only kept for partial updates
+        self.failIf(has_record_sources(data_loader_dst))
+        data_loader_dst.es_tools.delete_index()
+        data_loader_dst.create_index(get_mappings("dntest", True))
+        self.failUnless(has_record_sources(data_loader_dst))
+
+        records = [
+            self.get_denormalized_record("r1", ["e1"]),
+            self.get_denormalized_record("r2", ["e1", "e2"])]
+        bulk_records = []
+        for record in records:
+            bulk_records.append(get_index_command(data_loader_dst, record))
+            bulk_records.append(record["_source"])
+        data_loader_dst.es_tools.submit_bulk_to_es(bulk_records)
+        data_loader_dst.es_tools.refresh_index()
+
+        records = [
+            self.get_denormalized_record("r1", ["e1"]),
+            self.get_denormalized_record("r2", ["e2"]),
+            self.get_denormalized_record("r3", ["e3"])]
+        actions = list(get_update_actions(data_loader_dst, [
+            (get_index_command(data_loader_dst, record), record["_source"])
+            for record in records]))
+
+        # r1 is skipped, r2 has its events updated and r3 is indexed
+        self.failUnless(
+            [(command.keys()[0], command.values()[0]["_id"])
+             for (command, _) in actions] ==
+            [("update", "r2"), ("index", "r3")])
+        self.failUnless(actions[0][1] == {
+            "doc": {
+                "events": records[1]["_source"]["events"],
+                "overlaps": 1
+            },
+            "upsert": records[1]["_source"]})
+        self.failUnless(actions[1][1] == records[2]["_source"])
+
+        for _ in data_loader_dst.es_tools.parallel_bulk_to_es(actions):
+            pass
+        data_loader_dst.es_tools.refresh_index()
+        docs = data_loader_dst.es_tools.mget(
+            [("dntest", "r1"), ("dntest", "r2"), ("dntest", "r3")])
+        self.failUnless(
+            [doc["_source"] for doc in docs] ==
+            [record["_source"] for record in records])
+
+    @unittest.skipUnless(
+        os.environ.get("ES_TEST_HOST") == FAKE_HOST, "needs the memory host")
+    def test_reindex_verification(self):
+        data_loader = self.get_loader("dntest")
+        data_loader.es_tools.delete_index()
+        data_loader_dst = self.get_loader("dntest_denormalized")
+        data_loader_dst.es_tools.delete_index()
+        data_loader_dst.create_index(get_mappings("dntest"))
+
+        bulk_records = []
+        for idx in range(10):
+            bulk_records.append({"index": {"_type": "dntest", "_id": str(idx)}})
+            bulk_records.append({
+                "chrom_number": "01", "start": idx, "end": idx + 1,
+                "cell_id": "c%d" % idx, "source_id": "dntest"})
+        data_loader.es_tools.submit_bulk_to_es(bulk_records)
+        data_loader.es_tools.refresh_index()
+
+        params = {
+            "index": "dntest",
+            "dst_index": "dntest_denormalized",
+            "doc_type": "dntest",
+            "host": self.host,
+            "port": self.port,
+            "use_ssl": False,
+            "http_auth": None,
+            "source": {"source_id": "dntest"},
+            "requests_per_second": None
+        }
+        # A reindex task failing without copying anything, as on Elastic
+        # search 2.x its status is gone once completed
+        es = data_loader.es_tools.es
+        es.reindex = lambda *args, **kwargs: {"task": "dntest:1"}
+        try:
+            self.failIf(reindex_sc_records(params))
+        finally:
+            del es.reindex
+
+        self.failUnless(reindex_sc_records(params))
+        self.failUnless(
+            data_loader_dst.es_tools.count({"match_all": {}})["count"] == 10)
+
+
 def main():
     ''' main function '''
     argparser = argparse.ArgumentParser()
@@ -1157,6 +2074,41 @@ def main():
         help='Elastic search port number to connect to, default is 9200',
         type=int,
         default=9200)
+    argparser.add_argument(
+        '-e',
+        '--overlap-engine',
+        dest='overlap_engine',
+        action='store',
+        help='How overlapping records are found, using interval trees ' +
+        '(intervaltree, the default) or sorted position arrays (numpy)',
+        choices=[TREE_ENGINE, NUMPY_ENGINE],
+        type=str,
+        default=TREE_ENGINE)
+    argparser.add_argument(
+        '--lazy-sources',
+        dest='lazy_sources',
+        action='store_true',
+        help='If set, only the positions of the records are read ahead, ' +
+        'the sources being fetched in batches as the records are ' +
+        'rewritten, using the numpy engine',
+        default=False)
+    argparser.add_argument(
+        '--partial-update',
+        dest='partial_update',
+        action='store_true',
+        help='If set, records already in the denormalized index only ' +
+        'have their events and overlaps updated, and are skipped if ' +
+        'these have not changed. The denormalized index then keeps the ' +
+        'record sources',
+        default=False)
+    argparser.add_argument(
+        '--requests-per-second',
+        dest='requests_per_second',
+        action='store',
+        help='Throttle of the server side reindex copying single cell ' +
+        'records, in sub-requests per second, unthrottled by default',
+        type=float,
+        default=None)
     args = argparser.parse_args()
 
     # Set logging to console, default verbosity to INFO.
@@ -1196,7 +2148,11 @@ def main():
             doc_type=args.document_type,
             host=args.host,
             port=args.port,
-            source={"file_fullname": args.filename}
+            source={"file_fullname": args.filename},
+            overlap_engine=args.overlap_engine,
+            lazy_sources=args.lazy_sources,
+            partial_update=args.partial_update,
+            requests_per_second=args.requests_per_second
         )
 
 
@@ -0,0 +1,1303 @@
+'''
+In-memory stand-in for the Elastic search client
+
+Implements the subset of the elasticsearch-py client API used by the
+loaders: bulk, index, get, mget, delete, search (bool, filtered,
+constant_score, match, term(s), range, exists, missing and ids queries,
+post_filter, sort, min/max/avg/sum/value_count/cardinality/terms/filter(s)
+aggregations), msearch, count, scan/scroll (with _shards preference),
+reindex (with scripts assigning constant values), tasks, mappings (with
+_source enabled/includes/excludes), aliases, settings, refresh and
+forcemerge. Documents are visible as soon as they are written, string
+values are matched exactly, as the loaders map them not_analyzed.
+
+The backend is selected by connecting to host FAKE_HOST, all such
+connections of a process share a single in-memory cluster. Each request is
+counted and its body size recorded, an optional simulated latency is added
+to every request, so that the Python side of the loaders can be profiled
+and benchmarked deterministically without a cluster.
+
+'''
+
+from __future__ import division
+from collections import OrderedDict
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import RequestError
+from elasticsearch.exceptions import TransportError
+import threading
+import fnmatch
+import copy
+import json
+import time
+import zlib
+import uuid
+
+# Host name selecting the in-memory backend
+FAKE_HOST = "memory"
+
+DEFAULT_SHARDS = 5
+
+try:
+    STRING_TYPES = (str, unicode)
+    NUMBER_TYPES = (int, long, float)
+except NameError:
+    STRING_TYPES = (str, )
+    NUMBER_TYPES = (int, float)
+
+
+class FakeIndex(object):
+
+    '''
+    Holds the documents, mappings and settings of an index
+    '''
+
+    def __init__(self, name, settings=None, mappings=None):
+        self.name = name
+        self.settings = {
+            "number_of_shards": DEFAULT_SHARDS,
+            "number_of_replicas": 1
+        }
+        if settings:
+            self.settings.update(_flatten_settings(settings))
+        self.mappings = copy.deepcopy(mappings) if mappings else {}
+        # documents by (doc type, id), in indexing order
+        self.docs = OrderedDict()
+        self.versions = {}
+
+    def get_shard_count(self):
+        ''' Returns the number of shards of the index '''
+        return int(self.settings["number_of_shards"])
+
+    def get_shard(self, doc_id):
+        ''' Returns the shard a document is routed to '''
+        return zlib.crc32(doc_id.encode("utf-8")) % self.get_shard_count()
+
+    def put(self, doc_type, doc_id, source):
+        ''' Adds or replaces a document, returns whether it was created '''
+        key = (doc_type, doc_id)
+        created = key not in self.docs
+        self.docs[key] = source
+        self.versions[key] = self.versions.get(key, 0) + 1
+        if doc_type not in self.mappings:
+            self.mappings[doc_type] = {"properties": {}}
+        return created
+
+    def get_stored_source(self, doc_type, source):
+        '''
+        Returns the part of a document source kept by the _source mapping of
+        its type, None if the _source is disabled. The whole source is still
+        searchable, as its fields are indexed
+        '''
+        mapping = self.mappings.get(doc_type, {}).get("_source", {})
+        if not mapping.get("enabled", True):
+            return None
+        if mapping.get("includes") or mapping.get("excludes"):
+            return _filter_source(source, mapping)
+        return source
+
+
+class FakeIndices(object):
+
+    '''
+    Index management API
+    '''
+
+    def __init__(self, client):
+        self.__client__ = client
+
+    def create(self, index, body=None, **kwargs):
+        ''' Creates an index '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.create", body)
+            if index in client.data or index in client.aliases:
+                return client.error(
+                    400, "index_already_exists_exception",
+                    "already exists", index, kwargs)
+            body = body or {}
+            client.data[index] = FakeIndex(
+                index, body.get("settings"), body.get("mappings"))
+            return {"acknowledged": True}
+
+    def delete(self, index, **kwargs):
+        ''' Deletes one or more indices '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.delete")
+            try:
+                names = client.resolve(index, aliases=False)
+            except NotFoundError:
+                if 404 in _ignored(kwargs):
+                    return {}
+                raise
+            for name in names:
+                del client.data[name]
+                for alias in client.aliases.values():
+                    alias.discard(name)
+            return {"acknowledged": True}
+
+    def exists(self, index, **kwargs):
+        ''' Checks whether an index or alias exists '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.exists")
+            try:
+                return bool(client.resolve(index))
+            except NotFoundError:
+                return False
+
+    def exists_type(self, index, doc_type, **kwargs):
+        ''' Checks whether a document type exists '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.exists_type")
+            try:
+                names = client.resolve(index)
+            except NotFoundError:
+                return False
+            doc_types = _split(doc_type)
+            return any(
+                name in doc_types
+                for index_name in names
+                for name in client.data[index_name].mappings)
+
+    def put_mapping(self, body, index=None, doc_type=None, **kwargs):
+        ''' Adds or updates the mapping of a document type '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.put_mapping", body)
+            if doc_type in body and len(body) == 1:
+                body = body[doc_type]
+            for name in client.resolve(index):
+                mappings = client.data[name].mappings
+                mapping = mappings.setdefault(doc_type, {"properties": {}})
+                for key, value in body.items():
+                    if key == "properties":
+                        mapping.setdefault("properties", {}).update(
+                            copy.deepcopy(value))
+                    else:
+                        mapping[key] = copy.deepcopy(value)
+            return {"acknowledged": True}
+
+    def get_mapping(self, index=None, doc_type=None, **kwargs):
+        ''' Returns the mappings of the given indices '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.get_mapping")
+            doc_types = _split(doc_type)
+            result = {}
+            for name in client.resolve(index):
+                result[name] = {"mappings": dict(
+                    (key, copy.deepcopy(value))
+                    for key, value in client.data[name].mappings.items()
+                    if not doc_types or key in doc_types)}
+            return result
+
+    def put_settings(self, body, index=None, **kwargs):
+        ''' Updates the settings of the given indices '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.put_settings", body)
+            for name in client.resolve(index):
+                client.data[name].settings.update(_flatten_settings(body))
+            return {"acknowledged": True}
+
+    def get_settings(self, index=None, **kwargs):
+        ''' Returns the settings of the given indices '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.get_settings")
+            result = {}
+            for name in client.resolve(index):
+                result[name] = {"settings": {"index": dict(
+                    (key, str(value)) for key, value in
+                    client.data[name].settings.items())}}
+            return result
+
+    def refresh(self, index=None, **kwargs):
+        ''' Documents are visible right away, only counts the request '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.refresh")
+            names = client.resolve(index)
+            return {"_shards": client.shards(names)}
+
+    def forcemerge(self, index=None, **kwargs):
+        ''' Nothing to merge, only counts the request '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.forcemerge")
+            names = client.resolve(index)
+            return {"_shards": client.shards(names)}
+
+    def put_alias(self, index, name, **kwargs):
+        ''' Adds the given indices to an alias '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.put_alias")
+            names = client.resolve(index, aliases=False)
+            client.aliases.setdefault(name, set()).update(names)
+            return {"acknowledged": True}
+
+    def exists_alias(self, index=None, name=None, **kwargs):
+        ''' Checks whether an alias exists '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.exists_alias")
+            return name in client.aliases and bool(client.aliases[name])
+
+    def get_alias(self, index=None, name=None, **kwargs):
+        ''' Returns the aliases of the given indices '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.get_alias")
+            names = client.resolve(index) if index else client.data.keys()
+            result = {}
+            for alias, alias_indices in client.aliases.items():
+                if name and not fnmatch.fnmatch(alias, name):
+                    continue
+                for index_name in alias_indices:
+                    if index_name in names:
+                        result.setdefault(
+                            index_name, {"aliases": {}})["aliases"][alias] = {}
+            if name and not result:
+                raise NotFoundError(
+                    404, "alias_not_found_exception", {"alias": name})
+            return result
+
+    def delete_alias(self, index, name, **kwargs):
+        ''' Removes the given indices from an alias '''
+        client = self.__client__
+        with client.lock:
+            client.record("indices.delete_alias")
+            if name not in client.aliases:
+                raise NotFoundError(
+                    404, "aliases_not_found_exception", {"alias": name})
+            for index_name in client.resolve(index, aliases=False):
+                client.aliases[name].discard(index_name)
+            return {"acknowledged": True}
+
+    def update_aliases(self, body, **kwargs):
+        ''' Applies a list of alias actions '''
+        for action in body.get("actions", []):
+            for (action_type, params) in action.items():
+                if action_type == "add":
+                    self.put_alias(params["index"], params["alias"])
+                elif action_type == "remove":
+                    self.delete_alias(params["index"], params["alias"])
+        return {"acknowledged": True}
+
+
+class FakeCluster(object):
+
+    '''
+    Cluster API
+    '''
+
+    def __init__(self, client):
+        self.__client__ = client
+
+    def health(self, **kwargs):
+        ''' Reports a single node green cluster '''
+        client = self.__client__
+        with client.lock:
+            client.record("cluster.health")
+            return {
+                "cluster_name": "fake",
+                "status": "green",
+                "timed_out": False,
+                "number_of_nodes": 1,
+                "number_of_data_nodes": 1
+            }
+
+
+class FakeTasks(object):
+
+    '''
+    Task management API, as tasks run synchronously none is ever listed
+    '''
+
+    def __init__(self, client):
+        self.__client__ = client
+
+    def list(self, task_id=None, **kwargs):
+        ''' Lists the running tasks, completed tasks are not found '''
+        client = self.__client__
+        with client.lock:
+            client.record("tasks.list")
+            if task_id:
+                return client.error(
+                    404, "resource_not_found_exception",
+                    "task [" + task_id + "] isn't running",
+                    None, kwargs)
+            return {"nodes": {}}
+
+
+class FakeElasticsearch(object):
+
+    '''
+    In-memory implementation of the Elastic search client API subset used
+    by the loaders. latency is added to every request, in seconds, and
+    latency_per_mb per megabyte of request body
+    '''
+
+    def __init__(self, latency=0.0, latency_per_mb=0.0):
+        self.lock = threading.RLock()
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb
+        # index data by name, the index management API being client.data
+        self.data = {}
+        self.aliases = {}
+        self.scrolls = {}
+        self.requests = {}
+        self.request_bytes = {}
+        self.indices = FakeIndices(self)
+        self.cluster = FakeCluster(self)
+        self.tasks = FakeTasks(self)
+
+    def record(self, operation, body=None):
+        '''
+        Counts a request and its body size, then waits for the simulated
+        latency
+        '''
+        nbytes = _body_size(body)
+        self.requests[operation] = self.requests.get(operation, 0) + 1
+        self.request_bytes[operation] = \
+            self.request_bytes.get(operation, 0) + nbytes
+        delay = self.latency + self.latency_per_mb * nbytes / 1024000
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_stats(self):
+        ''' Returns the request counts and body sizes by operation '''
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "bytes": dict(self.request_bytes),
+                "documents": dict(
+                    (name, len(index.docs))
+                    for name, index in self.data.items())
+            }
+
+    def reset(self):
+        ''' Removes all data and statistics '''
+        with self.lock:
+            self.data.clear()
+            self.aliases.clear()
+            self.scrolls.clear()
+            self.requests.clear()
+            self.request_bytes.clear()
+
+    def error(self, status, error_type, reason, index, kwargs):
+        ''' Raises a request error unless its status is ignored '''
+        if status in _ignored(kwargs):
+            return {"error": {"type": error_type, "reason": reason},
+                    "status": status}
+        error_class = NotFoundError if status == 404 else RequestError
+        raise error_class(
+            status, error_type,
+            {"error": {"type": error_type, "reason": reason, "index": index},
+             "status": status})
+
+    def resolve(self, index, aliases=True):
+        '''
+        Returns the names of the indices matching a comma separated list of
+        index names, aliases and wildcard expressions
+        '''
+        data = self.data
+        if index is None or index in ("_all", "*", ""):
+            return sorted(data.keys())
+        names = []
+        for name in _split(index):
+            if "*" in name:
+                matches = fnmatch.filter(data.keys(), name)
+                if aliases:
+                    for alias in fnmatch.filter(self.aliases.keys(), name):
+                        matches.extend(self.aliases[alias])
+            elif name in data:
+                matches = [name]
+            elif aliases and self.aliases.get(name):
+                matches = list(self.aliases[name])
+            else:
+                raise NotFoundError(
+                    404, "index_not_found_exception",
+                    {"error": {"type": "index_not_found_exception",
+                               "reason": "no such index", "index": name},
+                     "status": 404})
+            for match in sorted(matches):
+                if match not in names:
+                    names.append(match)
+        return names
+
+    def shards(self, names):
+        ''' Returns the _shards section of a response '''
+        total = sum(self.data[name].get_shard_count() for name in names)
+        return {"total": total, "successful": total, "failed": 0}
+
+    def bulk(self, body, index=None, doc_type=None, **kwargs):
+        '''
+        Executes index, create, update and delete actions given either as
+        an NDJSON string or a list of alternating actions and sources
+        '''
+        with self.lock:
+            self.record("bulk", body)
+            t0 = time.time()
+            lines = _parse_lines(body)
+            items = []
+            errors = False
+            idx = 0
+            while idx < len(lines):
+                (action, params) = list(lines[idx].items())[0]
+                idx += 1
+                source = None
+                if action != "delete":
+                    source = lines[idx]
+                    idx += 1
+                item = self._bulk_action(
+                    action, params, source, index, doc_type)
+                errors = errors or "error" in item
+                items.append({action: item})
+            return {
+                "took": int((time.time() - t0) * 1000),
+                "errors": errors,
+                "items": items
+            }
+
+    def _bulk_action(self, action, params, source, index, doc_type):
+        ''' Executes a single bulk action '''
+        index_name = params.get("_index", index)
+        type_name = params.get("_type", doc_type)
+        doc_id = params.get("_id")
+        result = {"_index": index_name, "_type": type_name, "_id": doc_id}
+        try:
+            names = self.resolve(index_name)
+            if len(names) != 1:
+                raise RequestError(
+                    400, "illegal_argument_exception",
+                    {"error": "alias points to several indices"})
+            target = self.data[names[0]]
+        except NotFoundError:
+            # indices are created on first use, same as with auto_create_index
+            target = self.data[index_name] = FakeIndex(index_name)
+        except RequestError as error:
+            result.update(status=400, error=error.info)
+            return result
+
+        key = (type_name, doc_id)
+        if action in ("index", "create"):
+            if doc_id is None:
+                doc_id = result["_id"] = _new_id()
+                key = (type_name, doc_id)
+            elif action == "create" and key in target.docs:
+                result.update(status=409, error={
+                    "type": "document_already_exists_exception"})
+                return result
+            created = target.put(type_name, doc_id, _copy(source))
+            result.update(
+                status=201 if created else 200, created=created,
+                _version=target.versions[key])
+        elif action == "update":
+            existing = target.docs.get(key)
+            if existing is None:
+                if "upsert" in source:
+                    new_source = _copy(source["upsert"])
+                elif source.get("doc_as_upsert"):
+                    new_source = _copy(source["doc"])
+                else:
+                    result.update(status=404, error={
+                        "type": "document_missing_exception"})
+                    return result
+            else:
+                existing = target.get_stored_source(type_name, existing)
+                if existing is None:
+                    result.update(status=400, error={
+                        "type": "document_source_missing_exception"})
+                    return result
+                new_source = _copy(existing)
+                new_source.update(_copy(source.get("doc", {})))
+            target.put(type_name, doc_id, new_source)
+            result.update(status=200, _version=target.versions[key])
+        elif action == "delete":
+            found = target.docs.pop(key, None) is not None
+            result.update(status=200 if found else 404, found=found)
+        else:
+            result.update(status=400, error={
+                "type": "action_request_validation_exception",
+                "reason": "unknown action " + action})
+        return result
+
+    def index(self, index, doc_type, body, id=None, **kwargs):
+        ''' Adds or replaces a document '''
+        with self.lock:
+            self.record("index", body)
+            names = self._resolve_or_create(index)
+            doc_id = id if id is not None else _new_id()
+            target = self.data[names[0]]
+            created = target.put(doc_type, doc_id, _copy(body))
+            return {
+                "_index": names[0], "_type": doc_type, "_id": doc_id,
+                "_version": target.versions[(doc_type, doc_id)],
+                "created": created
+            }
+
+    def _resolve_or_create(self, index):
+        ''' Resolves an index name, creating the index if missing '''
+        try:
+            return self.resolve(index)
+        except NotFoundError:
+            self.data[index] = FakeIndex(index)
+            return [index]
+
+    def get(self, index, id, doc_type="_all", **kwargs):
+        ''' Returns a document by ID '''
+        with self.lock:
+            self.record("get")
+            result = self._get(index, doc_type, id, kwargs.get("_source"))
+            if not result["found"]:
+                if 404 in _ignored(kwargs):
+                    return result
+                raise NotFoundError(404, "not_found", result)
+            return result
+
+    def _get(self, index, doc_type, doc_id, source_filter=None):
+        ''' Looks a document up in the given indices '''
+        for name in self.resolve(index):
+            target = self.data[name]
+            if doc_type in (None, "_all"):
+                type_names = [type_name for (type_name, key_id) in target.docs
+                              if key_id == doc_id]
+            else:
+                type_names = _split(doc_type)
+            for type_name in type_names:
+                source = target.docs.get((type_name, doc_id))
+                if source is None:
+                    continue
+                result = {
+                    "_index": name, "_type": type_name, "_id": doc_id,
+                    "_version": target.versions[(type_name, doc_id)],
+                    "found": True
+                }
+                source = target.get_stored_source(type_name, source)
+                if source_filter is not False and source is not None:
+                    result["_source"] = _filter_source(source, source_filter)
+                return result
+        return {"_index": index, "_type": doc_type, "_id": doc_id,
+                "found": False}
+
+    def mget(self, body, index=None, doc_type=None, **kwargs):
+        ''' Returns several documents by ID '''
+        with self.lock:
+            self.record("mget", body)
+            source_filter = kwargs.get("_source")
+            if "ids" in body:
+                docs = [{"_id": doc_id} for doc_id in body["ids"]]
+            else:
+                docs = body["docs"]
+            results = []
+            for doc in docs:
+                try:
+                    results.append(self._get(
+                        doc.get("_index", index),
+                        doc.get("_type", doc_type or "_all"),
+                        doc["_id"],
+                        doc.get("_source", source_filter)))
+                except NotFoundError as error:
+                    results.append({
+                        "_index": doc.get("_index", index),
+                        "_id": doc["_id"],
+                        "error": error.info})
+            return {"docs": results}
+
+    def delete(self, index, doc_type, id, **kwargs):
+        ''' Deletes a document '''
+        with self.lock:
+            self.record("delete")
+            for name in self.resolve(index):
+                if self.data[name].docs.pop((doc_type, id), None) is not None:
+                    return {"_index": name, "_type": doc_type, "_id": id,
+                            "found": True}
+            if 404 in _ignored(kwargs):
+                return {"found": False}
+            raise NotFoundError(404, "not_found", {"_id": id, "found": False})
+
+    def count(self, index=None, doc_type=None, body=None, **kwargs):
+        ''' Counts the documents matching a query '''
+        with self.lock:
+            self.record("count", body)
+            names = self.resolve(index)
+            query = (body or {}).get("query", {"match_all": {}})
+            total = sum(1 for _ in self._iter_docs(names, doc_type, query))
+            return {"count": total, "_shards": self.shards(names)}
+
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        ''' Searches the given indices '''
+        with self.lock:
+            self.record("search", body)
+            return self._search(index, doc_type, body or {}, kwargs)
+
+    def _search(self, index, doc_type, body, params):
+        ''' Executes a search, starting a scroll if requested '''
+        t0 = time.time()
+        names = self.resolve(index)
+        shards = None
+        preference = params.get("preference") or ""
+        if preference.startswith("_shards:"):
+            shards = set(int(shard) for shard in
+                         preference[len("_shards:"):].split(";")[0].split(","))
+        query = body.get("query", {"match_all": {}})
+
+        matches = list(self._iter_docs(names, doc_type, query, shards))
+        aggregations = None
+        aggs = body.get("aggs", body.get("aggregations"))
+        if aggs:
+            aggregations = _aggregate(aggs, [source for (_, source) in matches])
+        if "post_filter" in body:
+            matches = [match for match in matches
+                       if _matches(body["post_filter"], match[1])]
+
+        sort = body.get("sort", params.get("sort"))
+        if sort:
+            matches = _sort(matches, sort)
+
+        size = body.get("size", params.get("size", 10))
+        start = body.get("from", params.get("from_", 0))
+        hits = [self._get_hit(match, body, params) for match in matches]
+        if sort:
+            for hit, match in zip(hits, matches):
+                hit["sort"] = [
+                    _get_value(match[1], field)
+                    for field in _sort_fields(sort)]
+
+        response = {
+            "took": int((time.time() - t0) * 1000),
+            "timed_out": False,
+            "_shards": self.shards(names),
+            "hits": {"total": len(hits), "max_score": 1.0, "hits": []}
+        }
+        if aggregations is not None:
+            response["aggregations"] = aggregations
+
+        search_type = params.get("search_type")
+        if params.get("scroll"):
+            if search_type == "scan":
+                # scan returns size hits per shard with each scroll request
+                page_size = size * (len(shards) if shards is not None else
+                                    self.shards(names)["total"])
+                remaining = hits[start:]
+            else:
+                page_size = size
+                response["hits"]["hits"] = hits[start:start + size]
+                remaining = hits[start + size:]
+            scroll_id = _new_id()
+            self.scrolls[scroll_id] = (remaining, page_size, names)
+            response["_scroll_id"] = scroll_id
+        elif search_type != "count":
+            response["hits"]["hits"] = hits[start:start + size]
+        return response
+
+    def _iter_docs(self, names, doc_type, query, shards=None):
+        '''
+        Yields the (hit metadata, source) tuples of the documents matching
+        a query
+        '''
+        doc_types = _split(doc_type)
+        for name in names:
+            target = self.data[name]
+            for (type_name, doc_id), source in target.docs.items():
+                if doc_types and type_name not in doc_types:
+                    continue
+                if shards is not None and \
+                        target.get_shard(doc_id) not in shards:
+                    continue
+                if _matches(query, source, doc_id):
+                    yield ((name, type_name, doc_id), source)
+
+    def _get_hit(self, match, body, params):
+        ''' Formats a search hit '''
+        ((name, type_name, doc_id), source) = match
+        hit = {
+            "_index": name,
+            "_type": type_name,
+            "_id": doc_id,
+            "_score": 1.0
+        }
+        source_filter = body.get("_source", params.get("_source"))
+        fields = body.get("fields", body.get("stored_fields"))
+        if fields is not None:
+            fields = _split(fields)
+            if "_source" in fields and source_filter is None:
+                source_filter = True
+            elif source_filter is None:
+                source_filter = False
+            for field in fields:
+                if field == "_size":
+                    hit["_size"] = len(json.dumps(source))
+                    hit.setdefault("fields", {})["_size"] = hit["_size"]
+                elif field != "_source" and \
+                        _get_value(source, field) is not None:
+                    hit.setdefault("fields", {})[field] = \
+                        _as_list(_get_value(source, field))
+        for field in _split(body.get("fielddata_fields")):
+            if _get_value(source, field) is not None:
+                hit.setdefault("fields", {})[field] = \
+                    _as_list(_get_value(source, field))
+        source = self.data[name].get_stored_source(type_name, source)
+        if source_filter is not False and source is not None:
+            hit["_source"] = _filter_source(source, source_filter)
+        return hit
+
+    def scroll(self, scroll_id=None, body=None, scroll=None, **kwargs):
+        ''' Returns the next page of a scroll '''
+        with self.lock:
+            self.record("scroll")
+            if scroll_id is None:
+                scroll_id = body["scroll_id"]
+            if scroll_id not in self.scrolls:
+                raise NotFoundError(
+                    404, "search_context_missing_exception",
+                    {"scroll_id": scroll_id})
+            (remaining, page_size, names) = self.scrolls[scroll_id]
+            self.scrolls[scroll_id] = (remaining[page_size:], page_size, names)
+            return {
+                "_scroll_id": scroll_id,
+                "took": 0,
+                "timed_out": False,
+                "_shards": self.shards(
+                    [name for name in names if name in self.data]),
+                "hits": {"total": len(remaining), "max_score": 1.0,
+                         "hits": remaining[:page_size]}
+            }
+
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        ''' Releases scroll contexts '''
+        with self.lock:
+            self.record("clear_scroll")
+            if scroll_id is None:
+                scroll_id = (body or {}).get("scroll_id", [])
+            for scroll in _as_list(scroll_id):
+                for scroll in _split(scroll):
+                    self.scrolls.pop(scroll, None)
+            return {"succeeded": True}
+
+    def msearch(self, body, index=None, doc_type=None, **kwargs):
+        '''
+        Executes several searches given either as an NDJSON string or a
+        list of alternating headers and bodies
+        '''
+        with self.lock:
+            self.record("msearch", body)
+            lines = _parse_lines(body)
+            responses = []
+            for idx in range(0, len(lines), 2):
+                header = lines[idx]
+                params = dict(
+                    (key, value) for key, value in header.items()
+                    if key in ("search_type", "preference"))
+                try:
+                    responses.append(self._search(
+                        header.get("index", index),
+                        header.get("type", doc_type),
+                        lines[idx + 1],
+                        params))
+                except TransportError as error:
+                    responses.append({
+                        "error": error.info, "status": error.status_code})
+            return {"responses": responses}
+
+    def reindex(self, body, params=None, **kwargs):
+        '''
+        Copies the documents matching the source query into the destination
+        index, applying the script, the task completing before returning
+        '''
+        params = dict(params or {}, **kwargs)
+        with self.lock:
+            self.record("reindex", body)
+            t0 = time.time()
+            source = body["source"]
+            names = self.resolve(source["index"])
+            assignments = _parse_script(body.get("script"))
+            dest = body["dest"]["index"]
+            matches = list(self._iter_docs(
+                names, source.get("type"),
+                source.get("query", {"match_all": {}})))
+            target = self.data[self._resolve_or_create(dest)[0]]
+            counts = {"created": 0, "updated": 0}
+            for ((_, type_name, doc_id), doc) in matches:
+                doc = _copy(doc)
+                for (field, value) in assignments:
+                    doc[field] = _copy(value)
+                if target.put(type_name, doc_id, doc):
+                    counts["created"] += 1
+                else:
+                    counts["updated"] += 1
+
+            if str(params.get("wait_for_completion", "true")).lower() \
+                    == "false":
+                return {"task": "fake:" + _new_id()}
+            return {
+                "took": int((time.time() - t0) * 1000),
+                "total": len(matches),
+                "created": counts["created"],
+                "updated": counts["updated"],
+                "failures": []
+            }
+
+    def info(self, **kwargs):
+        ''' Returns the version information '''
+        return {"version": {"number": "2.4.1"}, "tagline": "fake"}
+
+    def ping(self, **kwargs):
+        ''' The backend is always available '''
+        return True
+
+
+def _matches(query, source, doc_id=None):
+    ''' Checks whether a document matches a query '''
+    if not query:
+        return True
+    for (query_type, params) in query.items():
+        if query_type == "match_all":
+            continue
+        elif query_type == "bool":
+            if not _matches_bool(params, source, doc_id):
+                return False
+        elif query_type == "filtered":
+            if not _matches(params.get("query"), source, doc_id) or \
+                    not _matches(params.get("filter"), source, doc_id):
+                return False
+        elif query_type == "constant_score":
+            if not _matches(
+                    params.get("filter", params.get("query")), source, doc_id):
+                return False
+        elif query_type in ("match", "term", "match_phrase"):
+            for (field, value) in params.items():
+                if isinstance(value, dict):
+                    value = value.get("query", value.get("value"))
+                if not _equals(_get_value(source, field), value):
+                    return False
+        elif query_type == "terms":
+            for (field, values) in params.items():
+                if not any(_equals(_get_value(source, field), value)
+                           for value in values):
+                    return False
+        elif query_type == "range":
+            for (field, bounds) in params.items():
+                if not _in_range(_get_value(source, field), bounds):
+                    return False
+        elif query_type == "exists":
+            if _is_missing(_get_value(source, params["field"])):
+                return False
+        elif query_type == "missing":
+            if not _is_missing(_get_value(source, params["field"])):
+                return False
+        elif query_type == "ids":
+            if doc_id not in params.get("values", []):
+                return False
+        elif query_type in ("and", "or", "not"):
+            filters = params.get("filters", params) \
+                if isinstance(params, dict) else params
+            results = [_matches(item, source, doc_id)
+                       for item in _as_list(filters)]
+            if (query_type == "and" and not all(results)) or \
+                    (query_type == "or" and not any(results)) or \
+                    (query_type == "not" and any(results)):
+                return False
+        else:
+            raise RequestError(
+                400, "query_parsing_exception",
+                {"error": "unsupported query type " + query_type})
+    return True
+
+
+def _matches_bool(params, source, doc_id):
+    ''' Checks whether a document matches a bool query '''
+    for clause in ("must", "filter"):
+        for item in _as_list(params.get(clause, [])):
+            if not _matches(item, source, doc_id):
+                return False
+    for item in _as_list(params.get("must_not", [])):
+        if _matches(item, source, doc_id):
+            return False
+    should = _as_list(params.get("should", []))
+    if should:
+        required = params.get("minimum_should_match")
+        if required is None:
+            required = 0 if params.get("must") or params.get("filter") else 1
+        matched = sum(1 for item in should if _matches(item, source, doc_id))
+        if matched < int(required):
+            return False
+    return True
+
+
+def _get_value(source, field):
+    '''
+    Returns the value of a possibly dotted field name, the values of all
+    objects for fields within arrays of objects
+    '''
+    value = source
+    for part in field.split("."):
+        if isinstance(value, list):
+            values = []
+            for item in value:
+                if isinstance(item, dict) and part in item:
+                    values.extend(_as_list(item[part]))
+            value = values or None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+        if value is None:
+            return None
+    return value
+
+
+def _equals(value, query_value):
+    ''' Compares a field value, or any of its values, with a query value '''
+    for item in _as_list(value):
+        if item == query_value:
+            return True
+        if isinstance(item, bool) or isinstance(query_value, bool):
+            if str(item).lower() == str(query_value).lower():
+                return True
+        elif isinstance(item, NUMBER_TYPES) or \
+                isinstance(query_value, NUMBER_TYPES):
+            try:
+                if float(item) == float(query_value):
+                    return True
+            except (TypeError, ValueError):
+                pass
+    return False
+
+
+def _in_range(value, bounds):
+    ''' Checks whether a field value, or any of its values, is in range '''
+    lower = bounds.get("gte", bounds.get("from"))
+    include_lower = bounds.get("include_lower", True) or "gte" in bounds
+    if "gt" in bounds:
+        lower = bounds["gt"]
+        include_lower = False
+    upper = bounds.get("lte", bounds.get("to"))
+    include_upper = bounds.get("include_upper", True) or "lte" in bounds
+    if "lt" in bounds:
+        upper = bounds["lt"]
+        include_upper = False
+
+    for item in _as_list(value):
+        if item is None:
+            continue
+        if lower is not None and \
+                (item < lower or (item == lower and not include_lower)):
+            continue
+        if upper is not None and \
+                (item > upper or (item == upper and not include_upper)):
+            continue
+        return True
+    return False
+
+
+def _is_missing(value):
+    ''' Checks whether a field value counts as missing '''
+    return value is None or value == [] or \
+        (isinstance(value, list) and all(item is None for item in value))
+
+
+def _sort_fields(sort):
+    ''' Returns the field names of a sort specification '''
+    fields = []
+    for item in _as_list(sort):
+        if isinstance(item, dict):
+            fields.extend(item.keys())
+        else:
+            fields.append(item.split(":")[0])
+    return fields
+
+
+def _sort(matches, sort):
+    ''' Sorts search matches, documents missing a sort value go last '''
+    specs = []
+    for item in _as_list(sort):
+        if isinstance(item, dict):
+            for (field, order) in item.items():
+                if isinstance(order, dict):
+                    order = order.get("order", "asc")
+                specs.append((field, order))
+        else:
+            parts = item.split(":")
+            specs.append((parts[0], parts[1] if len(parts) > 1 else "asc"))
+
+    for (field, order) in reversed(specs):
+        if field in ("_doc", "_score"):
+            continue
+        present = [match for match in matches
+                   if _get_value(match[1], field) is not None]
+        missing = [match for match in matches
+                   if _get_value(match[1], field) is None]
+
+        def sort_key(match, field=field, order=order):
+            ''' sorts arrays by their min or max value, same as ES '''
+            values = _as_list(_get_value(match[1], field))
+            return max(values) if order == "desc" else min(values)
+
+        present.sort(key=sort_key, reverse=(order == "desc"))
+        matches = present + missing
+    return matches
+
+
+def _aggregate(aggs, sources):
+    ''' Computes the aggregations of the given documents '''
+    results = {}
+    for (name, spec) in aggs.items():
+        sub_aggs = spec.get("aggs", spec.get("aggregations"))
+        for (agg_type, params) in spec.items():
+            if agg_type in ("aggs", "aggregations", "meta"):
+                continue
+            results[name] = _aggregate_one(agg_type, params, sources, sub_aggs)
+    return results
+
+
+def _aggregate_one(agg_type, params, sources, sub_aggs):
+    ''' Computes a single aggregation '''
+    if agg_type in ("min", "max", "avg", "sum", "value_count",
+                    "cardinality"):
+        values = []
+        for source in sources:
+            values.extend(
+                value for value in _as_list(_get_value(source, params["field"]))
+                if value is not None)
+        if agg_type == "value_count":
+            return {"value": len(values)}
+        if agg_type == "cardinality":
+            return {"value": len(set(
+                json.dumps(value) for value in values))}
+        if agg_type == "sum":
+            return {"value": float(sum(values))}
+        if not values:
+            return {"value": None}
+        if agg_type == "avg":
+            return {"value": float(sum(values)) / len(values)}
+        value = min(values) if agg_type == "min" else max(values)
+        if isinstance(value, STRING_TYPES):
+            return {"value": None, "value_as_string": value}
+        return {"value": float(value)}
+
+    if agg_type == "filter":
+        matching = [source for source in sources if _matches(params, source)]
+        return _bucket(matching, sub_aggs)
+
+    if agg_type == "filters":
+        filters = params["filters"]
+        if isinstance(filters, dict):
+            return {"buckets": dict(
+                (key, _bucket(
+                    [source for source in sources
+                     if _matches(query, source)], sub_aggs))
+                for (key, query) in filters.items())}
+        return {"buckets": [
+            _bucket([source for source in sources
+                     if _matches(query, source)], sub_aggs)
+            for query in filters]}
+
+    if agg_type == "terms":
+        groups = OrderedDict()
+        for source in sources:
+            values = _as_list(_get_value(source, params["field"]))
+            for value in set(json.dumps(value) for value in values
+                             if value is not None):
+                groups.setdefault(value, []).append(source)
+        buckets = []
+        for (key, members) in groups.items():
+            bucket = _bucket(members, sub_aggs)
+            bucket["key"] = json.loads(key)
+            buckets.append(bucket)
+        order = params.get("order", {"_count": "desc"})
+        (order_key, direction) = list(order.items())[0]
+        if order_key in ("_term", "_key"):
+            buckets.sort(key=lambda bucket: bucket["key"],
+                         reverse=direction == "desc")
+        else:
+            buckets.sort(key=lambda bucket: bucket["key"])
+            buckets.sort(key=lambda bucket: bucket["doc_count"],
+                         reverse=direction == "desc")
+        size = params.get("size", 10)
+        if size:
+            buckets = buckets[:size]
+        return {
+            "doc_count_error_upper_bound": 0,
+            "sum_other_doc_count": 0,
+            "buckets": buckets
+        }
+
+    raise RequestError(
+        400, "search_parse_exception",
+        {"error": "unsupported aggregation type " + agg_type})
+
+
+def _bucket(sources, sub_aggs):
+    ''' Returns an aggregation bucket with its sub-aggregations '''
+    bucket = {"doc_count": len(sources)}
+    if sub_aggs:
+        bucket.update(_aggregate(sub_aggs, sources))
+    return bucket
+
+
+def _filter_source(source, source_filter):
+    ''' Applies a _source filter (bool, field list or includes/excludes) '''
+    if source_filter in (None, True, "true"):
+        return _copy(source)
+    if source_filter in (False, "false"):
+        return None
+    excludes = []
+    if isinstance(source_filter, dict):
+        includes = _split(source_filter.get(
+            "includes", source_filter.get("include", [])))
+        excludes = _split(source_filter.get(
+            "excludes", source_filter.get("exclude", [])))
+    else:
+        includes = _split(source_filter)
+    return _filter_fields(source, includes, excludes)
+
+
+def _filter_fields(value, includes, excludes):
+    '''
+    Keeps the included fields of an object or of a list of objects, dotted
+    patterns applying to the fields of inner objects
+    '''
+    if isinstance(value, list):
+        return [_filter_fields(item, includes, excludes) for item in value]
+    if not isinstance(value, dict) or not (includes or excludes):
+        return _copy(value)
+    result = {}
+    for (key, item) in value.items():
+        if any(fnmatch.fnmatch(key, pattern) for pattern in excludes):
+            continue
+        inner_includes = []
+        if includes and not any(
+                fnmatch.fnmatch(key, pattern) for pattern in includes):
+            inner_includes = _inner_patterns(key, includes)
+            if not inner_includes:
+                continue
+        result[key] = _filter_fields(
+            item, inner_includes, _inner_patterns(key, excludes))
+    return result
+
+
+def _inner_patterns(key, patterns):
+    ''' Returns the dotted patterns applying to the fields of a key '''
+    return [pattern.split(".", 1)[1] for pattern in patterns
+            if "." in pattern and
+            fnmatch.fnmatch(key, pattern.split(".", 1)[0])]
+
+
+def _parse_script(script):
+    '''
+    Returns the (field, value) assignments of a script made of statements
+    such as ctx._source.field = <JSON value>
+    '''
+    if not script:
+        return []
+    if isinstance(script, dict):
+        script = script.get("inline", script.get("source", ""))
+    assignments = []
+    for statement in script.split(";"):
+        if not statement.strip():
+            continue
+        (target, _, value) = statement.partition("=")
+        target = target.strip()
+        if not target.startswith("ctx._source.") or not value.strip():
+            raise RequestError(400, "script_exception", {
+                "error": "unsupported script statement " + statement})
+        try:
+            value = json.loads(value.strip())
+        except ValueError:
+            raise RequestError(400, "script_exception", {
+                "error": "unsupported script value " + value})
+        assignments.append((target[len("ctx._source."):], value))
+    return assignments
+
+
+def _flatten_settings(settings):
+    ''' Returns index settings without the index prefix '''
+    flat = {}
+    for (key, value) in settings.items():
+        if key == "index" and isinstance(value, dict):
+            flat.update(_flatten_settings(value))
+        elif key.startswith("index."):
+            flat[key[len("index."):]] = value
+        else:
+            flat[key] = value
+    return flat
+
+
+def _parse_lines(body):
+    ''' Returns the items of an NDJSON body or a list of items '''
+    if isinstance(body, STRING_TYPES):
+        return [json.loads(line) for line in body.split("\n") if line.strip()]
+    return [json.loads(item) if isinstance(item, STRING_TYPES) else item
+            for item in body]
+
+
+def _body_size(body):
+    ''' Returns the size in bytes of a request body '''
+    if body is None:
+        return 0
+    if isinstance(body, STRING_TYPES):
+        return len(body)
+    if isinstance(body, list):
+        return sum(_body_size(item) + 1 for item in body)
+    return len(json.dumps(body, default=str))
+
+
+def _copy(source):
+    '''
+    Copies a document the way it would be stored, i.e. as JSON, so that
+    the caller can't modify the stored document
+    '''
+    return json.loads(json.dumps(source, default=_json_default))
+
+
+def _json_default(obj):
+    ''' Serializes dates the same way the Elastic search client does '''
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    return float(obj)
+
+
+def _split(value):
+    ''' Splits a comma separated list, also accepts lists and None '''
+    if value is None:
+        return []
+    if isinstance(value, STRING_TYPES):
+        return [item for item in value.split(",") if item]
+    return list(value)
+
+
+def _as_list(value):
+    ''' Returns a value as a list '''
+    if isinstance(value, list):
+        return value
+    if isinstance(value, tuple):
+        return list(value)
+    return [value]
+
+
+def _ignored(kwargs):
+    ''' Returns the status codes a request ignores '''
+    return _as_list(kwargs.get("ignore", []))
+
+
+def _new_id():
+    ''' Returns a new document or scroll ID '''
+    return uuid.uuid4().hex
+
+
+_fake_client = None
+_fake_client_lock = threading.Lock()
+
+
+def get_fake_client():
+    ''' Returns the in-memory backend of the process '''
+    global _fake_client
+    with _fake_client_lock:
+        if _fake_client is None:
+            _fake_client = FakeElasticsearch()
+        return _fake_client
@@ -16,12 +16,21 @@ import os
 import importlib
 import time
 import traceback
+from multiprocessing.pool import ThreadPool
 
 SCRIPT_PATH = os.path.abspath(__file__)
 sys.path.insert(1, '/'.join(SCRIPT_PATH.split('/')[:-2]))
 
 from elasticsearchloader.es_settings import YAML_INDEX, YAML_DOCTYPE
 from elasticsearchloader.es_settings import REFERENCE_INDEX as reference_index
+from elasticsearchloader.es_metrics import configure_metrics
+from elasticsearchloader.es_metrics import get_metrics
+from elasticsearchloader.es_utils import configure_dead_letters
+from elasticsearchloader.file_utils import CHECKSUM_ALGORITHMS
+from elasticsearchloader.file_utils import open_input
+
+# Number of files loaded at the same time by load_analysis_files
+LOAD_CONCURRENCY = 4
 
 
 def get_loader_class(loader_type):
@@ -39,6 +48,10 @@ def get_loader_class(loader_type):
             "module": "elasticsearchloader.csv_loader",
             "class": "CsvLoader"
         },
+        "parquet": {
+            "module": "elasticsearchloader.parquet_loader",
+            "class": "ParquetLoader"
+        },
     }
 
     try:
@@ -61,7 +74,7 @@ def get_header_data(input_file):
     '''
     header_values = {}
 
-    with open(input_file, 'r') as file_handle:
+    with open_input(input_file) as file_handle:
         for line in file_handle:
             line = line.strip()
             if line and not line.startswith("#"):
@@ -86,7 +99,14 @@ def load_analysis_data(
         skip_denormalize=False,
         is_qc=False,
         use_ssl=False,
-        http_auth=None):
+        http_auth=None,
+        csv_engine=None,
+        workers=None,
+        checksum=None,
+        overlap_engine=None,
+        lazy_sources=False,
+        partial_update=False,
+        timings=None):
     '''
     Loads the results from a single file into Elastic search
 
@@ -96,7 +116,9 @@ def load_analysis_data(
     :arg port: Elastic Search port - defaults to 9200
     :arg input_filename: input analysis results file
     :arg header_data: the data usually provided through the input YAML file
-    :arg analysis_data: parsed data, can be used in place of input file
+    :arg analysis_data: parsed data, can be used in place of input file,
+        a list or any iterable, e.g. a generator, of records or of batches of
+        records, read once
     :arg index_alias: alias to link the denormalized data index under
     :arg skip_denormalize: whether to skip denormalization, defaults to False
     :arg use_ssl: specify whether the connection is over SSL
@@ -105,6 +127,27 @@ def load_analysis_data(
             'username': <user_account>,
             'password': <user_password>
         }
+    :arg csv_engine: how CSV files are read, python (default) or pandas
+    :arg workers: number of processes parsing CSV files in parallel
+    :arg checksum: algorithm of the input file checksum recorded in the
+        import stats, none by default
+    :arg overlap_engine: how denormalization finds overlapping records,
+        intervaltree (default) or numpy
+    :arg lazy_sources: whether denormalization reads only the positions
+        of the records ahead, fetching their sources in batches
+    :arg partial_update: whether the records already denormalized only
+        have their events and overlaps updated
+    :arg timings: a dictionary the duration in seconds of each phase is
+        recorded in, i.e. reference_data, index, validate_import and
+        generate_events_data. The index phase is broken down into
+        index_records (reading and converting the records), index_serialize
+        and index_bulk_wait (waiting for the bulk requests), the workers'
+        times being summed and overlapping with the other loads running
+        in the process
+
+    Returns the index, document type and source of the loaded records,
+    along with the validation result, when the header data specifies the
+    caller
 
     E.g. load_analysis_data(
         input_filename=<path_to_results_file>,
@@ -180,6 +223,10 @@ def load_analysis_data(
         if header_data and not isinstance(header_data, dict):
             header_data = None
 
+        if timings is None:
+            timings = {}
+
+        t0 = time.time()
         if header_data:
             project_data = es_loader.get_reference_data(
                 reference_index, header_data
@@ -190,36 +237,71 @@ def load_analysis_data(
                 project_data = {}
                 logging.info('No relevant data found in %s.', reference_index)
             header_data = dict(header_data.items() + project_data.items())
+        timings["reference_data"] = time.time() - t0
 
         es_loader.create_index()
 
         es_loader.es_tools.refresh_index()
 
+        from elasticsearchloader.csv_loader import CsvLoader
+
+        # Only the CSV loader supports alternative engines and workers
+        parse_args = {}
+        if isinstance(es_loader, CsvLoader):
+            if csv_engine:
+                parse_args["engine"] = csv_engine
+            if workers and workers > 1:
+                parse_args["workers"] = workers
+        elif csv_engine or (workers and workers > 1):
+            logging.warn(
+                "The CSV engine and workers don't apply to %s, ignoring them.",
+                loader_class.__name__)
+        if checksum:
+            parse_args["checksum"] = checksum
+
         logging.info("Indexing started: %s", time.ctime())
+        stage_times = get_metrics().get_stage_times()
+        t0 = time.time()
         stats = es_loader.parse(
             analysis_file=input_filename,
             custom_header=header_data,
-            analysis_data=analysis_data
+            analysis_data=analysis_data,
+            **parse_args
         )
         logging.info("Indexing finished: %s", time.ctime())
 
         es_loader.es_tools.refresh_index()
+        timings["index"] = time.time() - t0
+        for (stage, duration) in get_metrics().get_stage_times().items():
+            timings["index_" + stage] = \
+                duration - stage_times.get(stage, 0.0)
 
-        es_loader.validate_import(
+        t0 = time.time()
+        validated = es_loader.validate_import(
             input_file=input_filename,
             input_data=analysis_data,
-            stats=stats
+            stats=stats,
+            refresh=False
         )
-
-        if skip_denormalize:
-            return
-
-        from elasticsearchloader.denormalize_index import generate_events_data
+        timings["validate_import"] = time.time() - t0
 
         if input_filename:
             source = {'file_fullname': input_filename}
         else:
             source = {'source_id': es_loader.get_source_id()}
+        result = {
+            "index": index_name,
+            "doc_type": doctype,
+            "source": source,
+            "validated": validated
+        }
+
+        if skip_denormalize:
+            return result
+
+        from elasticsearchloader.denormalize_index import generate_events_data
+
+        t0 = time.time()
         generate_events_data(
             index=index_name,
             doc_type=doctype,
@@ -229,10 +311,14 @@ def load_analysis_data(
             http_auth=http_auth,
             source=source,
             index_alias=index_alias,
-            is_qc=is_qc
+            is_qc=is_qc,
+            overlap_engine=overlap_engine,
+            lazy_sources=lazy_sources,
+            partial_update=partial_update
         )
+        timings["generate_events_data"] = time.time() - t0
 
-        return
+        return result
 
     header_data = get_header_data(input_filename)
 
@@ -325,7 +411,8 @@ def load_analysis_data(
             es_loader.validate_import(
                 input_file=input_filename,
                 input_data=analysis_data,
-                stats=stats
+                stats=stats,
+                refresh=False
             )
 
         except Exception:
@@ -338,6 +425,82 @@ def load_analysis_data(
             logging.error("#" * len(error_message))
 
 
+def load_analysis_files(file_loads, concurrency=LOAD_CONCURRENCY, **load_args):
+    '''
+    Loads several files at the same time, in threads of the current process
+    sharing the Elastic search clients and the bulk request threads. Each
+    item of file_loads holds the load_analysis_data arguments specific to a
+    file, i.e. input_filename and header_data, load_args the ones shared by
+    all files.
+
+    The files are denormalized one after the other once all of them have
+    been loaded, denormalization running in processes of its own.
+
+    Returns the result of load_analysis_data for each file, None for the
+    files that failed to load
+
+    E.g. load_analysis_files(
+        [
+            {'input_filename': <path_to_results_file>,
+             'header_data': {'caller': <data_type>, ...}},
+            ...
+        ],
+        concurrency=8,
+        host=<host>
+    )
+    '''
+    skip_denormalize = load_args.pop("skip_denormalize", False)
+
+    def load_file(file_load):
+        ''' loads a single file, logging any error '''
+        file_args = dict(load_args.items() + file_load.items())
+        file_args["skip_denormalize"] = True
+        try:
+            return load_analysis_data(**file_args)
+        except Exception:
+            error_message = "An error has occurred while processing " +\
+                            "results file " + \
+                            str(file_args.get("input_filename"))
+            logging.error("#" * len(error_message))
+            logging.error(error_message)
+            logging.error(traceback.format_exc())
+            logging.error("#" * len(error_message))
+            return None
+
+    pool = ThreadPool(max(1, min(concurrency, len(file_loads))))
+    try:
+        results = pool.map(load_file, file_loads)
+    finally:
+        pool.close()
+        pool.join()
+
+    if skip_denormalize:
+        return results
+
+    from elasticsearchloader.denormalize_index import generate_events_data
+
+    for file_load, result in zip(file_loads, results):
+        if not result:
+            continue
+        file_args = dict(load_args.items() + file_load.items())
+        generate_events_data(
+            index=result["index"],
+            doc_type=result["doc_type"],
+            host=file_args.get("host", "localhost"),
+            port=file_args.get("port", 9200),
+            use_ssl=file_args.get("use_ssl", False),
+            http_auth=file_args.get("http_auth"),
+            source=result["source"],
+            index_alias=file_args.get("index_alias"),
+            is_qc=file_args.get("is_qc", False),
+            overlap_engine=file_args.get("overlap_engine"),
+            lazy_sources=file_args.get("lazy_sources", False),
+            partial_update=file_args.get("partial_update", False)
+        )
+
+    return results
+
+
 def pool_process(params):
     '''
     Wrapper for function load_analysis_data intended to be queued onto
@@ -559,6 +722,77 @@ def main():
         '--password',
         dest='password',
         help='Password')
+    argparser.add_argument(
+        '--metrics-json',
+        dest='metrics_json',
+        help='File to write Elastic search request metrics to as JSON, ' +
+        '{pid} is replaced by the process id')
+    argparser.add_argument(
+        '--metrics-prom',
+        dest='metrics_prom',
+        help='Prometheus textfile to write Elastic search request ' +
+        'metrics to, {pid} is replaced by the process id')
+    argparser.add_argument(
+        '--metrics-interval',
+        dest='metrics_interval',
+        help='Interval between two metric snapshots in seconds, ' +
+        'default is 60',
+        type=float,
+        default=60.0)
+    argparser.add_argument(
+        '--dead-letter-file',
+        dest='dead_letter_file',
+        help='File to write the records which could not be indexed to, ' +
+        'to be re-submitted with es_replay_dead_letters, by default they ' +
+        'are dropped')
+    argparser.add_argument(
+        '--csv-engine',
+        dest='csv_engine',
+        help='How CSV files are read, row by row (python) or in chunks ' +
+        'of typed columns (pandas, requires pandas), default is python',
+        choices=['python', 'pandas'],
+        type=str,
+        default=None)
+    argparser.add_argument(
+        '--workers',
+        dest='workers',
+        help='Number of processes parsing CSV files in parallel, each ' +
+        'one a byte range of the file, default is 1',
+        type=int,
+        default=1)
+    argparser.add_argument(
+        '--checksum',
+        dest='checksum',
+        help='Algorithm of the input file checksum recorded in the ' +
+        'import stats',
+        choices=CHECKSUM_ALGORITHMS,
+        type=str,
+        default=None)
+    argparser.add_argument(
+        '--overlap-engine',
+        dest='overlap_engine',
+        help='How denormalization finds overlapping records, using ' +
+        'interval trees (intervaltree, the default) or sorted position ' +
+        'arrays (numpy, requires numpy)',
+        choices=['intervaltree', 'numpy'],
+        type=str,
+        default=None)
+    argparser.add_argument(
+        '--lazy-sources',
+        dest='lazy_sources',
+        action='store_true',
+        help='If set, denormalization reads only the positions of the ' +
+        'records ahead, the sources being fetched in batches as the ' +
+        'records are rewritten, using the numpy engine',
+        default=False)
+    argparser.add_argument(
+        '--partial-update',
+        dest='partial_update',
+        action='store_true',
+        help='If set, records already in the denormalized index only ' +
+        'have their events and overlaps updated, and are skipped if ' +
+        'these have not changed',
+        default=False)
 
     args = argparser.parse_args()
 
@@ -597,6 +831,15 @@ def main():
     if args.username and args.password:
         http_auth = (args.username, args.password)
 
+    if args.metrics_json or args.metrics_prom:
+        configure_metrics(
+            json_file=args.metrics_json,
+            prometheus_file=args.metrics_prom,
+            export_interval=args.metrics_interval)
+
+    if args.dead_letter_file:
+        configure_dead_letters(os.path.abspath(args.dead_letter_file))
+
     if args.config_file:
         from elasticsearchloader.es_import_yaml import load_yaml_file
         try:
@@ -639,7 +882,13 @@ def main():
             skip_denormalize=args.skip_denormalize,
             is_qc = args.is_qc,
             use_ssl=args.use_ssl,
-            http_auth=http_auth
+            http_auth=http_auth,
+            csv_engine=args.csv_engine,
+            workers=args.workers,
+            checksum=args.checksum,
+            overlap_engine=args.overlap_engine,
+            lazy_sources=args.lazy_sources,
+            partial_update=args.partial_update
         )
 
 
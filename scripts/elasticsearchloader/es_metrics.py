@@ -0,0 +1,366 @@
+'''
+Per process metrics of the Elastic search requests
+
+Counts the requests, errors, documents and bytes of each operation (bulk,
+search, count, scan page, refresh, forcemerge...) and keeps histograms of
+the client side latency, along with the server side processing time
+reported in the responses. The time the loading process spends in each
+stage of the bulk indexing (producing the records, serializing them and
+waiting for the bulk requests) is summed as well. Snapshots are written periodically to a JSON
+file and/or a Prometheus textfile (node exporter textfile collector
+format), the file names may contain {pid} so that each worker process
+writes its own files. Pool workers leave without running the exit
+handlers, so the pool proxies export their snapshots when done, worker
+files being suffixed by the worker pid unless named with {pid}.
+
+'''
+
+from __future__ import division
+import threading
+import logging
+import atexit
+import json
+import time
+import os
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Minimum interval between two snapshots, in seconds
+EXPORT_INTERVAL = 60.0
+
+# Minimum interval between two stack captures of the same operation, slow
+# requests in between are logged without a stack trace
+STACK_SAMPLE_INTERVAL = 60.0
+
+PROMETHEUS_PREFIX = 'montage_es'
+
+
+class OperationMetrics(object):
+
+    '''
+    Counters and latency histogram of a single operation
+    '''
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.slow = 0
+        self.docs = 0
+        self.bytes = 0
+        self.wall_time = 0.0
+        self.max_wall_time = 0.0
+        self.took_requests = 0
+        self.took_time = 0.0
+        self.took_wall_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, wall_time, took=None, docs=0, nbytes=0, error=False):
+        ''' Adds a request to the metrics '''
+        self.requests += 1
+        self.docs += docs
+        self.bytes += nbytes
+        self.wall_time += wall_time
+        self.max_wall_time = max(self.max_wall_time, wall_time)
+        if error:
+            self.errors += 1
+        if took is not None:
+            # Requests without a server side time are left out of the
+            # comparison, so that both sums cover the same requests
+            self.took_requests += 1
+            self.took_time += took / 1000
+            self.took_wall_time += wall_time
+        for idx, bound in enumerate(LATENCY_BUCKETS):
+            if wall_time <= bound:
+                self.buckets[idx] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def get_quantile(self, quantile):
+        '''
+        Returns an upper bound of the given latency quantile, i.e. the
+        bucket it falls in
+        '''
+        if not self.requests:
+            return 0.0
+        rank = quantile * self.requests
+        total = 0
+        for idx, count in enumerate(self.buckets[:-1]):
+            total += count
+            if total >= rank:
+                return LATENCY_BUCKETS[idx]
+        return self.max_wall_time
+
+    def to_dict(self):
+        ''' Returns the metrics as a dictionary '''
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "slow": self.slow,
+            "docs": self.docs,
+            "bytes": self.bytes,
+            "wall_time": self.wall_time,
+            "max_wall_time": self.max_wall_time,
+            "p50": self.get_quantile(0.5),
+            "p95": self.get_quantile(0.95),
+            "p99": self.get_quantile(0.99),
+            "took_time": self.took_time,
+            "took_wall_time": self.took_wall_time,
+            "buckets": dict(
+                zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"],
+                    self.buckets))
+        }
+
+
+class MetricsRegistry(object):
+
+    '''
+    Collects the metrics of all operations of the process
+    '''
+
+    def __init__(self):
+        self.__lock__ = threading.Lock()
+        self.__json_file__ = None
+        self.__prometheus_file__ = None
+        self.__export_interval__ = EXPORT_INTERVAL
+        # The process the files were configured in, other processes write
+        # their own files
+        self.__owner_pid__ = os.getpid()
+        self.reset()
+
+    def reset(self):
+        ''' Clears the collected metrics '''
+        self.__pid__ = os.getpid()
+        self.__start_time__ = time.time()
+        self.__last_export__ = time.time()
+        self.__last_stack__ = {}
+        self.__operations__ = {}
+        self.__stages__ = {}
+
+    def configure(self, json_file=None, prometheus_file=None,
+                  export_interval=None):
+        '''
+        Sets the files the snapshots are written to, either file may be
+        None and may contain {pid}
+        '''
+        self.__json_file__ = json_file
+        self.__prometheus_file__ = prometheus_file
+        self.__owner_pid__ = os.getpid()
+        if export_interval is not None:
+            self.__export_interval__ = export_interval
+
+    def observe(self, operation, wall_time, took=None, docs=0, nbytes=0,
+                error=False):
+        '''
+        Records a request of the given operation, its wall time in seconds
+        and, if known, the server side processing time in milliseconds
+        '''
+        export = False
+        with self.__lock__:
+            self._check_pid()
+            metrics = self.__operations__.get(operation)
+            if metrics is None:
+                metrics = self.__operations__[operation] = OperationMetrics()
+            metrics.observe(
+                wall_time, took=took, docs=docs, nbytes=nbytes, error=error)
+            if (self.__json_file__ or self.__prometheus_file__) and \
+                    time.time() - self.__last_export__ > \
+                    self.__export_interval__:
+                self.__last_export__ = time.time()
+                export = True
+        if export:
+            self.export()
+
+    def observe_stage(self, stage, duration):
+        ''' Adds the time spent in a stage of the loading, in seconds '''
+        with self.__lock__:
+            self._check_pid()
+            self.__stages__[stage] = \
+                self.__stages__.get(stage, 0.0) + duration
+
+    def get_stage_times(self):
+        ''' Returns the time spent in each stage so far, in seconds '''
+        with self.__lock__:
+            self._check_pid()
+            return dict(self.__stages__)
+
+    def sample_stack(self, operation):
+        '''
+        Records a slow request and returns whether its stack should be
+        captured, at most once per STACK_SAMPLE_INTERVAL per operation
+        '''
+        now = time.time()
+        with self.__lock__:
+            self._check_pid()
+            metrics = self.__operations__.get(operation)
+            if metrics is not None:
+                metrics.slow += 1
+            if now - self.__last_stack__.get(operation, 0) < \
+                    STACK_SAMPLE_INTERVAL:
+                return False
+            self.__last_stack__[operation] = now
+            return True
+
+    def snapshot(self):
+        ''' Returns the current metrics as a dictionary '''
+        with self.__lock__:
+            self._check_pid()
+            return {
+                "pid": self.__pid__,
+                "start_time": self.__start_time__,
+                "time": time.time(),
+                "operations": dict(
+                    (operation, metrics.to_dict())
+                    for operation, metrics in self.__operations__.items()),
+                "stages": dict(self.__stages__)
+            }
+
+    def export(self):
+        ''' Writes a snapshot to the configured files '''
+        if not self.__json_file__ and not self.__prometheus_file__:
+            return
+        snapshot = self.snapshot()
+        try:
+            if self.__json_file__:
+                _write_file(
+                    self._get_file_name(self.__json_file__),
+                    json.dumps(snapshot, indent=2, sort_keys=True))
+            if self.__prometheus_file__:
+                _write_file(
+                    self._get_file_name(self.__prometheus_file__),
+                    format_prometheus(snapshot))
+        except (IOError, OSError) as error:
+            logging.warn("Unable to export metrics: %s", error)
+
+    def _get_file_name(self, file_name):
+        '''
+        Returns the name of a snapshot file, files not named with {pid}
+        being suffixed by the pid in processes other than the one which
+        configured them, e.g. pool workers
+        '''
+        if "{pid}" not in file_name and os.getpid() != self.__owner_pid__:
+            (root, ext) = os.path.splitext(file_name)
+            file_name = root + ".{pid}" + ext
+        return file_name.replace("{pid}", str(os.getpid()))
+
+    def _check_pid(self):
+        '''
+        Clears the metrics inherited from the parent in a forked process
+        '''
+        if os.getpid() != self.__pid__:
+            self.reset()
+
+
+def format_prometheus(snapshot):
+    ''' Formats a snapshot in the Prometheus text exposition format '''
+    lines = []
+    pid = snapshot["pid"]
+    operations = sorted(snapshot["operations"].items())
+
+    counters = [
+        ("requests_total", "requests", "Requests sent"),
+        ("errors_total", "errors", "Failed requests"),
+        ("slow_requests_total", "slow", "Requests slower than the threshold"),
+        ("docs_total", "docs", "Documents sent"),
+        ("bytes_total", "bytes", "Request body bytes sent"),
+        ("took_seconds_total", "took_time",
+         "Server side processing time reported by the responses"),
+        ("took_wall_seconds_total", "took_wall_time",
+         "Client side time of the requests reporting a server side time")
+    ]
+    for name, key, description in counters:
+        name = "%s_%s" % (PROMETHEUS_PREFIX, name)
+        lines.append("# HELP %s %s." % (name, description))
+        lines.append("# TYPE %s counter" % name)
+        for operation, metrics in operations:
+            lines.append('%s{operation="%s",pid="%d"} %s' % (
+                name, operation, pid, metrics[key]))
+
+    name = "%s_request_duration_seconds" % PROMETHEUS_PREFIX
+    lines.append("# HELP %s Client side request latency." % name)
+    lines.append("# TYPE %s histogram" % name)
+    for operation, metrics in operations:
+        total = 0
+        for bound in [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]:
+            total += metrics["buckets"][bound]
+            lines.append('%s_bucket{operation="%s",pid="%d",le="%s"} %d' % (
+                name, operation, pid, bound, total))
+        lines.append('%s_sum{operation="%s",pid="%d"} %s' % (
+            name, operation, pid, metrics["wall_time"]))
+        lines.append('%s_count{operation="%s",pid="%d"} %d' % (
+            name, operation, pid, metrics["requests"]))
+
+    name = "%s_stage_seconds_total" % PROMETHEUS_PREFIX
+    lines.append("# HELP %s Time spent in each loading stage." % name)
+    lines.append("# TYPE %s counter" % name)
+    for stage, duration in sorted(snapshot.get("stages", {}).items()):
+        lines.append('%s{stage="%s",pid="%d"} %s' % (
+            name, stage, pid, duration))
+
+    return "\n".join(lines) + "\n"
+
+
+def _write_file(file_name, content):
+    '''
+    Replaces the content of a file atomically, so that readers never see
+    a partial snapshot
+    '''
+    tmp_file_name = "%s.%d.tmp" % (file_name, os.getpid())
+    with open(tmp_file_name, "w") as tmp_file:
+        tmp_file.write(content)
+    os.rename(tmp_file_name, file_name)
+
+
+_metrics = MetricsRegistry()
+
+
+def get_metrics():
+    ''' Returns the metrics registry of the process '''
+    return _metrics
+
+
+def configure_metrics(json_file=None, prometheus_file=None,
+                      export_interval=None):
+    '''
+    Enables the periodic metric snapshots, a last one is written when the
+    process exits
+    '''
+    _metrics.configure(
+        json_file=json_file,
+        prometheus_file=prometheus_file,
+        export_interval=export_interval)
+
+
+def timed_iterator(iterable, stage):
+    '''
+    Yields the items of an iterable, the time spent producing them being
+    added to the given stage once the iteration ends
+    '''
+    duration = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            t0 = time.time()
+            try:
+                item = next(iterator)
+            finally:
+                duration += time.time() - t0
+            yield item
+    except StopIteration:
+        return
+    finally:
+        _metrics.observe_stage(stage, duration)
+
+
+def export_metrics():
+    '''
+    Writes a snapshot of the metrics of the process, to be called by the
+    pool proxies, as pool workers exit without running the exit handlers
+    '''
+    _metrics.export()
+
+
+atexit.register(_metrics.export)
@@ -0,0 +1,147 @@
+'''
+Re-submits the records written to a dead letter file by the bulk indexing
+functions, i.e. records which couldn't be indexed after several attempts.
+Records failing again are written to a new dead letter file.
+
+'''
+
+import logging
+import argparse
+import sys
+import os
+
+SCRIPT_PATH = os.path.abspath(__file__)
+sys.path.insert(1, '/'.join(SCRIPT_PATH.split('/')[:-2]))
+
+from elasticsearchloader.es_utils import ElasticSearchTools
+
+
+def replay_dead_letters(
+        dead_letter_file,
+        host="localhost",
+        port=9200,
+        use_ssl=False,
+        http_auth=None):
+    '''
+    Re-submits the records from the given dead letter file for indexing
+    '''
+    if not os.path.isfile(dead_letter_file):
+        logging.error("%s: no such file.", dead_letter_file)
+        return 0
+
+    es_tools = ElasticSearchTools()
+    es_tools.init_host(
+        host=host,
+        port=port,
+        use_ssl=use_ssl,
+        http_auth=http_auth)
+    es_tools.set_dead_letter_file(dead_letter_file)
+
+    record_count = es_tools.replay_dead_letters(dead_letter_file)
+    logging.info(
+        "%d record(s) from %s have been re-submitted.",
+        record_count, dead_letter_file)
+
+    return record_count
+
+
+def main():
+    ''' main function '''
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '-i',
+        '--infile',
+        dest='infile',
+        action='store',
+        help='Dead letter file to re-submit',
+        type=str,
+        required=True)
+
+    argparser.add_argument(
+        '-H',
+        '--host',
+        dest='host',
+        action='store',
+        help='elastic search host. Default is localhost',
+        type=str,
+        default="localhost")
+
+    argparser.add_argument(
+        '-p',
+        '--port',
+        dest='port',
+        action='store',
+        help='Elastic search port, default is 9200',
+        type=int,
+        default=9200)
+
+    argparser.add_argument(
+        '-v',
+        '--verbosity',
+        dest='verbosity',
+        action='store',
+        help='Default level of verbosity is INFO.',
+        choices=['info', 'debug', 'warn', 'error'],
+        type=str,
+        default="info")
+
+    argparser.add_argument(
+        '--use-ssl',
+        dest='use_ssl',
+        action='store_true',
+        help='Connect over SSL',
+        default=False)
+    argparser.add_argument(
+        '-u',
+        '--username',
+        dest='username',
+        help='Username')
+    argparser.add_argument(
+        '-P',
+        '--password',
+        dest='password',
+        help='Password')
+
+    args = argparser.parse_args()
+
+    # Set logging to console, default verbosity to INFO.
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    es_logger = logging.getLogger('elasticsearch')
+    es_logger.setLevel(logging.WARN)
+    request_logger = logging.getLogger("urllib3")
+    request_logger.setLevel(logging.WARN)
+
+    logging.basicConfig(
+        format='%(levelname)s: %(message)s',
+        stream=sys.stdout
+    )
+
+    if args.verbosity:
+        if args.verbosity.lower() == "debug":
+            logger.setLevel(logging.DEBUG)
+
+        elif args.verbosity.lower() == "warn":
+            logger.setLevel(logging.WARN)
+
+        elif args.verbosity.lower() == "error":
+            logger.setLevel(logging.ERROR)
+            es_logger.setLevel(logging.ERROR)
+            request_logger.setLevel(logging.ERROR)
+
+    http_auth = None
+    if args.username and args.password:
+        http_auth = (args.username, args.password)
+
+    replay_dead_letters(
+        dead_letter_file=args.infile,
+        host=args.host,
+        port=args.port,
+        use_ssl=args.use_ssl,
+        http_auth=http_auth
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,32 @@ YAML_DOCTYPE = 'config_type'
 
 DENORMALIZED_ALIAS = 'denormalized_data'
 
+# Normalized header mode, the header of each source is stored once in the
+# sources index, the records keeping the RECORD_HEADER_FIELDS, which the
+# validation, denormalization and dashboard facets rely on, along with the
+# HEADER_FILTER_FIELDS (by default) used to filter the data. The mode isn't
+# exposed by es_import_file until the dashboard resolves the other header
+# fields through the sources index
+SOURCES_INDEX = 'sources_index'
+
+SOURCES_DOCTYPE = 'source_type'
+
+RECORD_HEADER_FIELDS = [
+    'caller', 'sample_id', 'normal_sample_id', 'project', 'tumor_type',
+    'expt_type', 'patient_id']
+
+HEADER_FILTER_FIELDS = ['library_id', 'normal_library_id', 'run_id']
+
+# Bulk indexing retry settings, records rejected by the cluster because of a
+# full queue are retried with a randomized exponential backoff (in seconds),
+# the ones which can't be indexed are written to the dead letter file, if one
+# is configured, in bulk request (NDJSON) format, to be re-submitted with
+# es_replay_dead_letters
+BULK_MAX_RETRIES = 6
+BULK_INITIAL_BACKOFF = 1.0
+BULK_MAX_BACKOFF = 60.0
+DEAD_LETTER_FILE = None
+
 HEADER_FIELDS = {
     'common': {
         'build': {'field': 'build', 'transform': 'lower'},
@@ -12,9 +12,28 @@ from elasticsearch import Elasticsearch
 import logging
 from elasticsearch.exceptions import TransportError
 from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import ConnectionError as EsConnectionError
 from elasticsearch import helpers
+from elasticsearchloader.bulk_controller import get_bulk_controller
+from elasticsearchloader.bulk_buffer import BulkBuffer
+from elasticsearchloader.es_metrics import get_metrics
+from elasticsearchloader.es_metrics import timed_iterator
+from elasticsearchloader.es_fake import FAKE_HOST
+from elasticsearchloader.es_fake import get_fake_client
+from elasticsearchloader.es_settings import BULK_MAX_RETRIES
+from elasticsearchloader.es_settings import BULK_INITIAL_BACKOFF
+from elasticsearchloader.es_settings import BULK_MAX_BACKOFF
+from elasticsearchloader.es_settings import DEAD_LETTER_FILE
 from datetime import datetime
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import threading
+import Queue
 import traceback
+import fcntl
+import random
+import copy
+import os
 import json
 
 import time
@@ -22,6 +41,43 @@ import pprint as pp
 
 TIMEOUT = 300
 
+# Number of bulk requests kept in flight per loader by default
+BULK_THREAD_COUNT = 4
+
+# Threads submitting the bulk requests of all the loaders of a process
+BULK_POOL_SIZE = 16
+
+# Hits per shard returned by each scroll request, and the maximum number of
+# such pages buffered per parallel scan
+SCAN_PAGE_SIZE = 1000
+SCAN_QUEUE_SIZE = 8
+
+# Maximum number of searches sent in a single multi search request
+MSEARCH_BATCH_SIZE = 100
+
+# Maximum number of documents fetched in a single multi get request
+MGET_BATCH_SIZE = 1000
+
+# First version whose reindex requests can be sliced
+SLICED_REINDEX_VERSION = (5, 1)
+
+# Serializes the dead letter file writes of the threads in a process
+_dead_letter_lock = threading.Lock()
+
+# HTTP connections kept open per client, shared by all loaders of a process,
+# enough for the bulk requests and scan slices in flight at the same time
+CONNECTION_POOL_SIZE = 32
+
+# Clients of the process, by connection settings
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Bulk request thread pool of the process, along with the process id, as
+# the pool threads are not inherited by forked processes
+_bulk_pool = None
+_bulk_pool_pid = None
+_bulk_pool_lock = threading.Lock()
+
 class ElasticSearchTools(object):
 
     ''' Initializes the Elastic search api.  '''
@@ -29,32 +85,57 @@ class ElasticSearchTools(object):
     __es_index__ = "unknown_index"
     __es_port__ = 0
     __es_id__ = 0
-    es = Elasticsearch()
+    __es__ = None
    
     __t0__ = 0.0
     __tb__ = time.time()
     __slow_query__ = 3.0    #query is slow if it runs longer than this 
+    __dead_letter_file__ = DEAD_LETTER_FILE
     __log_interval__ = 10.0 #interval to print logging information
     
     def __init__(self, es_doc_type=None, es_index=None):
         self.__es_doc_type__ = es_doc_type
         self.__es_index__ = es_index
+        self.__id_lock__ = threading.Lock()
+
+    @property
+    def es(self):
+        '''
+        The Elastic search client, the shared client of the default host
+        unless init_host has been called
+        '''
+        if self.__es__ is None:
+            self.__es__ = get_client()
+        return self.__es__
+
+    @es.setter
+    def es(self, client):
+        self.__es__ = client
 
     def logerr(self,msg):
         logging.error("%s; %s\n%s",time.strftime("%Y-%m-%d %H:%M:%S",time.localtime()),msg,pp.pformat(traceback.format_list(traceback.extract_stack())))
 
-    def slow_query_log(self,t0,t1,isPrint=0,message="",query="",index="",doc_type="",tmout=__slow_query__):
+    def slow_query_log(self,t0,t1,isPrint=0,message="",query="",index="",doc_type="",tmout=__slow_query__
+                       ,operation="other",took=None,docs=0,nbytes=0,error=False):
         '''
-        prints slow query information if necessary
+        records the request in the metrics registry and prints slow query
+        information if necessary, the stack is only captured for a sample
+        of the slow queries
         if isPrint then always print query
         '''
-        if isPrint or ((tmout>0) and (t1 - t0 > tmout)):
-            logging.info("%s; %s\n%s; index: %s; type: %s;\nslow query: %s;\nexec-time=%f;"
-                         ,time.strftime("%Y-%m-%d %H:%M:%S",time.localtime())
-                         ,pp.pformat(traceback.format_list(traceback.extract_stack()))
-                         ,message
-                         ,index,doc_type
-                         ,query,t1-t0)
+        get_metrics().observe(operation,t1-t0,took=took,docs=docs,nbytes=nbytes,error=error)
+        is_slow = (tmout>0) and (t1 - t0 > tmout)
+        if not (isPrint or is_slow):
+            return
+        stack = ""
+        if (is_slow and get_metrics().sample_stack(operation)) or isPrint:
+            stack = pp.pformat(traceback.format_list(traceback.extract_stack()))
+        logging.info("%s; %s\n%s; operation: %s; index: %s; type: %s;\nslow query: %s;\nexec-time=%f; took=%s;"
+                     ,time.strftime("%Y-%m-%d %H:%M:%S",time.localtime())
+                     ,stack
+                     ,message,operation
+                     ,index,doc_type
+                     ,query,t1-t0,took)
 
     def create_index(self, mappings):
         ''' Creates a new index using the provided mapping '''
@@ -91,17 +172,22 @@ class ElasticSearchTools(object):
 	            self.logerr(str(e))
             return x
 
-    def init_host(self, host=None, port=None, http_auth=None, timeout=None, use_ssl=False):
-        ''' Applies the Elastic search connection settings '''
+    def init_host(self, host=None, port=None, http_auth=None, timeout=None, use_ssl=False,
+                  maxsize=None):
+        '''
+        Applies the Elastic search connection settings, the client is shared
+        with the other instances of the process using the same settings
+        '''
         if not timeout:
             timeout = TIMEOUT 
         __es_id__ = 0  # reset ID count cause host changed.
-        self.es = Elasticsearch(
-            [host],
+        self.es = get_client(
+            host=host,
             port=port,
             use_ssl=use_ssl,
             http_auth=http_auth,
-            timeout=timeout
+            timeout=timeout,
+            maxsize=maxsize
         )
 
     def delete_index(self):
@@ -133,57 +219,234 @@ class ElasticSearchTools(object):
         '''
         self.__es_id__ += 1
         t0 = time.time()
+        res = None
         try:
             res = self.es.index(
                 index=self.__es_index__,
                 doc_type=self.__es_doc_type__,
                 body=record_to_insert)
         finally:
-	    self.slow_query_log(t0,time.time(),query=record_to_insert)
+            self.slow_query_log(t0,time.time(),query=record_to_insert
+                               ,operation="index",docs=1,error=res is None)
         return res
 
     def submit_bulk_to_es(self, records_to_insert):
         '''
-        Adds a group of records to the Elastic search index
-        '''
-        self.__es_id__ += len(records_to_insert) / 2
-	##debug
-        #self.__es_id__ += len(records_to_insert) / 2
-        #if time.time()-self.__t0__ > 1.0:
-        #    self.__t0__ = time.time()
-        #    logging.info("submit_bulk_to_es(); t=%f; n=%d; tot=%d"
-        #                 ,self.__t0__-self.__tb__,len(records_to_insert)
-        #                 ,self.__es_id__)
-        ##debug
-	t0 = time.time()
+        Adds a group of records to the Elastic search index, the records are
+        given either as a BulkBuffer or as a list of alternating index commands
+        and records.
+        Records rejected because of a full queue, as well as the whole request
+        in case of a connection error, are retried with a randomized
+        exponential backoff, records which still can't be indexed are written
+        to the dead letter file. As a request failing with a connection error
+        might have been applied, it is only sent again if all its records
+        carry IDs, so that no record is indexed twice
+        '''
+        if not isinstance(records_to_insert, BulkBuffer):
+            records_to_insert = BulkBuffer(records_to_insert)
+        with self.__id_lock__:
+            self.__es_id__ += len(records_to_insert)
+
         res = {}
-	try:
-       	    res = self.es.bulk(
-       	        body=records_to_insert,
-       	        index=self.__es_index__,
-       	        doc_type=self.__es_doc_type__,
-       	        request_timeout=TIMEOUT)
-        except Exception as e:
-               self.logerr({"error":str(e),"index":self.__es_index__,"doc_type":self.__es_doc_type__
-                           ,"body":["records_to_insert ..."],"nrecs":str(len(records_to_insert)/2)})
-        finally:
-            self.slow_query_log(t0,time.time(),index=self.__es_index__
-                               ,doc_type=self.__es_doc_type__
-                               ,query="len(records_to_insert)="+str(int(len(records_to_insert) / 2))+";")
-            if res["errors"]:
-                try:
-                    errors = [
-                        item for item in res["items"]
-                        if "error" in item["create"].keys()]
-                except KeyError as e:
-                    errors = [
-                        item for item in res["items"]
-                        if "error" in item["index"].keys()]
-                    logging.error("The following error(s) occurred during indexing: "+str(e))
-                    for line in json.dumps(errors, indent=2).split('\n'):
-                       logging.error(line)
+        pending = records_to_insert
+        for attempt in range(BULK_MAX_RETRIES + 1):
+            if attempt:
+                time.sleep(_get_backoff(attempt))
+            t0 = time.time()
+            response = None
+            try:
+                response = self.es.bulk(
+                    body=pending.get_body(),
+                    index=self.__es_index__,
+                    doc_type=self.__es_doc_type__,
+                    request_timeout=TIMEOUT)
+            except Exception as e:
+                retry = _is_retryable(e, pending.has_ids())
+                if getattr(e, "status_code", None) == 429:
+                    get_bulk_controller().record(
+                        len(pending), pending.get_size(), None,
+                        time.time() - t0, rejected=len(pending))
+                self.logerr({"error":str(e),"index":self.__es_index__,"doc_type":self.__es_doc_type__
+                            ,"body":["records_to_insert ..."],"nrecs":str(len(pending))
+                            ,"attempt":attempt})
+                if retry and attempt < BULK_MAX_RETRIES:
+                    continue
+                self.write_dead_letters(pending)
+                break
+            finally:
+                self.slow_query_log(t0,time.time(),index=self.__es_index__
+                                   ,doc_type=self.__es_doc_type__
+                                   ,query="len(records_to_insert)="+str(len(pending))+";"
+                                   ,operation="bulk",docs=len(pending),nbytes=pending.get_size()
+                                   ,took=response.get("took") if response else None
+                                   ,error=response is None or bool(response.get("errors")))
+
+            if not res:
+                res = response
+            rejected, failed, errors = _get_failed_records(response)
+            get_bulk_controller().record(
+                len(pending), pending.get_size(), response.get("took"),
+                time.time() - t0, rejected=len(rejected))
+
+            if failed:
+                logging.error(
+                    "%d record(s) could not be indexed into %s, e.g.: %s",
+                    len(failed), self.__es_index__, json.dumps(errors[:3]))
+                self.write_dead_letters(pending.subset(failed))
+            if not rejected:
+                break
+            if attempt == BULK_MAX_RETRIES:
+                logging.error(
+                    "%d record(s) rejected by %s after %d attempts.",
+                    len(rejected), self.__es_index__, attempt + 1)
+                self.write_dead_letters(pending.subset(rejected))
+                break
+            logging.warn(
+                "%d record(s) rejected by %s, retrying.",
+                len(rejected), self.__es_index__)
+            pending = pending.subset(rejected)
         return res
 
+    def set_dead_letter_file(self, dead_letter_file):
+        '''
+        Sets the file records which can't be indexed are written to, None
+        for them to be dropped
+        '''
+        self.__dead_letter_file__ = dead_letter_file
+
+    def write_dead_letters(self, bulk_buffer):
+        '''
+        Appends the actions of a bulk buffer to the dead letter file,
+        completing the index and document type of the commands
+        '''
+        if not self.__dead_letter_file__:
+            logging.error(
+                "%d record(s) dropped, no dead letter file is configured.",
+                len(bulk_buffer))
+            return
+
+        lines = []
+        for action in bulk_buffer.get_actions():
+            (command_line, record_line) = action.split('\n', 1)
+            command = json.loads(command_line)
+            for metadata in command.values():
+                metadata.setdefault("_index", self.__es_index__)
+                metadata.setdefault("_type", self.__es_doc_type__)
+            lines.append(json.dumps(command) + '\n' + record_line)
+
+        with _dead_letter_lock:
+            with open(self.__dead_letter_file__, 'a') as dead_letter_fh:
+                # several processes might share the same file
+                fcntl.flock(dead_letter_fh, fcntl.LOCK_EX)
+                dead_letter_fh.write(''.join(lines))
+                fcntl.flock(dead_letter_fh, fcntl.LOCK_UN)
+        logging.error(
+            "%d record(s) written to %s.",
+            len(bulk_buffer), self.__dead_letter_file__)
+
+    def replay_dead_letters(self, dead_letter_file=None):
+        '''
+        Re-submits the records from a dead letter file, the records which fail
+        again are written to a new dead letter file.
+        Returns the number of re-submitted records
+        '''
+        if not dead_letter_file:
+            dead_letter_file = self.__dead_letter_file__
+        if not dead_letter_file:
+            return 0
+        # Move the file out of the way, as it might receive new failures
+        replay_file = dead_letter_file + '.' + \
+            time.strftime("%Y%m%d%H%M%S") + '.replay'
+        os.rename(dead_letter_file, replay_file)
+        counts = {"records": 0}
+
+        def read_records():
+            ''' yields the command/record pairs from the replay file '''
+            with open(replay_file) as replay_fh:
+                lines = (line for line in replay_fh if line.strip())
+                for command in lines:
+                    counts["records"] += 1
+                    yield json.loads(command), json.loads(next(lines))
+
+        for _ in self.parallel_bulk_to_es(read_records()):
+            pass
+        os.remove(replay_file)
+
+        return counts["records"]
+
+    def parallel_bulk_to_es(self, actions, thread_count=None,
+                            chunk_size=None, max_chunk_bytes=None):
+        '''
+        Bulk indexes the (index command, record) pairs produced by the actions
+        iterator, keeping up to 2 * thread_count bulk requests in flight while
+        the caller carries on producing records. The requests are submitted
+        by the bulk thread pool shared by all loaders of the process. Unless
+        chunk_size (records) and max_chunk_bytes are given, the request
+        limits are set by the shared bulk size controller.
+        Yields the bulk response of each chunk in submission order.
+        The time spent producing the records, serializing them and waiting
+        for the requests is added to the records, serialize and bulk_wait
+        stages of the process metrics.
+        '''
+        if not thread_count:
+            thread_count = BULK_THREAD_COUNT
+
+        pool = get_bulk_pool()
+        pending = deque()
+        wait_time = 0.0
+        try:
+            # Records are produced in the calling thread, so that parsing
+            # errors surface to the caller, only the requests are delegated
+            for chunk in self._chunk_actions(
+                    timed_iterator(actions, "records"), chunk_size,
+                    max_chunk_bytes):
+                pending.append(
+                    pool.apply_async(self.submit_bulk_to_es, (chunk,)))
+                # Limit the number of chunks held in memory
+                while len(pending) > 2 * thread_count:
+                    t0 = time.time()
+                    response = pending.popleft().get()
+                    wait_time += time.time() - t0
+                    yield response
+            while pending:
+                t0 = time.time()
+                response = pending.popleft().get()
+                wait_time += time.time() - t0
+                yield response
+        finally:
+            # Requests still in flight after an error are waited for, so
+            # that none outlives the call
+            t0 = time.time()
+            for result in pending:
+                result.wait()
+            wait_time += time.time() - t0
+            get_metrics().observe_stage("bulk_wait", wait_time)
+
+    def _chunk_actions(self, actions, chunk_size=None, max_chunk_bytes=None):
+        '''
+        Serializes the actions into bulk buffers of limited size
+        '''
+        controller = get_bulk_controller()
+        chunk = BulkBuffer()
+        limit = chunk_size or controller.get_chunk_size()
+        byte_limit = max_chunk_bytes or controller.get_max_chunk_bytes()
+        serialize_time = 0.0
+        try:
+            for command, record in actions:
+                t0 = time.time()
+                chunk.append(command, record)
+                serialize_time += time.time() - t0
+                if len(chunk) >= limit or chunk.get_size() >= byte_limit:
+                    yield chunk
+                    chunk = BulkBuffer()
+                    limit = chunk_size or controller.get_chunk_size()
+                    byte_limit = \
+                        max_chunk_bytes or controller.get_max_chunk_bytes()
+            if len(chunk):
+                yield chunk
+        finally:
+            get_metrics().observe_stage("serialize", serialize_time)
+
     def get_id(self):
         ''' __es_id__ is not being used at this time '''
         return self.__es_id__
@@ -208,13 +471,15 @@ class ElasticSearchTools(object):
     def count(self, query):
         ''' Performs an index search '''
         t0 = time.time()
+        res = None
         try:
             res = self.es.count(
                 index=self.__es_index__,
                 doc_type=self.__es_doc_type__,
                 body={'query': query})
         finally:
-            self.slow_query_log(t0,time.time())
+            self.slow_query_log(t0,time.time(),index=self.__es_index__
+                               ,query=query,operation="count",error=res is None)
         return res
 
     def raw_search(self, query):
@@ -232,7 +497,8 @@ class ElasticSearchTools(object):
             pass
         finally:
             self.slow_query_log(t0,time.time(),index=self.__es_index__
-                               ,query=query,doc_type=self.__es_doc_type__)
+                               ,query=query,doc_type=self.__es_doc_type__
+                               ,operation="search",took=res.get("took"),error=not res)
         return res
 
     def search(self, query):
@@ -252,23 +518,115 @@ class ElasticSearchTools(object):
             self.logerr({"error":str(e),"index":es_index,"body":query})
             pass
         finally:
-            self.slow_query_log(t0,time.time(),index=es_index,query=query)
+            self.slow_query_log(t0,time.time(),index=es_index,query=query
+                               ,operation="search",took=res.get("took"),error=not res)
         return res
 
     def global_search(self, es_index, query):
         ''' Allows searching an index other than the registered '''
         return self.global_raw_search(es_index, {'query': query})
 
+    def msearch(self, queries):
+        '''
+        Sends several searches in multi search requests, each query being
+        either a complete search body, run against the registered index, or
+        an (index, body) tuple. Returns the responses in the order of the
+        queries, an empty one for each failed search
+        '''
+        responses = []
+        for idx in range(0, len(queries), MSEARCH_BATCH_SIZE):
+            responses.extend(
+                self._msearch(queries[idx:idx + MSEARCH_BATCH_SIZE]))
+        return responses
+
+    def _msearch(self, queries):
+        ''' Sends a single multi search request '''
+        body = []
+        for query in queries:
+            if isinstance(query, tuple):
+                body.append({"index": query[0]})
+                body.append(query[1])
+            else:
+                header = {"index": self.__es_index__}
+                if self.__es_doc_type__:
+                    header["type"] = self.__es_doc_type__
+                body.append(header)
+                body.append(query)
+
+        t0 = time.time()
+        res = {}
+        try:
+            res = self.es.msearch(body=body)
+        except Exception as e:
+            self.logerr({"error":str(e),"index":self.__es_index__,"body":body})
+        finally:
+            took = [response.get("took") for response in res.get("responses", [])
+                    if response.get("took") is not None]
+            self.slow_query_log(t0,time.time(),index=self.__es_index__
+                               ,query=body,doc_type=self.__es_doc_type__
+                               ,operation="msearch",docs=len(queries)
+                               ,took=max(took) if took else None,error=not res)
+
+        responses = res.get("responses", [{}] * len(queries))
+        for idx, response in enumerate(responses):
+            if "error" in response:
+                logging.error("Search failed: %s; query: %s", response["error"], body[2*idx:2*idx+2])
+                responses[idx] = {}
+        return responses
+
+    def multi_search(self):
+        '''
+        Returns a queue of searches to be sent together as multi search
+        requests
+        '''
+        return MultiSearch(self)
+
+    def mget(self, docs, source_fields=None):
+        '''
+        Fetches documents of the registered index given their (doc type, ID)
+        pairs, in multi get requests. Returns the documents in the order
+        of the pairs, None for each document not found. source_fields
+        limits the returned _source fields
+        '''
+        results = []
+        for idx in range(0, len(docs), MGET_BATCH_SIZE):
+            results.extend(self._mget(
+                docs[idx:idx + MGET_BATCH_SIZE], source_fields))
+        return results
+
+    def _mget(self, docs, source_fields):
+        ''' Sends a single multi get request '''
+        body = {"docs": [
+            {"_type": doc_type, "_id": doc_id} for (doc_type, doc_id) in docs]}
+        kwargs = {}
+        if source_fields is not None:
+            kwargs["_source"] = source_fields
+
+        t0 = time.time()
+        res = {}
+        try:
+            res = self.es.mget(body=body, index=self.__es_index__, **kwargs)
+        finally:
+            self.slow_query_log(t0,time.time(),index=self.__es_index__
+                               ,operation="mget",docs=len(docs),error=not res)
+
+        return [
+            doc if doc.get("found") else None
+            for doc in res.get("docs", [])]
+
     def refresh_index(self):
         ''' Refreshes the index associated with this instance '''
         t0 = time.time()
+        failed = True
         try:
             self.es.indices.refresh(index=self.__es_index__)
+            failed = False
         except TransportError as error:
         #except TransportError as error:
             self.logerr(str(error))
         finally:
-            self.slow_query_log(t0,time.time())
+            self.slow_query_log(t0,time.time(),index=self.__es_index__
+                               ,operation="refresh",error=failed)
 
     def put_mapping(self, mappings):
         ''' Updates the index mappings '''
@@ -298,26 +656,203 @@ class ElasticSearchTools(object):
         )
 
     def scan(self, search_query, scroll_time=None, timeout_period=None):
-        ''' Returns an iterator object for the whole result set '''
+        '''
+        Returns an iterator object for the whole result set, each scroll
+        page being recorded in the metrics
+        '''
         if not scroll_time:
             scroll_time = "30m"
         if not timeout_period:
             timeout_period = "15m"
-        t0 = time.time()
-        # print("xxselect",search_query) #debug
-        # logging.info("xxselect; %s;",search_query) #debug
-        try:
-            rc = helpers.scan(
-                client=self.es,
+        for page in _scroll_pages(
+                self.es,
+                search_query,
+                scroll=scroll_time,
                 index=self.__es_index__,
                 doc_type=self.__es_doc_type__,
-                query=search_query,
-                scroll=scroll_time,
-                timeout=timeout_period)
+                timeout=timeout_period):
+            for hit in page:
+                yield hit
+
+    def parallel_scan(self, search_query, slices=None, ordered=False,
+                      source_fields=None, scroll_time=None,
+                      timeout_period=None):
+        '''
+        Returns an iterator object for the whole result set, read by one
+        scroll per slice, each in a separate thread. The index shards are
+        divided among the slices, by default one slice per shard, and the
+        slice results are either merged as they arrive or, if ordered is set,
+        returned one slice after another. source_fields limits the returned
+        _source fields
+        '''
+        if not scroll_time:
+            scroll_time = "30m"
+        if not timeout_period:
+            timeout_period = "15m"
+
+        query = copy.deepcopy(search_query)
+        if source_fields is not None:
+            query["_source"] = source_fields
+
+        shard_count = self.get_shard_count()
+        if not slices or slices > shard_count:
+            slices = shard_count
+        slice_shards = [range(shard_count)[idx::slices] for idx in range(slices)]
+
+        if ordered:
+            queues = [Queue.Queue(SCAN_QUEUE_SIZE) for _ in slice_shards]
+        else:
+            queues = [Queue.Queue(SCAN_QUEUE_SIZE * slices)] * slices
+        stop = threading.Event()
+
+        def scan_slice(idx):
+            ''' reads the hits of one slice into its queue '''
+            try:
+                for page in _scroll_pages(
+                        self.es,
+                        query,
+                        scroll=scroll_time,
+                        index=self.__es_index__,
+                        doc_type=self.__es_doc_type__,
+                        preference="_shards:" + ",".join(
+                            str(shard) for shard in slice_shards[idx]),
+                        timeout=timeout_period):
+                    if not _put(queues[idx], (idx, page), stop):
+                        return
+                _put(queues[idx], (idx, None), stop)
+            except Exception as e:
+                _put(queues[idx], (idx, e), stop)
+
+        t0 = time.time()
+        threads = [
+            threading.Thread(target=scan_slice, args=(idx,))
+            for idx in range(slices)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            if ordered:
+                for idx in range(slices):
+                    for hit in self._read_slices(queues[idx], [idx], slices):
+                        yield hit
+            else:
+                for hit in self._read_slices(queues[0], range(slices), slices):
+                    yield hit
+        finally:
+            # Let the slices still being read release their scroll contexts
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.slow_query_log(t0,time.time(),message="parallel scan",index=self.__es_index__
+                                ,query=query,operation="scan",tmout=0)
+
+    def _read_slices(self, hits_queue, slice_ids, slices):
+        '''
+        Yields the hits read into the queue by the given slices, logging the
+        progress of each slice
+        '''
+        slice_ids = set(slice_ids)
+        progress = {}
+        last_log = time.time()
+        while slice_ids:
+            (idx, page) = hits_queue.get()
+            if isinstance(page, Exception):
+                raise page
+            if page is None:
+                slice_ids.discard(idx)
+                logging.debug(
+                    "Scan of %s, slice %d/%d completed, %d hits.",
+                    self.__es_index__, idx + 1, slices, progress.get(idx, 0))
+                continue
+            progress[idx] = progress.get(idx, 0) + len(page)
+            if time.time() - last_log > self.__log_interval__:
+                last_log = time.time()
+                logging.debug(
+                    "Scan of %s in progress, hits per slice: %s",
+                    self.__es_index__,
+                    ", ".join(
+                        "%d: %d" % (key + 1, progress[key])
+                        for key in sorted(progress)))
+            for hit in page:
+                yield hit
+
+    def get_version(self):
+        '''
+        Returns the version of the Elastic search cluster as a tuple of
+        numbers, e.g. (2, 4, 1)
+        '''
+        number = self.es.info()["version"]["number"]
+        return tuple(
+            int(part) for part in number.split("-")[0].split(".")
+            if part.isdigit())
+
+    def reindex(self, dst_index, query, script, requests_per_second=None,
+                slices=None):
+        '''
+        Starts a server side copy of the documents of the registered index
+        matching the query into the destination index, each document being
+        transformed by the script. The copy keeps the document types and IDs
+        and runs as a task throttled to requests_per_second and split into
+        slices, where the cluster supports it. Returns the task ID
+        '''
+        body = {
+            "source": {
+                "index": self.__es_index__,
+                "query": query
+            },
+            "dest": {"index": dst_index},
+            "script": {"inline": script}
+        }
+        params = {"wait_for_completion": "false"}
+        if requests_per_second:
+            params["requests_per_second"] = requests_per_second
+        if slices and slices > 1 and \
+                self.get_version() >= SLICED_REINDEX_VERSION:
+            params["slices"] = slices
+
+        t0 = time.time()
+        res = {}
+        try:
+            res = self.es.reindex(body=body, params=params)
         finally:
-            self.slow_query_log(t0,time.time(),message="xxselect",index=self.__es_index__
-                                ,query=search_query,tmout=1.0)
-            return rc
+            self.slow_query_log(t0,time.time(),query=body,index=self.__es_index__
+                               ,operation="reindex",error=not res)
+
+        return res["task"]
+
+    def get_task(self, task_id):
+        '''
+        Returns the status of a task along with whether it has completed,
+        tasks no longer listed being completed. The status of a reindex
+        task holds its total, created and updated document counts, and once
+        completed its failures
+        '''
+        try:
+            res = self.es.tasks.list(task_id=task_id, detailed="true")
+        except NotFoundError:
+            return (True, {})
+
+        if "task" in res:
+            status = dict(res["task"].get("status", {}))
+            status["failures"] = res.get("response", {}).get("failures", [])
+            return (res.get("completed", False), status)
+
+        for node in res.get("nodes", {}).values():
+            for task in node.get("tasks", {}).values():
+                return (False, task.get("status", {}))
+
+        return (True, {})
+
+    def get_shard_count(self):
+        '''
+        Returns the number of shards of the index, or the largest one among
+        the indices in case of an alias
+        '''
+        settings = self.es.indices.get_settings(index=self.__es_index__)
+        return max(
+            int(index_settings["settings"]["index"]["number_of_shards"])
+            for index_settings in settings.values())
 
     def put_settings(self, body=None):
         ''' Applies the specified index settings '''
@@ -332,7 +867,13 @@ class ElasticSearchTools(object):
     def forcemerge(self):
         ''' Wrapper function for es.indices.forcemerge '''
 
-        result = self.es.indices.forcemerge(index=self.__es_index__, request_timeout=120)
+        t0 = time.time()
+        result = None
+        try:
+            result = self.es.indices.forcemerge(index=self.__es_index__, request_timeout=120)
+        finally:
+            self.slow_query_log(t0,time.time(),index=self.__es_index__
+                               ,operation="forcemerge",tmout=120.0,error=result is None)
 
         return result["_shards"]["successful"] == result["_shards"]["total"]
 
@@ -372,17 +913,217 @@ class ElasticSearchTools(object):
             index_name = self.__es_index__
         return self.es.indices.put_alias(name=alias_name, index=index_name)
 
+class MultiSearch(object):
+
+    '''
+    Queues searches, which are sent together by execute, one multi search
+    request per MSEARCH_BATCH_SIZE searches
+    '''
+
+    def __init__(self, es_tools):
+        self.__es_tools__ = es_tools
+        self.__queries__ = []
+
+    def __len__(self):
+        ''' Returns the number of queued searches '''
+        return len(self.__queries__)
+
+    def add(self, query, index=None):
+        '''
+        Queues a complete search body, run against the given index or the
+        registered one, returns the position of its response
+        '''
+        if index:
+            query = (index, query)
+        self.__queries__.append(query)
+        return len(self.__queries__) - 1
+
+    def execute(self):
+        '''
+        Sends the queued searches and returns their responses in order,
+        an empty one for each failed search
+        '''
+        queries = self.__queries__
+        self.__queries__ = []
+        if not queries:
+            return []
+        return self.__es_tools__.msearch(queries)
+
+
+def get_bulk_pool():
+    '''
+    Returns the thread pool submitting the bulk requests of the process
+    '''
+    global _bulk_pool, _bulk_pool_pid
+    with _bulk_pool_lock:
+        if _bulk_pool is None or _bulk_pool_pid != os.getpid():
+            _bulk_pool = ThreadPool(BULK_POOL_SIZE)
+            _bulk_pool_pid = os.getpid()
+        return _bulk_pool
+
+
+def get_client(host=None, port=None, use_ssl=False, http_auth=None,
+               timeout=TIMEOUT, maxsize=None):
+    '''
+    Returns the Elastic search client of the process for the given
+    connection settings, creating it on first use, in which case maxsize
+    sets the number of HTTP connections it keeps alive. Clients are not
+    shared with forked processes
+    '''
+    if host == FAKE_HOST:
+        return get_fake_client()
+    if isinstance(http_auth, list):
+        http_auth = tuple(http_auth)
+    if not maxsize:
+        maxsize = CONNECTION_POOL_SIZE
+    pid = os.getpid()
+    key = (host, port, use_ssl, http_auth, timeout, pid)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+        # Drop the clients inherited from the parent process
+        for client_key in _clients.keys():
+            if client_key[-1] != pid:
+                del _clients[client_key]
+        if host is None and port is None:
+            client = Elasticsearch(timeout=timeout, maxsize=maxsize)
+        else:
+            client = Elasticsearch(
+                [host],
+                port=port,
+                use_ssl=use_ssl,
+                http_auth=http_auth,
+                timeout=timeout,
+                maxsize=maxsize
+            )
+        _clients[key] = client
+        return client
+
+
+def _get_failed_records(bulk_response):
+    '''
+    Given a bulk request response, returns the positions of the records
+    rejected because of a full queue, those of the records which failed for
+    any other reason and the errors of the latter
+    '''
+    rejected = []
+    failed = []
+    errors = []
+    if not bulk_response.get("errors"):
+        return rejected, failed, errors
+    for idx, item in enumerate(bulk_response["items"]):
+        for result in item.values():
+            if "error" not in result:
+                continue
+            if result.get("status") == 429 or \
+                    "rejected_execution" in str(result["error"]).lower():
+                rejected.append(idx)
+            else:
+                failed.append(idx)
+                errors.append(result)
+    return rejected, failed, errors
+
+
+def configure_dead_letters(dead_letter_file):
+    '''
+    Sets the dead letter file of the process, used by the Elastic search
+    tools which don't set their own
+    '''
+    ElasticSearchTools.__dead_letter_file__ = dead_letter_file
+
+
+def _is_retryable(error, idempotent=True):
+    '''
+    Checks whether a failed request can be retried, i.e. the cluster is
+    temporarily overloaded or unreachable. Requests rejected as a whole
+    are always retried, while requests failing otherwise might have been
+    applied, and are retried only if they are idempotent
+    '''
+    if getattr(error, "status_code", None) == 429:
+        return True
+    if not idempotent:
+        return False
+    if isinstance(error, EsConnectionError):
+        return True
+    return getattr(error, "status_code", None) == 503
+
+
+def _get_backoff(attempt):
+    '''
+    Returns a random delay before the given retry attempt, drawn from an
+    exponentially growing range
+    '''
+    return random.uniform(
+        0, min(BULK_MAX_BACKOFF, BULK_INITIAL_BACKOFF * 2 ** attempt))
+
+
+def _scroll_pages(client, query, scroll, size=SCAN_PAGE_SIZE, **kwargs):
+    '''
+    Same as helpers.scan, but yields whole pages of hits, the time spent on
+    each request is recorded in the metrics as a scan page
+    '''
+    metrics = get_metrics()
+    t0 = time.time()
+    resp = client.search(
+        body=query, scroll=scroll, size=size, search_type='scan', **kwargs)
+    metrics.observe("scan_page", time.time() - t0, took=resp.get("took"))
+    scroll_id = resp.get('_scroll_id')
+    if scroll_id is None:
+        return
+
+    try:
+        while True:
+            t0 = time.time()
+            resp = client.scroll(scroll_id, scroll=scroll)
+            metrics.observe(
+                "scan_page", time.time() - t0, took=resp.get("took"),
+                docs=len(resp["hits"]["hits"]))
+            if resp["hits"]["hits"]:
+                yield resp["hits"]["hits"]
+            if resp["_shards"]["failed"]:
+                logging.warn(
+                    'Scroll request has failed on %d shards out of %d.',
+                    resp['_shards']['failed'], resp['_shards']['total'])
+            scroll_id = resp.get('_scroll_id')
+            if scroll_id is None or not resp['hits']['hits']:
+                break
+    finally:
+        if scroll_id:
+            client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404, ))
+
+
+def _put(target_queue, item, stop):
+    '''
+    Puts an item on a bounded queue unless the consumer has stopped reading,
+    returns whether the item has been queued
+    '''
+    while not stop.is_set():
+        try:
+            target_queue.put(item, timeout=1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
 ##############################################
 ######  TESTS             ####################
 ##############################################
 
+import tempfile
 import unittest
+from elasticsearch.exceptions import ConnectionTimeout
 
 
 class EsUtilsTests(unittest.TestCase):
 
+    # The tests run against the Elastic search server given by ES_TEST_HOST
+    # and ES_TEST_PORT, ES_TEST_HOST=memory runs them in memory
     es_tools = ElasticSearchTools("estest", "estest_index")
-    es_tools.init_host(host="localhost", port=9200)
+    es_tools.init_host(
+        host=os.environ.get("ES_TEST_HOST", "localhost"),
+        port=int(os.environ.get("ES_TEST_PORT", 9200)))
 
     indexCmd = {"index": {"_index": "estest_index", "_type": "estest"}}
     doc = {
@@ -508,6 +1249,172 @@ class EsUtilsTests(unittest.TestCase):
         results = self.es_tools.search({'match': {'user': 'arisetyo'}})
         self.failUnless(results['hits']['total'] == 2)
 
+    def patch_bulk(self, failures):
+        '''
+        Makes the bulk requests fail with the errors added to the given
+        list, one per request, the requests timing out being applied first.
+        Returns the list of backoff attempts, the retries being made without
+        waiting
+        '''
+        global _get_backoff
+        get_backoff = _get_backoff
+        bulk = self.es_tools.es.bulk
+        attempts = []
+
+        def failing_bulk(*args, **kwargs):
+            ''' fails the request with the next error, if any '''
+            if not failures:
+                return bulk(*args, **kwargs)
+            error = failures.pop(0)
+            if isinstance(error, ConnectionTimeout):
+                bulk(*args, **kwargs)
+            raise error
+
+        def restore():
+            ''' restores the bulk requests and the backoff '''
+            global _get_backoff
+            _get_backoff = get_backoff
+            del self.es_tools.es.bulk
+
+        _get_backoff = lambda attempt: attempts.append(attempt) or 0
+        self.es_tools.es.bulk = failing_bulk
+        self.addCleanup(restore)
+        return attempts
+
+    def set_dead_letter_file(self):
+        ''' Writes the dead letters to a temporary file, returns its name '''
+        (file_handle, dead_letter_file) = tempfile.mkstemp(suffix=".ndjson")
+        os.close(file_handle)
+        os.remove(dead_letter_file)
+        self.es_tools.set_dead_letter_file(dead_letter_file)
+        self.addCleanup(self.es_tools.set_dead_letter_file, DEAD_LETTER_FILE)
+        return dead_letter_file
+
+    def read_dead_letters(self, dead_letter_file):
+        ''' Returns the lines of a dead letter file, then removes it '''
+        if not os.path.isfile(dead_letter_file):
+            return []
+        with open(dead_letter_file) as dead_letter_fh:
+            lines = dead_letter_fh.readlines()
+        os.remove(dead_letter_file)
+        return lines
+
+    def get_total(self):
+        ''' Returns the number of indexed documents '''
+        if not self.es_tools.exists_index():
+            return 0
+        self.es_tools.refresh_index()
+        return self.es_tools.search({'match_all': {}})['hits']['total']
+
+    def test_backoff(self):
+        for attempt in range(1, BULK_MAX_RETRIES + 1):
+            bound = min(BULK_MAX_BACKOFF, BULK_INITIAL_BACKOFF * 2 ** attempt)
+            for _ in range(100):
+                self.failUnless(0 <= _get_backoff(attempt) <= bound)
+
+    @unittest.skipUnless(
+        os.environ.get("ES_TEST_HOST") == FAKE_HOST, "needs the memory host")
+    def test_bulk_retry(self):
+        self.es_tools.delete_index()
+        dead_letter_file = self.set_dead_letter_file()
+        rejection = TransportError(429, "es_rejected_execution_exception")
+
+        failures = []
+        attempts = self.patch_bulk(failures)
+
+        # Rejected requests are retried with a growing backoff
+        failures.extend([rejection, rejection])
+        self.es_tools.submit_bulk_to_es(
+            [self.indexCmd, self.doc, self.indexCmd, self.doc2])
+        self.failUnless(attempts == [1, 2])
+        self.failUnless(self.get_total() == 2)
+
+        # Until the retries run out
+        del attempts[:]
+        failures.extend([rejection] * (BULK_MAX_RETRIES + 1))
+        self.es_tools.submit_bulk_to_es([self.indexCmd, self.doc3])
+        self.failUnless(attempts == range(1, BULK_MAX_RETRIES + 1))
+        self.failUnless(self.get_total() == 2)
+        self.failUnless(len(self.read_dead_letters(dead_letter_file)) == 2)
+
+        # Other errors aren't retried
+        del attempts[:]
+        failures.append(TransportError(400, "mapper_parsing_exception"))
+        self.es_tools.submit_bulk_to_es([self.indexCmd, self.doc4])
+        self.failUnless(attempts == [])
+        self.failUnless(len(self.read_dead_letters(dead_letter_file)) == 2)
+
+    @unittest.skipUnless(
+        os.environ.get("ES_TEST_HOST") == FAKE_HOST, "needs the memory host")
+    def test_bulk_timeout(self):
+        self.es_tools.delete_index()
+        dead_letter_file = self.set_dead_letter_file()
+
+        failures = []
+        attempts = self.patch_bulk(failures)
+
+        # Records without IDs aren't sent again, as the request might have
+        # been applied
+        failures.append(ConnectionTimeout("TIMEOUT", "timed out", None))
+        self.es_tools.submit_bulk_to_es(
+            [self.indexCmd, self.doc, self.indexCmd, self.doc2])
+        self.failUnless(attempts == [])
+        self.failUnless(len(self.read_dead_letters(dead_letter_file)) == 4)
+
+        # Records with IDs are
+        failures.append(ConnectionTimeout("TIMEOUT", "timed out", None))
+        id_cmd = {"index": {"_type": "estest", "_id": "doc3"}}
+        self.es_tools.submit_bulk_to_es([id_cmd, self.doc3])
+        self.failUnless(attempts == [1])
+        self.failUnless(self.read_dead_letters(dead_letter_file) == [])
+
+        self.failUnless(self.get_total() == 3)
+
+    @unittest.skipUnless(
+        os.environ.get("ES_TEST_HOST") == FAKE_HOST, "needs the memory host")
+    def test_dead_letters(self):
+        from elasticsearchloader.es_replay_dead_letters import \
+            replay_dead_letters
+
+        self.es_tools.delete_index()
+        dead_letter_file = self.set_dead_letter_file()
+
+        self.patch_bulk([TransportError(400, "mapper_parsing_exception")])
+        self.es_tools.submit_bulk_to_es(
+            [self.indexCmd, self.doc,
+             {"index": {"_type": "estest", "_id": "doc2"}}, self.doc2])
+        self.failUnless(self.get_total() == 0)
+
+        # The commands keep their IDs and get the index and type of the
+        # request
+        with open(dead_letter_file) as dead_letter_fh:
+            lines = [json.loads(line) for line in dead_letter_fh]
+        self.failUnless(lines[1]["user"] == self.doc["user"])
+        self.failUnless(lines[2] == {"index": {
+            "_index": "estest_index", "_type": "estest", "_id": "doc2"}})
+
+        self.failUnless(replay_dead_letters(
+            dead_letter_file, host=FAKE_HOST) == 2)
+        self.failUnless(self.get_total() == 2)
+        self.failUnless(
+            self.es_tools.search({'match': {'user': 'arisetyo2'}})
+            ['hits']['hits'][0]['_id'] == "doc2")
+        # Nothing is left once replayed
+        self.failUnless(not os.path.exists(dead_letter_file))
+        self.failUnless(not [
+            name for name in os.listdir(os.path.dirname(dead_letter_file))
+            if name.startswith(os.path.basename(dead_letter_file))])
+
+    @unittest.skipUnless(
+        os.environ.get("ES_TEST_HOST") == FAKE_HOST, "needs the memory host")
+    def test_dropped_records(self):
+        self.es_tools.delete_index()
+        self.es_tools.set_dead_letter_file(None)
+        self.addCleanup(self.es_tools.set_dead_letter_file, DEAD_LETTER_FILE)
+        self.patch_bulk([TransportError(400, "mapper_parsing_exception")])
+        self.es_tools.submit_bulk_to_es([self.indexCmd, self.doc])
+        self.failUnless(self.get_total() == 0)
+        self.failUnless(self.es_tools.replay_dead_letters() == 0)
 
 def main():
     ''' Runs the unit tests '''
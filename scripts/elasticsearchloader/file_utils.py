@@ -11,10 +11,45 @@ Simple file hadling functions
 
 '''
 
+import io
 import os
 import re
 import csv
+import zlib
+import Queue
+import struct
+import hashlib
+import itertools
+import logging
+import threading
+import subprocess
+from collections import deque
 from datetime import date
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Algorithms available for input file checksums
+CHECKSUM_ALGORITHMS = ['md5', 'sha1', 'sha256']
+
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+# Size of the compressed data read at once
+READ_SIZE = 1024 * 1024
+
+# Number of lines LineReader.read reads at once
+READ_LINES = 1024
+
+# Number of decompressed chunks kept ahead of the parser
+QUEUE_CHUNKS = 16
+
+# Number of BGZF blocks, of up to 64 KB each, decompressed by a single task
+BGZF_BATCH_BLOCKS = 64
 
 
 class MissingInformation(Exception):
@@ -113,3 +148,653 @@ def getFileList(path):
             # the file is a single analysis
             return [path]
         f.close()
+
+
+class LineReader(object):
+
+    '''
+    Reads the lines of an input file or stream in a single pass. The lines
+    read ahead, i.e. while detecting the file format or parsing the header,
+    are replayed after rewind, so that the input doesn't need to be
+    seekable. Non-comment, non-empty lines are counted as they are read,
+    the same way AnalysisLoader.count_input_lines does, and a checksum of
+    the content can be computed along the way.
+    '''
+
+    def __init__(self, input_file, checksum=None):
+        if isinstance(input_file, basestring):
+            self.__file__ = open_input(input_file)
+            self.__close__ = True
+        else:
+            self.__file__ = input_file
+            self.__close__ = False
+        self.name = getattr(self.__file__, 'name', '<stream>')
+        self.__lines__ = iter(self.__file__)
+        self.__buffer__ = []
+        self.__position__ = 0
+        self.__recording__ = True
+        self.__checksum__ = hashlib.new(checksum) if checksum else None
+        self.lines_read = 0
+        self.input_lines = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        ''' Returns the next line '''
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    __next__ = next
+
+    def readline(self):
+        ''' Returns the next line, an empty string at the end of the input '''
+        if self.__position__ < len(self.__buffer__):
+            self.__position__ += 1
+            return self.__buffer__[self.__position__ - 1]
+
+        if not self.__recording__ and self.__buffer__:
+            # All read ahead lines have been replayed
+            self.__buffer__ = []
+            self.__position__ = 0
+
+        line = next(self.__lines__, '')
+        if line:
+            self.lines_read += 1
+            if line != '\n' and not line.startswith('#'):
+                self.input_lines += 1
+            if self.__checksum__:
+                self.__checksum__.update(line)
+            if self.__recording__:
+                self.__buffer__.append(line)
+                self.__position__ += 1
+        return line
+
+    def read(self, size=-1):
+        '''
+        Returns whole lines adding up to at least size bytes, all of the
+        remaining lines if size is negative. Once the lines read ahead have
+        been replayed, lines are read and counted in batches
+        '''
+        lines = []
+        length = 0
+        while (size < 0 or length < size) and (
+                self.__recording__ or
+                self.__position__ < len(self.__buffer__)):
+            line = self.readline()
+            if not line:
+                return ''.join(lines)
+            lines.append(line)
+            length += len(line)
+
+        if self.__recording__:
+            return ''.join(lines)
+        if self.__buffer__ and self.__position__ == len(self.__buffer__):
+            # All read ahead lines have been replayed
+            self.__buffer__ = []
+            self.__position__ = 0
+        while size < 0 or length < size:
+            batch = list(itertools.islice(self.__lines__, READ_LINES))
+            if not batch:
+                break
+            block = ''.join(batch)
+            self._count_lines(batch, block)
+            lines.append(block)
+            length += len(block)
+        return ''.join(lines)
+
+    def _count_lines(self, batch, block):
+        ''' Counts a batch of lines read, joined into a block '''
+        self.lines_read += len(batch)
+        if block.startswith(('\n', '#')) or '\n\n' in block or \
+                '\n#' in block:
+            self.input_lines += sum(
+                1 for line in batch
+                if line != '\n' and not line.startswith('#'))
+        else:
+            self.input_lines += len(batch)
+        if self.__checksum__:
+            self.__checksum__.update(block)
+
+    def rewind(self, keep=False):
+        '''
+        Replays the lines read so far, unless keep is set the lines read
+        from then on are no longer kept for another rewind
+        '''
+        self.__position__ = 0
+        self.__recording__ = keep
+
+    def get_checksum(self):
+        ''' Returns the checksum of the lines read, if requested '''
+        if self.__checksum__:
+            return self.__checksum__.hexdigest()
+        return None
+
+    def get_stats(self):
+        ''' Returns the line count and checksum, as parse stats '''
+        stats = {"input_lines": self.input_lines}
+        if self.__checksum__:
+            stats["checksum"] = self.get_checksum()
+        return stats
+
+    def close(self):
+        ''' Closes the input file, if opened by the reader '''
+        if self.__close__:
+            self.__file__.close()
+
+
+def get_compression(file_name):
+    '''
+    Returns the compression of a file, bgzip, gzip or zstd, None for plain
+    text files
+    '''
+    with open(file_name, 'rb') as input_fh:
+        return _get_head_compression(input_fh.read(16))
+
+
+def _get_head_compression(head):
+    '''
+    Returns the compression given the first bytes of a file, a gzip file
+    being recognized as bgzip from its first 16 bytes
+    '''
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if head.startswith(GZIP_MAGIC):
+        # BGZF blocks are gzip members whose extra field holds the block
+        # size in a 'BC' subfield
+        if len(head) == 16 and ord(head[3]) & 4 and head[12:14] == 'BC':
+            return 'bgzip'
+        return 'gzip'
+    return None
+
+
+def get_file_checksum(file_name, checksum):
+    '''
+    Returns the checksum of the raw content of a file, for binary formats
+    not read line by line
+    '''
+    file_hash = hashlib.new(checksum)
+    with open(file_name, 'rb') as input_fh:
+        for block in iter(lambda: input_fh.read(READ_SIZE), ''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def open_input(file_name, threads=None):
+    '''
+    Opens an input file, compressed files are decompressed by a background
+    thread as they are read, bgzip files using the given number of threads.
+    The file is opened once, its compression being told from the bytes
+    buffered by the first read, so that pipes can be read as well
+    '''
+    input_fh = io.open(file_name, 'rb')
+    try:
+        (head, input_fh) = _read_head(input_fh, 16)
+        compression = _get_head_compression(head)
+    except Exception:
+        input_fh.close()
+        raise
+    if not compression:
+        return input_fh
+
+    logging.info("Reading %s compressed file %s.", compression, file_name)
+    return DecompressedFile(input_fh, compression, threads)
+
+
+def _read_head(input_fh, size):
+    '''
+    Returns the first bytes of a binary file, up to size bytes, along with
+    the file to read from then on. The bytes are peeked at if the first
+    read buffers them all, otherwise they are read, the file being rewound,
+    or, if it can't be, replayed ahead of the rest of the content
+    '''
+    head = input_fh.peek(size)[:size]
+    if len(head) == size:
+        return (head, input_fh)
+
+    # A pipe may hold fewer bytes than the first read asked for, reads
+    # return size bytes unless the end of the file is reached
+    head = input_fh.read(size)
+    if input_fh.seekable():
+        input_fh.seek(0)
+        return (head, input_fh)
+    return (head, HeadReplayFile(head, input_fh))
+
+
+class HeadReplayFile(object):
+
+    '''
+    A binary file which can't be rewound, whose first bytes, read ahead,
+    are returned again before the rest of its content
+    '''
+
+    def __init__(self, head, input_fh):
+        self.name = getattr(input_fh, 'name', '<stream>')
+        self.__head__ = head
+        self.__file__ = input_fh
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        while self.__head__:
+            yield self.readline()
+        for line in self.__file__:
+            yield line
+
+    def read(self, size=-1):
+        ''' Returns size bytes, all of the remaining ones if negative '''
+        head = self.__head__
+        if not head:
+            return self.__file__.read(size)
+        if size < 0:
+            self.__head__ = ''
+            return head + self.__file__.read()
+        self.__head__ = head[size:]
+        head = head[:size]
+        if len(head) < size:
+            head += self.__file__.read(size - len(head))
+        return head
+
+    def readline(self):
+        ''' Returns the next line, an empty string at the end of the file '''
+        head = self.__head__
+        if not head:
+            return self.__file__.readline()
+        end = head.find('\n') + 1
+        if end:
+            self.__head__ = head[end:]
+            return head[:end]
+        self.__head__ = ''
+        return head + self.__file__.readline()
+
+    def close(self):
+        ''' Closes the file '''
+        self.__file__.close()
+
+
+class DecompressedFile(object):
+
+    '''
+    The lines of a compressed file, given by name or as a binary file
+    object. The file is decompressed in a background thread, up to
+    QUEUE_CHUNKS chunks ahead of the reader.
+    '''
+
+    def __init__(self, input_file, compression, threads=None):
+        if isinstance(input_file, basestring):
+            input_file = open(input_file, 'rb')
+        self.name = getattr(input_file, 'name', '<stream>')
+        self.__file__ = input_file
+        self.__queue__ = Queue.Queue(QUEUE_CHUNKS)
+        self.__closed__ = False
+
+        if compression == 'bgzip':
+            chunks = _bgzf_chunks(self.__file__, threads or cpu_count())
+        elif compression == 'gzip':
+            chunks = _gzip_chunks(self.__file__)
+        else:
+            chunks = _zstd_chunks(self.__file__)
+
+        self.__thread__ = threading.Thread(
+            target=self._decompress, args=(chunks,))
+        self.__thread__.daemon = True
+        self.__thread__.start()
+        self.__lines__ = self._get_lines()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self.__lines__
+
+    def next(self):
+        ''' Returns the next line '''
+        return next(self.__lines__)
+
+    __next__ = next
+
+    def readline(self):
+        ''' Returns the next line, an empty string at the end of the file '''
+        return next(self.__lines__, '')
+
+    def close(self):
+        ''' Stops the decompression and closes the file '''
+        self.__closed__ = True
+        self.__thread__.join()
+        self.__file__.close()
+
+    def _decompress(self, chunks):
+        '''
+        Queues the decompressed chunks, followed by None, or by the error
+        that interrupted the decompression
+        '''
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+            self._put(None)
+        except Exception as error:
+            self._put(error)
+        finally:
+            chunks.close()
+
+    def _put(self, item):
+        ''' Queues an item unless the file is closed in the meantime '''
+        while not self.__closed__:
+            try:
+                self.__queue__.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _get_lines(self):
+        ''' Splits the decompressed chunks into lines '''
+        pending = ''
+        while True:
+            chunk = self.__queue__.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise IOError(
+                    "Unable to decompress %s: %s" % (self.name, chunk))
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+
+def _gzip_chunks(input_fh):
+    ''' Decompresses a gzip file, which may hold several members '''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        data = input_fh.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+            if data:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def _bgzf_chunks(input_fh, threads):
+    '''
+    Decompresses a BGZF file, batches of blocks being decompressed in
+    parallel threads (zlib releases the interpreter lock)
+    '''
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        batch = []
+        for block in _bgzf_blocks(input_fh):
+            batch.append(block)
+            if len(batch) < BGZF_BATCH_BLOCKS:
+                continue
+            pending.append(pool.apply_async(_inflate_blocks, (batch,)))
+            batch = []
+            # Keeps a bounded number of batches in flight, in order
+            while len(pending) > 2 * threads:
+                yield pending.popleft().get()
+        if batch:
+            pending.append(pool.apply_async(_inflate_blocks, (batch,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def _bgzf_blocks(input_fh):
+    '''
+    Yields the compressed data, CRC and size of each block of a BGZF file
+    '''
+    while True:
+        header = input_fh.read(12)
+        if not header:
+            return
+        if len(header) < 12 or not header.startswith(GZIP_MAGIC):
+            raise IOError("Invalid BGZF block header")
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        extra = input_fh.read(extra_length)
+
+        block_size = None
+        position = 0
+        while position + 4 <= len(extra):
+            (subfield_id, subfield_length) = struct.unpack(
+                '<2sH', extra[position:position + 4])
+            if subfield_id == 'BC':
+                block_size = struct.unpack(
+                    '<H', extra[position + 4:position + 6])[0] + 1
+            position += 4 + subfield_length
+        if block_size is None:
+            raise IOError("BGZF block without a size")
+
+        data = input_fh.read(block_size - 12 - extra_length)
+        (crc, size) = struct.unpack('<II', data[-8:])
+        yield (data[:-8], crc, size)
+
+
+def _inflate_blocks(blocks):
+    ''' Decompresses and checks a batch of BGZF blocks '''
+    chunks = []
+    for (data, crc, size) in blocks:
+        chunk = zlib.decompress(data, -zlib.MAX_WBITS)
+        if len(chunk) != size or zlib.crc32(chunk) & 0xffffffff != crc:
+            raise IOError("BGZF block CRC mismatch")
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+
+def _zstd_chunks(input_fh):
+    '''
+    Decompresses a zstd file, using the zstandard module if available and
+    the zstd command otherwise
+    '''
+    if zstandard:
+        reader = zstandard.ZstdDecompressor().stream_reader(input_fh)
+        while True:
+            chunk = reader.read(READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    # The input is fed through a pipe, as part of it may already have been
+    # buffered by the file object
+    process = subprocess.Popen(
+        ['zstd', '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    feeder = threading.Thread(target=_feed_process, args=(input_fh, process))
+    feeder.daemon = True
+    feeder.start()
+    try:
+        while True:
+            chunk = process.stdout.read(READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        if process.wait():
+            raise IOError("zstd exited with status %d" % process.returncode)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        feeder.join()
+
+
+def _feed_process(input_fh, process):
+    ''' Writes the content of a file to the input of a process '''
+    try:
+        for block in iter(lambda: input_fh.read(READ_SIZE), ''):
+            process.stdin.write(block)
+    except (IOError, OSError, ValueError):
+        # The process has exited or the file has been closed
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+##############################################
+######  TESTS             ####################
+##############################################
+
+import gzip
+import time
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+
+
+def write_bgzf(file_name, content, block_size=100):
+    '''
+    Writes content as a BGZF file, in blocks of block_size bytes followed
+    by the empty end of file block
+    '''
+    with open(file_name, 'wb') as output_fh:
+        blocks = [content[start:start + block_size]
+                  for start in range(0, len(content), block_size)]
+        for block in blocks + ['']:
+            compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+            data = compressor.compress(block) + compressor.flush()
+            output_fh.write(
+                GZIP_MAGIC + '\x08\x04' + '\x00' * 4 + '\x00\xff' +
+                struct.pack('<H2sHH', 6, 'BC', 2, len(data) + 25) +
+                data +
+                struct.pack('<II', zlib.crc32(block) & 0xffffffff,
+                            len(block)))
+
+
+class FileUtilsTests(unittest.TestCase):
+
+    content = "".join(
+        "%d\tchr%d\t%d\n" % (idx, idx % 24, idx * 1000) for idx in range(500))
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def get_file_name(self, name):
+        ''' returns the path of a file of the test directory '''
+        return os.path.join(self.data_dir, name)
+
+    def read_lines(self, file_name):
+        ''' returns the lines of an input file '''
+        input_fh = open_input(file_name)
+        try:
+            return list(input_fh)
+        finally:
+            input_fh.close()
+
+    def check_file(self, file_name, compression):
+        ''' checks the compression and content of a file '''
+        self.failUnless(get_compression(file_name) == compression)
+        self.failUnless(
+            self.read_lines(file_name) == self.content.splitlines(True))
+
+    def test_gzip_members(self):
+        file_name = self.get_file_name("members.gz")
+        middle = len(self.content) // 2
+        for part in [self.content[:middle], self.content[middle:]]:
+            with gzip.open(file_name, 'ab') as output_fh:
+                output_fh.write(part)
+        self.check_file(file_name, 'gzip')
+
+    def test_bgzf(self):
+        file_name = self.get_file_name("blocks.gz")
+        write_bgzf(file_name, self.content)
+        self.check_file(file_name, 'bgzip')
+
+    @unittest.skipUnless(
+        zstandard or find_executable('zstd'), "needs zstandard or zstd")
+    def test_zstd(self):
+        file_name = self.get_file_name("content.zst")
+        if zstandard:
+            with open(file_name, 'wb') as output_fh:
+                output_fh.write(
+                    zstandard.ZstdCompressor().compress(self.content))
+        else:
+            process = subprocess.Popen(
+                ['zstd', '-q', '-c'], stdin=subprocess.PIPE,
+                stdout=open(file_name, 'wb'))
+            process.communicate(self.content)
+        self.check_file(file_name, 'zstd')
+
+    def test_short_head(self):
+        # Files shorter than the head
+        file_name = self.get_file_name("short.tsv")
+        with open(file_name, 'w') as output_fh:
+            output_fh.write("a\tb\n")
+        self.failUnless(self.read_lines(file_name) == ["a\tb\n"])
+
+        # Pipes whose first read returns part of the head only
+        bgzf_name = self.get_file_name("blocks.gz")
+        write_bgzf(bgzf_name, self.content)
+        with open(bgzf_name, 'rb') as bgzf_fh:
+            data = bgzf_fh.read()
+
+        def write_pipe(pipe_name, parts):
+            ''' writes the parts to a pipe, pausing in between '''
+            with open(pipe_name, 'wb', 0) as pipe_fh:
+                for part in parts:
+                    pipe_fh.write(part)
+                    time.sleep(0.1)
+
+        def read_pipe(content, read):
+            ''' reads a pipe whose first read returns 5 bytes '''
+            pipe_name = self.get_file_name("input.pipe")
+            os.mkfifo(pipe_name)
+            writer = threading.Thread(
+                target=write_pipe,
+                args=(pipe_name, [content[:5], content[5:]]))
+            writer.start()
+            try:
+                return read(pipe_name)
+            finally:
+                writer.join()
+                os.remove(pipe_name)
+
+        def read_head(pipe_name):
+            ''' returns the head of a pipe, then the whole content '''
+            (head, input_fh) = _read_head(io.open(pipe_name, 'rb'), 16)
+            with input_fh:
+                return (head, input_fh.read())
+
+        (head, content) = read_pipe(data, read_head)
+        self.failUnless(head == data[:16] and content == data)
+        self.failUnless(_get_head_compression(head) == 'bgzip')
+
+        def read_lines(pipe_name):
+            ''' returns the lines of a pipe, as the loaders read them '''
+            with LineReader(pipe_name) as input_lines:
+                return list(input_lines)
+
+        for content in [data, self.content]:
+            self.failUnless(read_pipe(content, read_lines) ==
+                            self.content.splitlines(True))
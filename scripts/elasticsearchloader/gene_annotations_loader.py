@@ -93,7 +93,7 @@ class GeneAnnotationsLoader(AnalysisLoader):
         )
         gene_annotations_values = copy.deepcopy(header_values)
 
-        infile_handle.seek(0, 0)
+        infile_handle.rewind(keep=True)
         line = infile_handle.readline().strip()
         while line.startswith('#'):
             if line.startswith('#!'):
@@ -124,7 +124,7 @@ class GeneAnnotationsLoader(AnalysisLoader):
         return gene_annotations_values
 
     def validate_input_file(self, filename):
-        if not filename.endswith('.gtf'):
+        if not re.sub(r'\.(gz|bgz|zst)$', '', filename).endswith('.gtf'):
             logging.info(
                 "%s Not a valid input file name. It must end with '.gtf'",
                 filename)
@@ -0,0 +1,352 @@
+'''
+Parser/indexer for analysis results in Parquet file format
+
+The files are read one row group at a time, only the columns that are
+indexed being read. Values keep the types stored in the file, no string
+conversion taking place, and the column types are used as the field types
+and Elastic search mappings, unless the header specifies otherwise.
+'''
+
+import __builtin__
+import logging
+import math
+import os
+from elasticsearchloader.csv_loader import CsvLoader
+from elasticsearchloader.csv_loader import _ColumnValues
+from elasticsearchloader.file_utils import get_file_checksum
+from sets import Set
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+# Elastic search field types of the loader field types, string fields are
+# mapped by the default dynamic template
+ES_FIELD_TYPES = {
+    "int": "long",
+    "float": "double",
+    "bool": "boolean",
+    "date": "date"
+}
+
+
+class ParquetLoader(CsvLoader):
+
+    ''' Class ParquetLoader '''
+
+    def parse(
+            self,
+            analysis_file=None,
+            custom_header=None,
+            analysis_data=None,
+            engine=None,
+            workers=None,
+            checksum=None):
+        '''
+        Parses and indexes the content of a Parquet file, row group by row
+        group. The CSV engine and workers don't apply, the number of rows
+        and the checksum of the file, computed using the given algorithm if
+        any, are returned in the parse stats
+        '''
+        if analysis_data is not None and (
+                not isinstance(analysis_data, list) or analysis_data):
+            return super(ParquetLoader, self).parse(
+                analysis_file, custom_header, analysis_data)
+
+        if parquet is None:
+            logging.error("Loading Parquet files requires pyarrow.")
+            exit(1)
+
+        if engine or workers:
+            logging.info(
+                "Parquet files are read by column, ignoring the CSV " +
+                "engine and workers.")
+
+        if "field_types" in custom_header.keys():
+            self.__field_types__.update(custom_header["field_types"])
+            del custom_header["field_types"]
+
+        if "field_ignore" in custom_header.keys():
+            self.__field_ignore__.update(custom_header["field_ignore"])
+            del custom_header["field_ignore"]
+
+        header_data = {}
+        header_data.update(custom_header)
+        header_data['source_id'] = self.__load_id__
+        header_data['file_fullname'] = os.path.abspath(analysis_file)
+
+        self.disable_index_refresh()
+
+        try:
+            stats = self._index_parquet_file(header_data, analysis_file)
+        finally:
+            self.enable_index_refresh()
+
+        if checksum:
+            stats["checksum"] = get_file_checksum(analysis_file, checksum)
+
+        return stats
+
+    def _index_parquet_file(self, header_data, analysis_file):
+        '''
+        Indexes the rows of a Parquet file, reading only the columns that
+        aren't ignored
+        '''
+        parquet_file = parquet.ParquetFile(analysis_file)
+        schema = parquet_file.schema.to_arrow_schema()
+
+        fld_xd = Set(self.__field_ignore__)
+        self._rm_fields(Set(schema.names))
+        column_types = {}
+        for field in schema:
+            if field.name not in fld_xd:
+                column_types[field.name] = _get_column_type(field)
+        columns = [name for name in schema.names if name in column_types]
+
+        self._configure_field_mapping(columns, header_data)
+        self._set_column_field_types(column_types)
+        self._verify_field_types()
+        self._check_for_reserved_fields()
+        self._put_column_mappings(columns, column_types, header_data)
+        header_data = self.store_header(header_data)
+
+        stats = {
+            "input_lines": parquet_file.metadata.num_rows,
+            "non_standard_chroms": 0
+        }
+        self._index_records(self._row_group_records(
+            parquet_file, columns, column_types, header_data))
+
+        return stats
+
+    def _row_group_records(
+            self, parquet_file, columns, column_types, header_data):
+        '''
+        Converts the row groups of a Parquet file into index records, each
+        column of a row group being converted at once
+        '''
+        chrom_numbers = {}
+        for idx in range(parquet_file.num_row_groups):
+            table = parquet_file.read_row_group(
+                idx, columns=columns, use_threads=False)
+            batch = {}
+            for name in columns:
+                batch[name] = _convert_values(
+                    table.column(name).to_pylist(),
+                    self.__field_types__[name],
+                    column_types[name])
+
+            for index_record in self._column_records(
+                    batch, table.num_rows, header_data, chrom_numbers):
+                yield index_record
+
+    def _set_column_field_types(self, column_types):
+        '''
+        Assigns the column types to the fields whose types aren't given in
+        the header
+        '''
+        logging.info("===================================================")
+        logging.info("Fields have been assigned the following data types:")
+        logging.info("===================================================")
+        for key in sorted(column_types.keys()):
+            if key not in self.__field_types__.keys():
+                if column_types[key] == "date":
+                    self.__field_types__[key] = "str"
+                else:
+                    self.__field_types__[key] = column_types[key]
+            logging.info("'" + key + "': " + self.__field_types__[key])
+        logging.info("=================================================")
+
+    def _put_column_mappings(self, columns, column_types, header_data):
+        '''
+        Maps the non string fields using their types, so that they don't
+        depend on the values of the first record indexed
+        '''
+        fields = {key: key for key in columns}
+        fields = self._update_record_keys(fields)
+        fields = self._remove_redundant_fields(fields)
+
+        properties = {}
+        for (key, column) in fields.items():
+            field_type = self.__field_types__[column]
+            if field_type == "str" and column_types[column] == "date":
+                # Dates are indexed as ISO 8601 strings
+                field_type = "date"
+            if key == "chrom_number" or key in header_data:
+                continue
+            if field_type in ES_FIELD_TYPES:
+                properties[key] = {"type": ES_FIELD_TYPES[field_type]}
+
+        if not properties:
+            return
+
+        try:
+            self.es_tools.put_mapping({"properties": properties})
+        except Exception as e:
+            # Fields already mapped differently, e.g. by a previous load,
+            # keep their mapping
+            logging.warn("Could not map the Parquet column types: %s", e)
+
+    def count_input_lines(self, input_file):
+        '''
+        Returns the number of rows of a Parquet file, from its metadata
+        '''
+        return parquet.ParquetFile(input_file).metadata.num_rows
+
+    def validate_record_number(self, record_count, imported_count):
+        '''
+        Parquet files hold no header line, each row is a record
+        '''
+        return record_count == imported_count
+
+
+def _get_column_type(field):
+    '''
+    Returns the loader field type of an Arrow schema field, date for
+    temporal columns
+    '''
+    arrow_type = field.type
+    if pyarrow.types.is_integer(arrow_type):
+        return "int"
+    if pyarrow.types.is_floating(arrow_type):
+        return "float"
+    if pyarrow.types.is_boolean(arrow_type):
+        return "bool"
+    if pyarrow.types.is_string(arrow_type) or \
+            pyarrow.types.is_binary(arrow_type) or \
+            pyarrow.types.is_dictionary(arrow_type):
+        return "str"
+    if pyarrow.types.is_temporal(arrow_type):
+        return "date"
+
+    logging.error(
+        "Column '%s' has unsupported type '%s'.", field.name, arrow_type)
+    exit(1)
+
+
+def _convert_values(values, field_type, column_type):
+    '''
+    Returns the values of a column as index record values, NaN being
+    treated as missing. Values are converted only if the field type given
+    in the header differs from the column type
+    '''
+    if column_type == "float":
+        values = [
+            None if value is not None and math.isnan(value) else value
+            for value in values]
+    elif column_type == "date":
+        values = [
+            value.isoformat() if value is not None else None
+            for value in values]
+
+    if field_type == column_type or (
+            field_type == "str" and column_type == "date"):
+        return _ColumnValues(values)
+
+    key_type = getattr(__builtin__, field_type)
+    return _ColumnValues(
+        key_type(value) if value is not None else None for value in values)
+
+
+##############################################
+######  TESTS             ####################
+##############################################
+
+import copy
+import datetime
+import tempfile
+import unittest
+from elasticsearchloader.es_fake import FAKE_HOST
+
+
+@unittest.skipIf(parquet is None, "needs pyarrow")
+class ParquetLoaderTests(unittest.TestCase):
+
+    header = {
+        "caller": "pqtest",
+        "sample_id": "SA1",
+        "field_mapping": {"chrom_number": "chr"},
+        "field_types": {"integer_median": "int"}
+    }
+
+    def write_file(self, file_name):
+        '''
+        writes a Parquet file of 7 rows, in row groups of 3 rows
+        '''
+        table = pyarrow.Table.from_arrays([
+            pyarrow.array(["c%d" % idx for idx in range(7)]),
+            pyarrow.array(["1", "2", "X", "y", "23", "7", "MT"]),
+            pyarrow.array(range(0, 7000, 1000), type=pyarrow.int64()),
+            pyarrow.array(range(999, 7999, 1000), type=pyarrow.int32()),
+            pyarrow.array([1.5, float("nan"), 2.0, None, 0.5, 3.0, 1.0]),
+            pyarrow.array([2.0, 3.0, None, 1.0, 0.0, 2.0, 4.0]),
+            pyarrow.array([True, False, True, None, True, False, True]),
+            pyarrow.array(
+                [datetime.datetime(2019, 1, idx + 1) for idx in range(7)],
+                type=pyarrow.timestamp("ms")),
+            pyarrow.array(["x"] * 7)
+        ], names=["cell_id", "chr", "start", "end", "state",
+                  "integer_median", "is_outlier", "created", "ignored"])
+        parquet.write_table(table, file_name, row_group_size=3)
+
+    def test_parquet_file(self):
+        (file_handle, file_name) = tempfile.mkstemp(suffix=".parquet")
+        os.close(file_handle)
+        loader = ParquetLoader(
+            es_index="pqtest", es_doc_type="pqtest",
+            es_host=FAKE_HOST, es_port=9200)
+        loader.create_index()
+        try:
+            self.write_file(file_name)
+            parquet_file = parquet.ParquetFile(file_name)
+            self.failUnless(parquet_file.num_row_groups == 3)
+            schema = parquet_file.schema.to_arrow_schema()
+            self.failUnless(
+                [_get_column_type(field) for field in schema] ==
+                ["str", "str", "int", "int", "float", "float", "bool",
+                 "date", "str"])
+
+            header = copy.deepcopy(self.header)
+            header["field_ignore"] = {"ignored": "str"}
+            stats = loader.parse(
+                analysis_file=file_name, custom_header=header)
+            loader.es_tools.refresh_index()
+            mappings = loader.es_tools.get_mappings()
+            results = loader.es_tools.raw_search(
+                {"query": {"match_all": {}}, "size": 100})
+        finally:
+            loader.es_tools.delete_index()
+            os.remove(file_name)
+
+        self.failUnless(stats["input_lines"] == 7)
+        properties = mappings["pqtest"]["mappings"]["pqtest"]["properties"]
+        self.failUnless(properties["start"]["type"] == "long")
+        self.failUnless(properties["end"]["type"] == "long")
+        self.failUnless(properties["state"]["type"] == "double")
+        self.failUnless(properties["is_outlier"]["type"] == "boolean")
+        self.failUnless(properties["created"]["type"] == "date")
+        # The header field type takes precedence over the column type
+        self.failUnless(properties["integer_median"]["type"] == "long")
+
+        # All rows of all row groups are indexed
+        records = sorted(
+            [hit["_source"] for hit in results["hits"]["hits"]],
+            key=lambda record: record["start"])
+        self.failUnless(
+            [record["cell_id"] for record in records] ==
+            ["c%d" % idx for idx in range(7)])
+        self.failUnless(
+            [record["chrom_number"] for record in records] ==
+            ["01", "02", "X", "Y", "X", "07", "MT"])
+        self.failUnless(
+            [record["state"] for record in records] ==
+            [1.5, None, 2.0, None, 0.5, 3.0, 1.0])
+        self.failUnless(
+            [record["integer_median"] for record in records] ==
+            [2, 3, None, 1, 0, 2, 4])
+        self.failUnless(records[3]["is_outlier"] is None)
+        self.failUnless(records[0]["created"] == "2019-01-01T00:00:00")
+        self.failUnless(records[6]["end"] == 6999)
+        self.failUnless("ignored" not in records[0])
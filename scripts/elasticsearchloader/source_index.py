@@ -0,0 +1,135 @@
+'''
+Input file headers stored once per source
+
+In normalized header mode the header of each loaded file is indexed once
+into the sources index, keyed by the source ID of the load, the data
+records keeping only the source ID and a few header fields used to filter
+them. The denormalized records and their events are copied as they are,
+readers needing the remaining header fields join them from the sources
+index by source ID (get_source), sources being cached as they don't
+change once loaded.
+'''
+
+import logging
+import threading
+from datetime import datetime
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import RequestError
+from elasticsearchloader.es_settings import SOURCES_INDEX
+from elasticsearchloader.es_settings import SOURCES_DOCTYPE
+
+# Number of sources kept by the lookup cache
+SOURCE_CACHE_SIZE = 1024
+
+# Maximum number of sources sharing a header value, i.e. the number of
+# times the same file has been loaded
+MAX_SOURCES = 10000
+
+# Cached source headers, by client and source ID
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+def index_source(es_tools, source_id, header_data):
+    '''
+    Stores the header of a source into the sources index
+    '''
+    es = es_tools.es
+    if not es_tools.exists(SOURCES_INDEX):
+        try:
+            es.indices.create(SOURCES_INDEX, body=get_sources_mappings())
+        except RequestError:
+            logging.info("%s exists.", SOURCES_INDEX)
+
+    source = dict(header_data)
+    source["source_id"] = source_id
+    source["index"] = es_tools.get_index()
+    source["doc_type"] = es_tools.get_doc_type()
+    source["timestamp"] = datetime.now()
+    es.index(SOURCES_INDEX, SOURCES_DOCTYPE, source, id=source_id)
+
+    with _sources_lock:
+        _cache_source(es, source_id, source)
+
+    return source
+
+
+def get_source(es_tools, source_id):
+    '''
+    Returns the header of a source, None if the source is unknown
+    '''
+    es = es_tools.es
+    key = (id(es), source_id)
+    with _sources_lock:
+        if key in _sources:
+            return _sources[key]
+
+    try:
+        source = es.get(
+            SOURCES_INDEX, source_id, doc_type=SOURCES_DOCTYPE)["_source"]
+    except NotFoundError:
+        return None
+
+    with _sources_lock:
+        _cache_source(es, source_id, source)
+
+    return source
+
+
+def get_source_ids(es_tools, source):
+    '''
+    Returns the IDs of the sources whose headers hold the given field
+    values, e.g. {'file_fullname': <path>}
+    '''
+    if not es_tools.exists(SOURCES_INDEX):
+        return []
+
+    results = es_tools.global_raw_search(SOURCES_INDEX, {
+        "query": {
+            "bool": {
+                "must": [
+                    {"match": {key: value}}
+                    for (key, value) in source.items()]
+            }
+        },
+        "_source": ["source_id"],
+        "size": MAX_SOURCES
+    })
+
+    return [
+        hit["_source"]["source_id"]
+        for hit in results.get("hits", {}).get("hits", [])]
+
+
+def get_sources_mappings():
+    '''
+    Returns the sources index mappings, header values being matched as
+    a whole
+    '''
+    return {
+        "mappings": {
+            SOURCES_DOCTYPE: {
+                "dynamic_templates": [
+                    {
+                        "string_values": {
+                            "match": "*",
+                            "match_mapping_type": "string",
+                            "mapping": {
+                                "type": "string",
+                                "index": "not_analyzed"
+                            }
+                        }
+                    }
+                ]
+            }
+        }
+    }
+
+
+def _cache_source(es, source_id, source):
+    '''
+    Caches the header of a source, the cache being emptied once full
+    '''
+    if len(_sources) >= SOURCE_CACHE_SIZE:
+        _sources.clear()
+    _sources[(id(es), source_id)] = source
@@ -10,7 +10,8 @@ setup(
         'Development Status :: 3 - Alpha',
         'Programming Language :: Python :: 2.7'
     ],
-    packages=find_packages(include=['elasticsearchloader']),
+    packages=find_packages(
+        include=['elasticsearchloader', 'elasticsearchloader.*']),
     install_requires=[
         'elasticsearch',
         'prettytable',